@@ -9,18 +9,17 @@ import socket
 import sys
 import os
 import json
-import zipfile
-import tempfile
-import shutil
 
 # 將專案根目錄加入路徑以使用 server.utils
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
-from server.utils import send_json, recv_json, send_file
+from server.utils import send_json, recv_json, send_file_stream, build_manifest
+from packager import iter_game_archive
 
 # ========================= 配置 =========================
 SERVER_HOST = '140.113.17.11'
 SERVER_PORT = 16969
 GAMES_DIR = os.path.join(os.path.dirname(__file__), 'games')
+INDEX_DIR = os.path.join(os.path.dirname(__file__), '.publish_index')  # 本地檔案雜湊快取
 
 # ========================= 全域變數 =========================
 sock = None
@@ -200,6 +199,32 @@ def list_local_games():
     
     return games
 
+def load_publish_index(game_path):
+    """讀取本地檔案雜湊快取 {相對路徑: {"mtime", "size", "hash"}}"""
+    index_path = os.path.join(INDEX_DIR, os.path.basename(os.path.normpath(game_path)) + '.json')
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except:
+        return {}
+
+def save_publish_index(game_path, index):
+    """儲存本地檔案雜湊快取"""
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    index_path = os.path.join(INDEX_DIR, os.path.basename(os.path.normpath(game_path)) + '.json')
+    try:
+        with open(index_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+    except Exception as e:
+        print(f"  ⚠️ 無法寫入檔案索引: {e}")
+
+def scan_game(game_path):
+    """計算本地遊戲的檔案清單 (未變更的檔案沿用快取的雜湊值)"""
+    index = load_publish_index(game_path)
+    manifest = build_manifest(game_path, cache=index)
+    save_publish_index(game_path, index)
+    return manifest
+
 def upload_game():
     """上架新遊戲"""
     print_header("上架新遊戲")
@@ -260,22 +285,9 @@ def upload_game():
         print("  已取消")
         return
     
-    # 打包遊戲
-    print("\n  ⏳ 正在打包遊戲...")
-    
-    temp_dir = tempfile.mkdtemp()
-    zip_path = os.path.join(temp_dir, f"{config.get('name', 'game')}.zip")
-    
     try:
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, dirs, files in os.walk(game_path):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, game_path)
-                    zipf.write(file_path, arcname)
-        
         # 發送上架請求
-        print("  ⏳ 正在上傳...")
+        print("\n  ⏳ 正在上傳...")
         
         response = send_request("UPLOAD_GAME", {
             "game_info": {
@@ -289,8 +301,9 @@ def upload_game():
         })
         
         if response and response.get("success"):
-            # 傳送檔案
-            success, msg = send_file(sock, zip_path)
+            # 邊打包邊傳送檔案
+            archive = iter_game_archive(game_path)
+            success, msg = send_file_stream(sock, f"{config.get('name', 'game')}.zip", archive)
             
             if success:
                 # 等待最終確認
@@ -308,9 +321,6 @@ def upload_game():
     except Exception as e:
         print(f"\n  ❌ 上架過程發生錯誤: {e}")
     
-    finally:
-        shutil.rmtree(temp_dir, ignore_errors=True)
-    
     input("  按 Enter 返回...")
 
 def create_config_interactive(game_path):
@@ -460,30 +470,45 @@ def update_game():
     
     update_notes = input("  更新說明 (可選): ").strip()
     
-    # 打包並上傳
-    print("\n  ⏳ 正在打包遊戲...")
+    # 比對伺服器目前版本的檔案清單，只上傳有變更的檔案
+    print("\n  ⏳ 正在比對檔案...")
+    
+    manifest = scan_game(game_path)
+    changed = None
     
-    temp_dir = tempfile.mkdtemp()
-    zip_path = os.path.join(temp_dir, "update.zip")
+    manifest_resp = send_request("GET_GAME_MANIFEST", {"game_id": selected_game["game_id"]})
+    if manifest_resp and manifest_resp.get("success"):
+        remote = manifest_resp["data"]["manifest"]
+        if remote.get("algorithm") == manifest["algorithm"]:
+            remote_files = remote.get("files", {})
+            changed = [
+                rel_path for rel_path, info in manifest["files"].items()
+                if remote_files.get(rel_path, {}).get("hash") != info["hash"]
+            ]
+    
+    if changed is None:
+        print("  ⚠️ 無法取得伺服器檔案清單，改為完整上傳")
+    else:
+        changed_size = sum(manifest["files"][rel_path]["size"] for rel_path in changed)
+        print(f"  📦 {len(changed)}/{len(manifest['files'])} 個檔案有變更 ({changed_size / 1024:.1f} KB)")
     
     try:
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, dirs, files in os.walk(game_path):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, game_path)
-                    zipf.write(file_path, arcname)
-        
         print("  ⏳ 正在上傳更新...")
         
-        response = send_request("UPDATE_GAME", {
+        update_request = {
             "game_id": selected_game["game_id"],
             "version": new_version,
             "update_notes": update_notes
-        })
+        }
+        if changed is not None:
+            update_request["manifest"] = manifest
+        
+        response = send_request("UPDATE_GAME", update_request)
         
         if response and response.get("success"):
-            success, msg = send_file(sock, zip_path)
+            # 邊打包 (只含變更的檔案) 邊傳送
+            archive = iter_game_archive(game_path, changed)
+            success, msg = send_file_stream(sock, "update.zip", archive)
             
             if success:
                 final_response = recv_json(sock)
@@ -499,9 +524,6 @@ def update_game():
     except Exception as e:
         print(f"\n  ❌ 更新過程發生錯誤: {e}")
     
-    finally:
-        shutil.rmtree(temp_dir, ignore_errors=True)
-    
     input("  按 Enter 返回...")
 
 def unpublish_game():
@@ -13,9 +13,12 @@ import tkinter as tk
 from tkinter import messagebox, scrolledtext
 
 class GuessNumberClient:
-    def __init__(self, host='127.0.0.1', port=9000):
+    def __init__(self, host='127.0.0.1', port=9000, room_id=None, username=None, token=None):
         self.host = host
         self.port = port
+        self.room_id = room_id
+        self.username = username
+        self.token = token
         self.sock = None
         self.player_name = None
         self.my_turn = False
@@ -306,6 +309,10 @@ class GuessNumberClient:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.sock.connect((self.host, self.port))
             
+            if self.room_id:
+                # 大廳託管模式共用 Port，先表明要進入的房間
+                self.send_message({"action": "ATTACH", "room_id": self.room_id, "username": self.username, "token": self.token})
+            
             recv_thread = threading.Thread(target=self.receive_messages)
             recv_thread.daemon = True
             recv_thread.start()
@@ -335,9 +342,12 @@ def main():
     parser = argparse.ArgumentParser(description='猜數字遊戲客戶端')
     parser.add_argument('--host', type=str, default='127.0.0.1')
     parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--room-id', type=str, help="Room ID (大廳託管模式)")
+    parser.add_argument('--username', type=str, help="玩家帳號 (大廳託管模式)")
+    parser.add_argument('--token', type=str, help="大廳發給玩家的連線 token (由大廳啟動時用來確認帳號)")
     args = parser.parse_args()
     
-    client = GuessNumberClient(args.host, args.port)
+    client = GuessNumberClient(args.host, args.port, args.room_id, args.username, args.token)
     client.run()
 
 if __name__ == "__main__":
@@ -9,6 +9,7 @@ import socket
 import threading
 import json
 import argparse
+import hmac
 import random
 import time
 
@@ -24,32 +25,134 @@ class GameState:
         self.winner = None
         self.min_players = 2
         self.max_players = 6
+        self.guess_count = 0
 
 game = GameState()
 lock = threading.Lock()
 server_socket = None
+lobby = None  # 與大廳的控制連線 (由大廳啟動時才有)
+ATTACH_TIMEOUT = 10  # 由大廳啟動時，Client 連線後多久內必須送出 ATTACH
 
-def report_result(lobby_host, lobby_port, room_id, result):
-    """回報遊戲結果給 Lobby Server"""
-    if not lobby_port or not room_id:
-        return
-        
-    try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((lobby_host, lobby_port))
-        
-        request = {
-            "action": "REPORT_GAME_RESULT",
-            "room_id": room_id,
-            "result": result
-        }
-        
-        data = json.dumps(request).encode('utf-8')
-        sock.sendall(len(data).to_bytes(4, 'big') + data)
-        sock.close()
-        print(f"[Report] Result sent to lobby: {result}")
-    except Exception as e:
-        print(f"[Error] Failed to report result: {e}")
+class LobbyChannel:
+    """
+    與 Lobby Server 的控制連線 (以大廳啟動時給的 --lobby-token 驗證)
+    整場遊戲共用一條連線：定期送出心跳與進度，遊戲結束時送出結果
+    """
+    HEARTBEAT_SECONDS = 5
+    
+    def __init__(self, lobby_host, lobby_port, room_id, token, status=None):
+        self.address = (lobby_host, lobby_port)
+        self.room_id = room_id
+        self.token = token
+        self.status = status  # 回傳心跳附帶資訊 (players / state) 的函式
+        self.sock = None
+        self.lock = threading.RLock()
+        self.closed = False
+        self.attach_tokens = {}  # 大廳帳號 -> ATTACH token (控制連線建立時由大廳提供)
+    
+    def start(self):
+        """建立連線並開始送出心跳，沒有大廳資訊時不啟用並回傳 False (連線失敗時之後送出訊息會再重試)"""
+        if not (self.address[1] and self.room_id and self.token):
+            return False
+        with self.lock:
+            self.connect()
+        threading.Thread(target=self.heartbeat_loop, daemon=True).start()
+        return True
+    
+    def connect(self):
+        try:
+            sock = socket.create_connection(self.address, timeout=5)
+            self.write(sock, {
+                "action": "GAME_CONTROL",
+                "client_type": "game_server",
+                "room_id": self.room_id,
+                "token": self.token
+            })
+            response = self.read(sock)
+            if not response or not response.get("success"):
+                print(f"[Lobby] Control channel rejected: {response.get('message') if response else 'no response'}")
+                sock.close()
+                return False
+            self.sock = sock
+            self.attach_tokens = (response.get("data") or {}).get("attach_tokens") or {}
+            return True
+        except (OSError, ValueError) as e:
+            print(f"[Lobby] Cannot connect to lobby: {e}")
+            return False
+    
+    def send(self, message):
+        """送出訊息，斷線時重新連線一次"""
+        with self.lock:
+            for _ in range(2):
+                if self.sock is None and not self.connect():
+                    return False
+                try:
+                    self.write(self.sock, message)
+                    return True
+                except OSError:
+                    self.sock.close()
+                    self.sock = None
+            return False
+    
+    def verify_attach(self, username, token):
+        """檢查 Client 的 ATTACH token 是否為大廳發給該帳號的 token"""
+        expected = self.attach_tokens.get(username)
+        return isinstance(token, str) and bool(expected) and hmac.compare_digest(expected, token)
+    
+    def heartbeat_loop(self):
+        while not self.closed:
+            time.sleep(self.HEARTBEAT_SECONDS)
+            message = {"type": "HEARTBEAT"}
+            if self.status:
+                message.update(self.status())
+            self.send(message)
+    
+    def send_stats(self, stats):
+        """即時對戰統計 (會合併，並在結果中一併記錄)"""
+        self.send({"type": "STATS", "stats": stats})
+    
+    def report_result(self, result):
+        """回報遊戲結果並等待大廳確認"""
+        with self.lock:
+            if not self.send({"type": "RESULT", "result": result}):
+                print("[Error] Failed to report result")
+                return False
+            try:
+                self.sock.settimeout(5)
+                response = self.read(self.sock)
+            except (OSError, ValueError):
+                response = None
+            print(f"[Report] Result sent to lobby: {result} ({response.get('message') if response else 'no response'})")
+            return bool(response and response.get("success"))
+    
+    def close(self):
+        with self.lock:
+            self.closed = True
+            if self.sock:
+                self.sock.close()
+                self.sock = None
+    
+    @staticmethod
+    def write(sock, data):
+        msg = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        sock.sendall(len(msg).to_bytes(4, 'big') + msg)
+    
+    @staticmethod
+    def read(sock):
+        header = b''
+        while len(header) < 4:
+            chunk = sock.recv(4 - len(header))
+            if not chunk:
+                return None
+            header += chunk
+        length = int.from_bytes(header, 'big')
+        data = b''
+        while len(data) < length:
+            chunk = sock.recv(length - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return json.loads(data.decode('utf-8'))
 
 def send_to_client(client_socket, message):
     """發送訊息給客戶端"""
@@ -109,8 +212,42 @@ def notify_turn():
             "range": {"min": range_min, "max": range_max}
         })
 
+def read_attach(client_socket, player_name):
+    """
+    由大廳啟動時 Client 連線後會先送出 ATTACH (帶大廳帳號與大廳發的 token)，
+    在加入遊戲前先處理，之後所有訊息都使用帳號名稱 (勝利者才能對應到大廳的玩家)
+    token 不符或名稱已被使用時維持預設名稱，連線中斷則回傳 None
+    """
+    if not lobby:
+        return player_name
+    try:
+        client_socket.settimeout(ATTACH_TIMEOUT)
+        message = LobbyChannel.read(client_socket)
+        client_socket.settimeout(None)
+    except socket.timeout:
+        return player_name
+    except (OSError, ValueError):
+        return None
+    if message is None:
+        return None
+    if message.get("action") != "ATTACH":
+        return player_name
+    
+    username = message.get("username")
+    if not lobby.verify_attach(username, message.get("token")):
+        print(f"[Server] ATTACH 驗證失敗: {username}")
+        return player_name
+    with lock:
+        if username in {info["name"] for info in game.players.values()}:
+            return player_name
+    return username
+
 def handle_client(client_socket, player_name):
     """處理單一客戶端"""
+    player_name = read_attach(client_socket, player_name)
+    if player_name is None:
+        client_socket.close()
+        return
     print(f"[Server] {player_name} 已連線")
     
     with lock:
@@ -195,6 +332,7 @@ def handle_client(client_socket, player_name):
                         continue
                     
                     result = None
+                    game.guess_count += 1
                     if guess == game.target:
                         result = "correct"
                         game.winner = player_name
@@ -213,6 +351,8 @@ def handle_client(client_socket, player_name):
                     "result": result,
                     "range": {"min": game.min_range, "max": game.max_range}
                 })
+                if lobby:
+                    lobby.send_stats({"guesses": game.guess_count, "range": [game.min_range, game.max_range]})
                 
                 if result == "correct":
                     broadcast({
@@ -263,16 +403,191 @@ def handle_client(client_socket, player_name):
             "player_count": len(game.players)
         })
 
+class GuessNumberRoom:
+    """
+    大廳託管模式 (config.json 的 hosting: in_process)
+    由大廳在同一個 process 內執行，所有回呼都在同一個執行緒，不需要 lock
+    """
+    
+    def __init__(self, room):
+        self.room = room
+        self.target = random.randint(1, 100)
+        self.min_range = 1
+        self.max_range = 100
+        self.player_order = []  # 依連線順序的 HostedPlayer
+        self.current_index = 0
+        self.game_started = False
+        self.countdown_started = False
+        self.winner = None
+        self.min_players = 2
+        self.max_players = 6
+    
+    def on_join(self, player):
+        if len(self.player_order) >= self.max_players:
+            player.send({"type": "FULL", "message": "遊戲人數已滿"})
+            player.close()
+            return
+        if self.game_started:
+            player.send({"type": "STARTED", "message": "遊戲已經開始"})
+            player.close()
+            return
+        
+        print(f"[Server] {player.name} 已連線 (room {self.room.room_id})")
+        self.player_order.append(player)
+        player_count = len(self.player_order)
+        
+        player.send({
+            "type": "JOINED",
+            "player_name": player.name,
+            "player_count": player_count,
+            "min_players": self.min_players
+        })
+        self.room.broadcast({
+            "type": "PLAYER_JOINED",
+            "player_name": player.name,
+            "player_count": player_count
+        }, exclude=player)
+        
+        # 人數足夠時倒數開始 (倒數期間仍可加入)
+        if player_count >= self.min_players and not self.countdown_started:
+            self.countdown_started = True
+            self.room.broadcast({
+                "type": "COUNTDOWN",
+                "message": "人數足夠！5 秒後開始遊戲...",
+                "seconds": 5
+            })
+            self.room.call_later(5, self.start_game)
+    
+    def start_game(self):
+        if self.game_started or len(self.player_order) < self.min_players:
+            self.countdown_started = False
+            return
+        
+        self.game_started = True
+        self.current_index = 0
+        print(f"[Server] 遊戲開始！答案是: {self.target}")
+        
+        self.room.broadcast({
+            "type": "GAME_START",
+            "message": "遊戲開始！猜一個 1-100 的數字",
+            "range": {"min": 1, "max": 100},
+            "player_count": len(self.player_order)
+        })
+        self.notify_turn()
+    
+    def notify_turn(self):
+        if not self.player_order:
+            return
+        self.room.broadcast({
+            "type": "TURN",
+            "current_player": self.player_order[self.current_index].name,
+            "range": {"min": self.min_range, "max": self.max_range}
+        })
+    
+    def on_message(self, player, message):
+        action = message.get("action")
+        
+        if action == "GUESS":
+            if not self.game_started or self.winner:
+                return
+            if player is not self.player_order[self.current_index]:
+                player.send({"type": "ERROR", "message": "還沒輪到你！"})
+                return
+            
+            guess = message.get("number")
+            if not isinstance(guess, int) or not (self.min_range <= guess <= self.max_range):
+                player.send({
+                    "type": "ERROR",
+                    "message": f"請猜 {self.min_range} 到 {self.max_range} 之間的數字！"
+                })
+                return
+            
+            if guess == self.target:
+                result = "correct"
+                self.winner = player.name
+            elif guess < self.target:
+                result = "higher"
+                self.min_range = guess + 1
+            else:
+                result = "lower"
+                self.max_range = guess - 1
+            
+            self.room.broadcast({
+                "type": "GUESS_RESULT",
+                "player": player.name,
+                "guess": guess,
+                "result": result,
+                "range": {"min": self.min_range, "max": self.max_range}
+            })
+            
+            if result == "correct":
+                self.room.broadcast({
+                    "type": "GAME_OVER",
+                    "winner": player.name,
+                    "answer": self.target,
+                    "message": f"🎉 {player.name} 猜中了！答案是 {self.target}"
+                })
+                self.room.report({"winner": player.name, "reason": "normal_end"})
+                self.room.finish()
+                return
+            
+            self.current_index = (self.current_index + 1) % len(self.player_order)
+            self.notify_turn()
+        
+        elif action == "CHAT":
+            self.room.broadcast({
+                "type": "CHAT",
+                "player": player.name,
+                "message": message.get("message", "")
+            })
+        
+        elif action == "QUIT":
+            player.close()
+    
+    def on_leave(self, player):
+        if player not in self.player_order:
+            return
+        
+        idx = self.player_order.index(player)
+        self.player_order.remove(player)
+        if self.current_index >= len(self.player_order) and self.player_order:
+            self.current_index = 0
+        elif idx < self.current_index:
+            self.current_index -= 1
+        
+        print(f"[Server] {player.name} 已離線")
+        self.room.broadcast({
+            "type": "PLAYER_LEFT",
+            "player_name": player.name,
+            "player_count": len(self.player_order)
+        })
+        
+        if self.winner:
+            return
+        if self.game_started and not self.player_order:
+            # 所有人都離開了，遊戲終止 (不回報結果，由大廳重置房間)
+            self.room.finish()
+        elif self.game_started and idx == self.current_index:
+            # 輪到的玩家離開，換下一位
+            self.notify_turn()
+
 def main():
-    global server_socket
+    global server_socket, lobby
     
     parser = argparse.ArgumentParser(description='猜數字遊戲伺服器')
     parser.add_argument('--port', type=int, default=9000, help='監聽埠號')
     parser.add_argument('--host', type=str, default='140.113.17.11', help='監聽位址')
     parser.add_argument('--lobby-port', type=int, help="Lobby Server Port")
     parser.add_argument('--room-id', type=str, help="Room ID")
+    parser.add_argument('--lobby-token', type=str, help="Lobby control channel token")
     args = parser.parse_args()
     
+    channel = LobbyChannel(args.host, args.lobby_port, args.room_id, args.lobby_token,
+                           status=lambda: {"players": len(game.players),
+                                           "state": "playing" if game.game_started else "waiting"})
+    if channel.start():
+        lobby = channel
+    
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     
@@ -289,12 +604,11 @@ def main():
             with lock:
                 if game.winner is not None:
                     # 回報結果
-                    if args.lobby_port and args.room_id:
-                        result = {
+                    if lobby:
+                        lobby.report_result({
                             "winner": game.winner,
                             "reason": "normal_end"
-                        }
-                        report_result(args.host, args.lobby_port, args.room_id, result)
+                        })
                     
                     time.sleep(3)
                     break
@@ -339,6 +653,7 @@ def main():
     except KeyboardInterrupt:
         print("\n[Server] 伺服器關閉")
     finally:
+        channel.close()
         server_socket.close()
 
 if __name__ == "__main__":
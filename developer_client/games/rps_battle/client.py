@@ -11,9 +11,12 @@ import sys
 import threading
 
 class RPSClient:
-    def __init__(self, host, port):
+    def __init__(self, host, port, room_id=None, username=None, token=None):
         self.host = host
         self.port = port
+        self.room_id = room_id
+        self.username = username
+        self.token = token
         self.sock = None
         self.running = True
         self.my_turn = False
@@ -23,6 +26,9 @@ class RPSClient:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.sock.connect((self.host, self.port))
             print(f"已連線到 {self.host}:{self.port}")
+            if self.room_id:
+                # 大廳託管模式共用 Port，先表明要進入的房間
+                self.send_json({"action": "ATTACH", "room_id": self.room_id, "username": self.username, "token": self.token})
             return True
         except Exception as e:
             print(f"連線失敗: {e}")
@@ -71,6 +77,10 @@ class RPSClient:
                     print(f"目前比分: {message['scores']}")
                     print("-"*30)
                     
+                elif msg_type == "ERROR":
+                    print(f"\n[錯誤] {message['message']}")
+                    self.running = False
+                    
                 elif msg_type == "GAME_OVER":
                     print("\n" + "="*30)
                     print(f"遊戲結束！")
@@ -140,7 +150,10 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--host', default='127.0.0.1')
     parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--room-id', type=str, help="Room ID (大廳託管模式)")
+    parser.add_argument('--username', type=str, help="玩家帳號 (大廳託管模式)")
+    parser.add_argument('--token', type=str, help="大廳發給玩家的連線 token (由大廳啟動時用來確認帳號)")
     args = parser.parse_args()
     
-    client = RPSClient(args.host, args.port)
+    client = RPSClient(args.host, args.port, args.room_id, args.username, args.token)
     client.run()
@@ -8,6 +8,7 @@ import socket
 import threading
 import json
 import argparse
+import hmac
 import time
 
 # 遊戲設定
@@ -23,6 +24,8 @@ class GameState:
 
 game = GameState()
 lock = threading.RLock()
+lobby = None  # 與大廳的控制連線 (由大廳啟動時才有)
+ATTACH_TIMEOUT = 10  # 由大廳啟動時，Client 連線後多久內必須送出 ATTACH
 
 def send_json(sock, data):
     try:
@@ -37,27 +40,126 @@ def broadcast(data):
         for sock in game.player_sockets:
             send_json(sock, data)
 
-def report_result(lobby_host, lobby_port, room_id, result):
-    """回報遊戲結果給 Lobby Server"""
-    if not lobby_port or not room_id:
-        return
-        
-    try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((lobby_host, lobby_port))
-        
-        request = {
-            "action": "REPORT_GAME_RESULT",
-            "room_id": room_id,
-            "result": result
-        }
-        
-        data = json.dumps(request).encode('utf-8')
-        sock.sendall(len(data).to_bytes(4, 'big') + data)
-        sock.close()
-        print(f"[Report] Result sent to lobby: {result}")
-    except Exception as e:
-        print(f"[Error] Failed to report result: {e}")
+class LobbyChannel:
+    """
+    與 Lobby Server 的控制連線 (以大廳啟動時給的 --lobby-token 驗證)
+    整場遊戲共用一條連線：定期送出心跳與進度，遊戲結束時送出結果
+    """
+    HEARTBEAT_SECONDS = 5
+    
+    def __init__(self, lobby_host, lobby_port, room_id, token, status=None):
+        self.address = (lobby_host, lobby_port)
+        self.room_id = room_id
+        self.token = token
+        self.status = status  # 回傳心跳附帶資訊 (players / state) 的函式
+        self.sock = None
+        self.lock = threading.RLock()
+        self.closed = False
+        self.attach_tokens = {}  # 大廳帳號 -> ATTACH token (控制連線建立時由大廳提供)
+    
+    def start(self):
+        """建立連線並開始送出心跳，沒有大廳資訊時不啟用並回傳 False (連線失敗時之後送出訊息會再重試)"""
+        if not (self.address[1] and self.room_id and self.token):
+            return False
+        with self.lock:
+            self.connect()
+        threading.Thread(target=self.heartbeat_loop, daemon=True).start()
+        return True
+    
+    def connect(self):
+        try:
+            sock = socket.create_connection(self.address, timeout=5)
+            self.write(sock, {
+                "action": "GAME_CONTROL",
+                "client_type": "game_server",
+                "room_id": self.room_id,
+                "token": self.token
+            })
+            response = self.read(sock)
+            if not response or not response.get("success"):
+                print(f"[Lobby] Control channel rejected: {response.get('message') if response else 'no response'}")
+                sock.close()
+                return False
+            self.sock = sock
+            self.attach_tokens = (response.get("data") or {}).get("attach_tokens") or {}
+            return True
+        except (OSError, ValueError) as e:
+            print(f"[Lobby] Cannot connect to lobby: {e}")
+            return False
+    
+    def send(self, message):
+        """送出訊息，斷線時重新連線一次"""
+        with self.lock:
+            for _ in range(2):
+                if self.sock is None and not self.connect():
+                    return False
+                try:
+                    self.write(self.sock, message)
+                    return True
+                except OSError:
+                    self.sock.close()
+                    self.sock = None
+            return False
+    
+    def verify_attach(self, username, token):
+        """檢查 Client 的 ATTACH token 是否為大廳發給該帳號的 token"""
+        expected = self.attach_tokens.get(username)
+        return isinstance(token, str) and bool(expected) and hmac.compare_digest(expected, token)
+    
+    def heartbeat_loop(self):
+        while not self.closed:
+            time.sleep(self.HEARTBEAT_SECONDS)
+            message = {"type": "HEARTBEAT"}
+            if self.status:
+                message.update(self.status())
+            self.send(message)
+    
+    def send_stats(self, stats):
+        """即時對戰統計 (會合併，並在結果中一併記錄)"""
+        self.send({"type": "STATS", "stats": stats})
+    
+    def report_result(self, result):
+        """回報遊戲結果並等待大廳確認"""
+        with self.lock:
+            if not self.send({"type": "RESULT", "result": result}):
+                print("[Error] Failed to report result")
+                return False
+            try:
+                self.sock.settimeout(5)
+                response = self.read(self.sock)
+            except (OSError, ValueError):
+                response = None
+            print(f"[Report] Result sent to lobby: {result} ({response.get('message') if response else 'no response'})")
+            return bool(response and response.get("success"))
+    
+    def close(self):
+        with self.lock:
+            self.closed = True
+            if self.sock:
+                self.sock.close()
+                self.sock = None
+    
+    @staticmethod
+    def write(sock, data):
+        msg = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        sock.sendall(len(msg).to_bytes(4, 'big') + msg)
+    
+    @staticmethod
+    def read(sock):
+        header = b''
+        while len(header) < 4:
+            chunk = sock.recv(4 - len(header))
+            if not chunk:
+                return None
+            header += chunk
+        length = int.from_bytes(header, 'big')
+        data = b''
+        while len(data) < length:
+            chunk = sock.recv(length - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return json.loads(data.decode('utf-8'))
 
 def determine_round_winner(move1, move2):
     # R: Rock, P: Paper, S: Scissors
@@ -119,6 +221,14 @@ def process_round():
                 p2_name: game.players[p2_sock]["score"]
             }
         })
+        if lobby:
+            lobby.send_stats({
+                "rounds": game.round,
+                "scores": {
+                    p1_name: game.players[p1_sock]["score"],
+                    p2_name: game.players[p2_sock]["score"]
+                }
+            })
         
         # 檢查遊戲結束
         game_winner = check_game_over()
@@ -140,6 +250,36 @@ def process_round():
                 "round": game.round
             })
 
+def read_attach(client_socket, player_name):
+    """
+    由大廳啟動時 Client 連線後會先送出 ATTACH (帶大廳帳號與大廳發的 token)，
+    在加入遊戲前先處理，之後所有訊息都使用帳號名稱 (勝利者才能對應到大廳的玩家)
+    token 不符或名稱已被使用時維持預設名稱，連線中斷則回傳 None
+    """
+    if not lobby:
+        return player_name
+    try:
+        client_socket.settimeout(ATTACH_TIMEOUT)
+        message = LobbyChannel.read(client_socket)
+        client_socket.settimeout(None)
+    except socket.timeout:
+        return player_name
+    except (OSError, ValueError):
+        return None
+    if message is None:
+        return None
+    if message.get("action") != "ATTACH":
+        return player_name
+    
+    username = message.get("username")
+    if not lobby.verify_attach(username, message.get("token")):
+        print(f"[Server] ATTACH 驗證失敗: {username}")
+        return player_name
+    with lock:
+        if username in {info["name"] for info in game.players.values()}:
+            return player_name
+    return username
+
 def handle_client(client_socket, player_name):
     print(f"[Server] {player_name} 已連線")
     
@@ -193,14 +333,122 @@ def handle_client(client_socket, player_name):
     finally:
         client_socket.close()
 
+class RPSBattleRoom:
+    """
+    大廳託管模式 (config.json 的 hosting: in_process)
+    由大廳在同一個 process 內執行，所有回呼都在同一個執行緒，不需要 lock
+    """
+    
+    def __init__(self, room):
+        self.room = room
+        self.players = []   # 依連線順序的 HostedPlayer
+        self.scores = {}    # player -> 分數
+        self.moves = {}     # player -> 出拳
+        self.round = 1
+        self.game_over = False
+    
+    def on_join(self, player):
+        if len(self.players) >= 2:
+            player.send({"type": "ERROR", "message": "遊戲人數已滿"})
+            player.close()
+            return
+        
+        print(f"[Server] {player.name} 已連線 (room {self.room.room_id})")
+        self.players.append(player)
+        self.scores[player] = 0
+        self.moves[player] = None
+        
+        if len(self.players) == 2:
+            self.room.broadcast({
+                "type": "GAME_START",
+                "message": f"遊戲開始！搶 {WIN_COUNT} 勝",
+                "round": self.round
+            })
+    
+    def on_message(self, player, message):
+        action = message.get("action")
+        
+        if action == "MOVE":
+            move = message.get("move")
+            if move not in ['R', 'P', 'S'] or len(self.players) < 2 or self.game_over:
+                return
+            if player not in self.moves or self.moves[player] is not None:
+                return
+            
+            self.moves[player] = move
+            player.send({"type": "WAITING", "message": "已出拳，等待對手..."})
+            
+            if all(self.moves[p] for p in self.players):
+                self.process_round()
+        
+        elif action == "QUIT":
+            player.close()
+    
+    def on_leave(self, player):
+        if not self.game_over:
+            # 有玩家中途離開，遊戲終止 (不回報結果，由大廳重置房間)
+            print("玩家斷線，遊戲終止")
+            self.game_over = True
+            self.room.finish()
+    
+    def process_round(self):
+        """處理回合結算"""
+        p1, p2 = self.players
+        p1_move, p2_move = self.moves[p1], self.moves[p2]
+        
+        winner_idx = determine_round_winner(p1_move, p2_move)
+        
+        round_result = "平手"
+        if winner_idx == 1:
+            self.scores[p1] += 1
+            round_result = f"{p1.name} 獲勝"
+        elif winner_idx == 2:
+            self.scores[p2] += 1
+            round_result = f"{p2.name} 獲勝"
+        
+        self.room.broadcast({
+            "type": "ROUND_RESULT",
+            "round": self.round,
+            "p1_name": p1.name,
+            "p2_name": p2.name,
+            "p1_move": p1_move,
+            "p2_move": p2_move,
+            "result": round_result,
+            "scores": {p1.name: self.scores[p1], p2.name: self.scores[p2]}
+        })
+        
+        winner = next((p.name for p in self.players if self.scores[p] >= WIN_COUNT), None)
+        if winner:
+            self.game_over = True
+            self.room.broadcast({
+                "type": "GAME_OVER",
+                "winner": winner,
+                "message": f"恭喜 {winner} 獲得最終勝利！"
+            })
+            self.room.report({"winner": winner, "reason": "normal_end"})
+            self.room.finish()
+        else:
+            self.round += 1
+            self.moves[p1] = None
+            self.moves[p2] = None
+            self.room.broadcast({"type": "NEW_ROUND", "round": self.round})
+
 def main():
+    global lobby
+    
     parser = argparse.ArgumentParser()
     parser.add_argument('--port', type=int, default=9000)
     parser.add_argument('--host', type=str, default='140.113.17.11')
     parser.add_argument('--lobby-port', type=int, help="Lobby Server Port")
     parser.add_argument('--room-id', type=str, help="Room ID")
+    parser.add_argument('--lobby-token', type=str, help="Lobby control channel token")
     args = parser.parse_args()
     
+    channel = LobbyChannel(args.host, args.lobby_port, args.room_id, args.lobby_token,
+                           status=lambda: {"players": len(game.player_sockets), "state": f"round {game.round}"})
+    if channel.start():
+        lobby = channel
+    
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     
@@ -212,9 +460,12 @@ def main():
         # 等待兩位玩家
         while len(game.player_sockets) < 2:
             client, addr = server.accept()
+            player_name = read_attach(client, f"Player{len(game.player_sockets)+1}")
+            if player_name is None:
+                client.close()
+                continue
             
             with lock:
-                player_name = f"Player{len(game.player_sockets)+1}"
                 game.players[client] = {"name": player_name, "score": 0, "move": None}
                 game.player_sockets.append(client)
                 
@@ -236,16 +487,16 @@ def main():
                     break
             time.sleep(1)
             
-        if game.winner and args.lobby_port and args.room_id:
-            report_result(args.host, args.lobby_port, args.room_id, {
+        if game.winner and lobby:
+            lobby.report_result({
                 "winner": game.winner,
                 "reason": "normal_end"
             })
-            time.sleep(2) # 等待回報完成
             
     except Exception as e:
         print(f"[Error] Server error: {e}")
     finally:
+        channel.close()
         server.close()
 
 if __name__ == "__main__":
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Game Store System - Developer Client 打包工具
+以多個行程平行壓縮檔案，邊產生 zip 內容邊交給呼叫者送出，不需要先寫出暫存 zip 檔
+"""
+
+import os
+import time
+import zlib
+import struct
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+# 由 dev_client 負責將專案根目錄加入路徑
+from server.utils import walk_files
+
+# ========================= 配置 =========================
+COMPRESS_LEVEL = 6
+# 本身已壓縮過的格式，再壓縮只會浪費 CPU，直接以 STORED 存放
+STORED_EXTENSIONS = {
+    '.png', '.jpg', '.jpeg', '.gif', '.webp',
+    '.ogg', '.mp3', '.mp4', '.webm', '.m4a',
+    '.zip', '.gz', '.bz2', '.xz', '.7z', '.rar',
+    '.woff', '.woff2'
+}
+# 總大小低於此值時直接在本行程壓縮，省下啟動 process pool 的成本
+PARALLEL_THRESHOLD = 1024 * 1024
+STREAM_CHUNK_SIZE = 64 * 1024
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+UTF8_FLAG = 0x800
+ZIP_VERSION = 20
+
+# ========================= 壓縮單一檔案 =========================
+
+def compress_entry(task):
+    """
+    壓縮單一檔案 (在 worker 行程執行)
+    回傳 (arcname, method, crc32, 壓縮後內容, 原始大小, mtime, mode)
+    """
+    file_path, arcname = task
+    stat = os.stat(file_path)
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    
+    crc = zlib.crc32(data) & 0xffffffff
+    method = ZIP_STORED
+    payload = data
+    
+    if os.path.splitext(arcname)[1].lower() not in STORED_EXTENSIONS:
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        # 壓縮後沒有變小就直接存放
+        if len(compressed) < len(data):
+            method = ZIP_DEFLATED
+            payload = compressed
+    
+    return arcname, method, crc, payload, len(data), stat.st_mtime, stat.st_mode
+
+def dos_datetime(timestamp):
+    """將 timestamp 轉成 zip 使用的 DOS 日期與時間"""
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+# ========================= 串流 zip =========================
+
+def iter_compressed(tasks, workers=None):
+    """依原順序產出壓縮結果；檔案夠大時交給 process pool 平行處理"""
+    total_size = sum(os.path.getsize(file_path) for file_path, _ in tasks)
+    
+    if len(tasks) < 2 or total_size < PARALLEL_THRESHOLD:
+        for task in tasks:
+            yield compress_entry(task)
+        return
+    
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # 只預先送出有限數量的工作，避免網路較慢時壓縮結果全部堆在記憶體
+        pending = deque()
+        task_iter = iter(tasks)
+        
+        for task in task_iter:
+            pending.append(executor.submit(compress_entry, task))
+            if len(pending) >= workers * 2:
+                break
+        
+        while pending:
+            result = pending.popleft().result()
+            next_task = next(task_iter, None)
+            if next_task is not None:
+                pending.append(executor.submit(compress_entry, next_task))
+            yield result
+
+def iter_zip_chunks(tasks, workers=None):
+    """
+    依序產出 zip 檔的位元組區塊
+    tasks: [(完整路徑, 壓縮檔內名稱), ...]
+    """
+    if len(tasks) > 0xffff:
+        raise ValueError("檔案數量過多 (超過 65535 個)")
+    
+    offset = 0
+    central_dir = []
+    
+    for arcname, method, crc, payload, size, mtime, mode in iter_compressed(tasks, workers):
+        if offset > 0xffffffff or size > 0xffffffff:
+            raise ValueError(f"檔案過大，不支援 zip64: {arcname}")
+        
+        name = arcname.encode('utf-8')
+        dos_time, dos_date = dos_datetime(mtime)
+        
+        local_header = struct.pack(
+            '<IHHHHHIIIHH',
+            0x04034b50, ZIP_VERSION, UTF8_FLAG, method, dos_time, dos_date,
+            crc, len(payload), size, len(name), 0
+        ) + name
+        
+        central_dir.append(struct.pack(
+            '<IHHHHHHIIIHHHHHII',
+            0x02014b50, (3 << 8) | ZIP_VERSION, ZIP_VERSION, UTF8_FLAG, method, dos_time, dos_date,
+            crc, len(payload), size, len(name), 0, 0, 0, 0, (mode & 0xffff) << 16, offset
+        ) + name)
+        
+        yield local_header
+        for start in range(0, len(payload), STREAM_CHUNK_SIZE):
+            yield payload[start:start + STREAM_CHUNK_SIZE]
+        
+        offset += len(local_header) + len(payload)
+    
+    central_bytes = b''.join(central_dir)
+    yield central_bytes
+    yield struct.pack(
+        '<IHHHHIIH',
+        0x06054b50, 0, 0, len(central_dir), len(central_dir), len(central_bytes), offset, 0
+    )
+
+def iter_game_archive(game_path, rel_paths=None, workers=None):
+    """產出遊戲目錄的 zip 串流，指定 rel_paths 時只打包這些檔案"""
+    wanted = set(rel_paths) if rel_paths is not None else None
+    tasks = [
+        (file_path, arcname) for arcname, file_path in walk_files(game_path)
+        if wanted is None or arcname in wanted
+    ]
+    return iter_zip_chunks(tasks, workers)
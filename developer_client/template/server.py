@@ -8,6 +8,7 @@
 import socket
 import threading
 import json
+import time
 import argparse
 
 # 遊戲狀態
@@ -20,6 +21,7 @@ game_state = {
 
 clients = []
 lock = threading.Lock()
+lobby = None  # 與大廳的控制連線 (由大廳啟動時才有)
 
 def broadcast(message):
     """廣播訊息給所有客戶端"""
@@ -51,6 +53,8 @@ def handle_client(client_socket, player_id):
             if action == "MOVE":
                 # 處理玩家移動
                 # 在此實作遊戲邏輯
+                # 可用 lobby.send_stats({...}) 即時回報對戰統計，
+                # 遊戲結束時呼叫 lobby.report_result({"winner": ..., "reason": "normal_end"})
                 pass
             
             elif action == "QUIT":
@@ -66,40 +70,137 @@ def handle_client(client_socket, player_id):
         client_socket.close()
         print(f"[Disconnect] Player {player_id}")
 
-def report_result(lobby_host, lobby_port, room_id, result):
-    """回報遊戲結果給 Lobby Server"""
-    try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((lobby_host, lobby_port))
-        
-        request = {
-            "action": "REPORT_GAME_RESULT",
-            "room_id": room_id,
-            "result": result
-        }
-        
-        data = json.dumps(request).encode('utf-8')
-        sock.sendall(len(data).to_bytes(4, 'big') + data)
-        
-        # 接收回應 (可選)
-        header = sock.recv(4)
-        if header:
-            length = int.from_bytes(header, 'big')
-            resp_data = sock.recv(length)
-            print(f"[Report] Lobby response: {resp_data.decode('utf-8')}")
-            
-        sock.close()
-    except Exception as e:
-        print(f"[Error] Failed to report result: {e}")
+class LobbyChannel:
+    """
+    與 Lobby Server 的控制連線 (以大廳啟動時給的 --lobby-token 驗證)
+    整場遊戲共用一條連線：定期送出心跳與進度，遊戲結束時送出結果
+    """
+    HEARTBEAT_SECONDS = 5
+    
+    def __init__(self, lobby_host, lobby_port, room_id, token, status=None):
+        self.address = (lobby_host, lobby_port)
+        self.room_id = room_id
+        self.token = token
+        self.status = status  # 回傳心跳附帶資訊 (players / state) 的函式
+        self.sock = None
+        self.lock = threading.RLock()
+        self.closed = False
+    
+    def start(self):
+        """建立連線並開始送出心跳，沒有大廳資訊時不啟用並回傳 False (連線失敗時之後送出訊息會再重試)"""
+        if not (self.address[1] and self.room_id and self.token):
+            return False
+        with self.lock:
+            self.connect()
+        threading.Thread(target=self.heartbeat_loop, daemon=True).start()
+        return True
+    
+    def connect(self):
+        try:
+            sock = socket.create_connection(self.address, timeout=5)
+            self.write(sock, {
+                "action": "GAME_CONTROL",
+                "client_type": "game_server",
+                "room_id": self.room_id,
+                "token": self.token
+            })
+            response = self.read(sock)
+            if not response or not response.get("success"):
+                print(f"[Lobby] Control channel rejected: {response.get('message') if response else 'no response'}")
+                sock.close()
+                return False
+            self.sock = sock
+            return True
+        except (OSError, ValueError) as e:
+            print(f"[Lobby] Cannot connect to lobby: {e}")
+            return False
+    
+    def send(self, message):
+        """送出訊息，斷線時重新連線一次"""
+        with self.lock:
+            for _ in range(2):
+                if self.sock is None and not self.connect():
+                    return False
+                try:
+                    self.write(self.sock, message)
+                    return True
+                except OSError:
+                    self.sock.close()
+                    self.sock = None
+            return False
+    
+    def heartbeat_loop(self):
+        while not self.closed:
+            time.sleep(self.HEARTBEAT_SECONDS)
+            message = {"type": "HEARTBEAT"}
+            if self.status:
+                message.update(self.status())
+            self.send(message)
+    
+    def send_stats(self, stats):
+        """即時對戰統計 (會合併，並在結果中一併記錄)"""
+        self.send({"type": "STATS", "stats": stats})
+    
+    def report_result(self, result):
+        """回報遊戲結果並等待大廳確認"""
+        with self.lock:
+            if not self.send({"type": "RESULT", "result": result}):
+                print("[Error] Failed to report result")
+                return False
+            try:
+                self.sock.settimeout(5)
+                response = self.read(self.sock)
+            except (OSError, ValueError):
+                response = None
+            print(f"[Report] Result sent to lobby: {result} ({response.get('message') if response else 'no response'})")
+            return bool(response and response.get("success"))
+    
+    def close(self):
+        with self.lock:
+            self.closed = True
+            if self.sock:
+                self.sock.close()
+                self.sock = None
+    
+    @staticmethod
+    def write(sock, data):
+        msg = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        sock.sendall(len(msg).to_bytes(4, 'big') + msg)
+    
+    @staticmethod
+    def read(sock):
+        header = b''
+        while len(header) < 4:
+            chunk = sock.recv(4 - len(header))
+            if not chunk:
+                return None
+            header += chunk
+        length = int.from_bytes(header, 'big')
+        data = b''
+        while len(data) < length:
+            chunk = sock.recv(length - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return json.loads(data.decode('utf-8'))
 
 def main():
+    global lobby
+    
     parser = argparse.ArgumentParser()
     parser.add_argument('--port', type=int, default=9000)
     parser.add_argument('--host', type=str, default='140.113.17.11')
     parser.add_argument('--lobby-port', type=int, help="Lobby Server Port")
     parser.add_argument('--room-id', type=str, help="Room ID")
+    parser.add_argument('--lobby-token', type=str, help="Lobby control channel token")
     args = parser.parse_args()
     
+    # 與大廳的控制連線：自動送出心跳 (在線人數)，結果也由這條連線回報
+    channel = LobbyChannel(args.host, args.lobby_port, args.room_id, args.lobby_token,
+                           status=lambda: {"players": len(clients)})
+    if channel.start():
+        lobby = channel
+    
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server.bind((args.host, args.port))
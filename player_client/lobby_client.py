@@ -6,13 +6,16 @@ Game Store System - Lobby Client (Player)
 """
 
 import socket
+import select
 import sys
 import os
 import json
 import zipfile
 import subprocess
-import threading
 import time
+import shutil
+import tempfile
+from collections import deque
 
 # 將專案根目錄加入路徑以使用 server.utils
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
@@ -22,6 +25,21 @@ from server.utils import send_json, recv_json, recv_file_with_metadata
 SERVER_HOST = '140.113.17.11'
 SERVER_PORT = 16969
 DOWNLOADS_DIR = os.path.join(os.path.dirname(__file__), 'downloads')
+# 所有玩家共用的下載快取，依下載檔摘要存放，玩家目錄以硬連結建立
+CACHE_DIR = os.path.join(DOWNLOADS_DIR, '.cache')
+CACHE_MAX_BYTES = int(os.environ.get("LOBBY_CACHE_MAX_MB", "1024")) * 1024 * 1024
+# 等待開始時多久沒收到事件就主動確認一次房間狀態 (秒)
+ROOM_EVENT_TIMEOUT = 30
+# 伺服器主動推播的訊息類型 (不是請求的回應)
+PUSH_EVENT_TYPES = {
+    "GAME_UPDATE_NOTIFICATION", "ROOM_READY_UPDATE", "GAME_STARTED", "CHAT_MESSAGE", "MATCH_CANCELLED",
+    "ROOM_CLOSED"
+}
+# 房間畫面顯示的聊天訊息數量
+CHAT_DISPLAY_COUNT = 5
+# 連線中斷時重新連線的次數與間隔 (秒)，需在伺服器的寬限時間 (預設 60 秒) 內接回
+RESUME_ATTEMPTS = 5
+RESUME_RETRY_DELAY = 2
 
 # ========================= 全域變數 =========================
 sock = None
@@ -32,6 +50,9 @@ current_room = None
 game_process = None
 last_notification = None
 last_notification_time = 0
+room_list_cache = {"epoch": None, "revision": None, "rooms": {}}  # 房間列表快取，之後只查詢變動的部分
+# 目前房間的聊天紀錄 (推播收到的訊息直接加入，進入房間畫面時只補抓缺少的部分)
+room_chat = {"room_id": None, "last_seq": 0, "messages": deque(maxlen=CHAT_DISPLAY_COUNT)}
 
 # ========================= 工具函式 =========================
 
@@ -87,23 +108,75 @@ def send_request(action, data=None):
         request.update(data)
     
     if not send_json(sock, request):
-        print("  ❌ 發送請求失敗")
-        return None
+        # 請求沒有送出，重新連線接回 Session 後再送一次
+        if not resume_session() or not send_json(sock, request):
+            print("  ❌ 發送請求失敗")
+            return None
     
     while True:
         response = recv_json(sock)
         if not response:
+            # 不確定伺服器是否已處理這個請求，重新連線後不自動重送
+            if resume_session():
+                return {"success": False, "message": "連線中斷，已重新連線，請再試一次"}
             return None
             
-        if response.get("type") == "GAME_UPDATE_NOTIFICATION":
-            global last_notification, last_notification_time
-            last_notification = response.get("message")
-            last_notification_time = time.time()
-            print(f"\n  {last_notification}")
+        if handle_push_event(response):
             continue
             
         return response
 
+def resume_session():
+    """連線中斷時重新連線，並以 RESUME 接回原本的 Session (保留房間)"""
+    global sock
+    if not session_id:
+        return False
+    
+    for attempt in range(RESUME_ATTEMPTS):
+        if attempt:
+            time.sleep(RESUME_RETRY_DELAY)
+        disconnect()
+        try:
+            new_sock = socket.create_connection((SERVER_HOST, SERVER_PORT), timeout=5)
+            new_sock.settimeout(None)
+        except OSError:
+            continue
+        
+        sock = new_sock
+        if not send_json(sock, {"action": "RESUME", "client_type": "player", "session_id": session_id}):
+            continue
+        response = recv_json(sock)
+        while response and handle_push_event(response):
+            response = recv_json(sock)
+        if response and response.get("success"):
+            reset_room_list_cache()
+            print("  🔄 已重新連線")
+            return True
+        if response:
+            # Session 已過期，需要重新登入
+            print(f"  ❌ {response.get('message')}")
+            return False
+    return False
+
+def handle_push_event(message):
+    """處理伺服器推播的訊息，回傳 True 表示是推播 (不是請求的回應)"""
+    event_type = message.get("type")
+    if event_type not in PUSH_EVENT_TYPES:
+        return False
+    
+    if event_type == "GAME_UPDATE_NOTIFICATION":
+        global last_notification, last_notification_time
+        last_notification = message.get("message")
+        last_notification_time = time.time()
+        print(f"\n  {last_notification}")
+    elif event_type == "CHAT_MESSAGE":
+        add_chat_messages(message.get("room_id"), [message])
+    elif event_type == "ROOM_CLOSED":
+        print(f"\n  ⚠️ {message.get('message')}")
+    
+    # 房間事件只在等待開始時 (start_game) 才會讀取，其他時候收到的是過期事件，直接略過
+    return True
+
 # ========================= 連線管理 =========================
 
 def connect_to_server():
@@ -155,6 +228,7 @@ def login_menu():
             if response and response.get("success"):
                 session_id = response["data"]["session_id"]
                 username = response["data"]["username"]
+                reset_room_list_cache()
                 player_download_dir = os.path.join(DOWNLOADS_DIR, username)
                 os.makedirs(player_download_dir, exist_ok=True)
                 
@@ -315,12 +389,13 @@ def show_game_detail(game_id):
             "下載/更新此遊戲",
             "建立房間遊玩",
             "撰寫評論",
+            "排行榜",
             "返回"
         ])
         
-        choice = get_choice("請選擇: ", 4)
+        choice = get_choice("請選擇: ", 5)
         
-        if choice == 'q' or choice == 4:
+        if choice == 'q' or choice == 5:
             return
         
         if choice == 1:
@@ -329,6 +404,43 @@ def show_game_detail(game_id):
             create_room(game_id)
         elif choice == 3:
             write_review(game_id)
+        elif choice == 4:
+            show_leaderboard(game_id, game['name'])
+
+def show_leaderboard(game_id, game_name):
+    """顯示遊戲排行榜 (可切換積分 / 勝場 / 勝率)"""
+    boards = [("rating", "積分"), ("wins", "勝場"), ("win_rate", "勝率")]
+    board, label = boards[0]
+    
+    while True:
+        clear_screen()
+        print_header(f"排行榜 - {game_name} ({label})")
+        
+        response = send_request("GET_LEADERBOARD", {"game_id": game_id, "board": board, "limit": 10})
+        if not response or not response.get("success"):
+            print(f"  ❌ {response.get('message', '查詢失敗') if response else '連線失敗'}")
+            input("  按 Enter 返回...")
+            return
+        
+        data = response["data"]
+        if not data["entries"]:
+            print("  ⚠️ 尚無排行資料")
+            if board == "win_rate":
+                print(f"  (至少需要 {data['min_games']} 場才會列入勝率排行)")
+        for entry in data["entries"]:
+            mark = "👉" if entry["username"] == username else "  "
+            print(f"  {mark}{entry['rank']:>3}. {entry['username']:<16} 積分 {entry['rating']:>7.1f}  "
+                  f"{entry['wins']}/{entry['played']} 勝 ({entry['win_rate'] * 100:.1f}%)")
+        
+        me = data.get("player")
+        if me and me["rank"] > len(data["entries"]):
+            print(f"\n  您的名次: 第 {me['rank']} 名 / 共 {data['total']} 人")
+        
+        print_menu([f"查看{name}排行" for _, name in boards] + ["返回"])
+        choice = get_choice("請選擇: ", len(boards) + 1)
+        if choice == 'q' or choice == len(boards) + 1:
+            return
+        board, label = boards[choice - 1]
 
 def get_local_version(game_id):
     """取得本地遊戲版本"""
@@ -375,51 +487,69 @@ def download_game(game_id, game_name, server_version):
         input("  按 Enter 返回...")
         return
     
-    # 準備接收檔案
-    send_json(sock, {"status": "READY"})
-    
-    # 接收檔案 metadata
-    while True:
-        file_meta = recv_json(sock)
-        if file_meta and file_meta.get("type") == "GAME_UPDATE_NOTIFICATION":
-            global last_notification, last_notification_time
-            last_notification = file_meta.get("message")
-            last_notification_time = time.time()
-            print(f"\n  {last_notification}")
-            continue
-        break
-
-    if not file_meta or file_meta.get("type") != "FILE_TRANSFER":
-        print(f"\n  ❌ 未收到檔案")
-        input("  按 Enter 返回...")
-        return
-    
-    # 建立臨時目錄接收
-    import tempfile
-    temp_dir = tempfile.mkdtemp()
-    
-    success, msg, file_path = recv_file_with_metadata(sock, file_meta, temp_dir)
+    data = response["data"]
+    digest = data.get("digest")
+    cached_dir = cache_lookup(digest)
     
-    if not success:
-        print(f"\n  ❌ 下載失敗: {msg}")
-        import shutil
-        shutil.rmtree(temp_dir, ignore_errors=True)
-        input("  按 Enter 返回...")
-        return
+    if cached_dir:
+        # 本機快取已有相同內容 (可能是其他帳號下載的)，不必重新下載
+        send_json(sock, {"status": "CACHED"})
+        print("  ⚡ 本機快取已有此版本，略過下載")
+    else:
+        # 準備接收檔案
+        send_json(sock, {"status": "READY"})
+        
+        # 接收檔案 metadata
+        while True:
+            file_meta = recv_json(sock)
+            if file_meta and handle_push_event(file_meta):
+                continue
+            break
+        
+        if not file_meta or file_meta.get("type") != "FILE_TRANSFER":
+            print(f"\n  ❌ 未收到檔案")
+            input("  按 Enter 返回...")
+            return
+        
+        # 有摘要時接收到快取目錄 (中斷後可續傳)，否則使用臨時目錄
+        if digest:
+            recv_dir = os.path.join(CACHE_DIR, 'partial', digest[:16])
+        else:
+            recv_dir = tempfile.mkdtemp()
+        
+        success, msg, file_path = recv_file_with_metadata(sock, file_meta, recv_dir)
+        
+        if not success:
+            print(f"\n  ❌ 下載失敗: {msg}")
+            if not digest:
+                shutil.rmtree(recv_dir, ignore_errors=True)
+            input("  按 Enter 返回...")
+            return
+        
+        if digest:
+            try:
+                cached_dir = cache_store(digest, file_path, game_id, server_version)
+            except Exception as e:
+                print(f"\n  ❌ 解壓縮失敗: {e}")
+                shutil.rmtree(recv_dir, ignore_errors=True)
+                input("  按 Enter 返回...")
+                return
+            shutil.rmtree(recv_dir, ignore_errors=True)
     
-    # 解壓縮到遊戲目錄
+    # 建立遊戲目錄 (取代舊版本)
     game_dir = os.path.join(player_download_dir, game_id)
     
-    # 清除舊版本
-    if os.path.exists(game_dir):
-        import shutil
-        shutil.rmtree(game_dir)
-    
-    os.makedirs(game_dir)
-    
     try:
-        with zipfile.ZipFile(file_path, 'r') as zip_ref:
-            zip_ref.extractall(game_dir)
+        if cached_dir:
+            materialize_game(cached_dir, game_dir)
+        else:
+            # 伺服器未提供摘要 (舊版伺服器)，直接解壓縮
+            if os.path.exists(game_dir):
+                shutil.rmtree(game_dir)
+            os.makedirs(game_dir)
+            with zipfile.ZipFile(file_path, 'r') as zip_ref:
+                zip_ref.extractall(game_dir)
+            shutil.rmtree(recv_dir, ignore_errors=True)
             
         # 自動更新 config.json 中的版本號
         config_path = os.path.join(game_dir, 'config.json')
@@ -430,8 +560,11 @@ def download_game(game_id, game_name, server_version):
                 
                 config['version'] = server_version
                 
-                with open(config_path, 'w', encoding='utf-8') as f:
+                # 檔案是和快取共用的硬連結，必須寫到新檔再取代，不能直接覆寫
+                tmp_path = config_path + '.tmp'
+                with open(tmp_path, 'w', encoding='utf-8') as f:
                     json.dump(config, f, indent=4, ensure_ascii=False)
+                os.replace(tmp_path, config_path)
                     
                 print(f"  📝 Config 版本已更新至 v{server_version}")
             except Exception as e:
@@ -442,12 +575,119 @@ def download_game(game_id, game_name, server_version):
     except Exception as e:
         print(f"\n  ❌ 解壓縮失敗: {e}")
     
-    # 清理臨時目錄
-    import shutil
-    shutil.rmtree(temp_dir, ignore_errors=True)
-    
     input("  按 Enter 返回...")
 
+# ========================= 下載快取 =========================
+# downloads/.cache/objects/<摘要>/ 存放解壓縮後的遊戲檔案，同一份下載檔在這台電腦只存一次；
+# 各玩家的 downloads/<player>/<game_id>/ 以硬連結指向這些檔案 (不支援時改為複製)。
+# index.json 記錄每個快取項目的大小與最後使用時間，超過容量上限時依 LRU 淘汰。
+# 淘汰快取不影響已建立的玩家目錄 (硬連結仍保有內容)。
+
+def load_cache_index():
+    """讀取快取索引 {摘要: {"size", "last_used", "game_id", "version"}}"""
+    try:
+        with open(os.path.join(CACHE_DIR, 'index.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except:
+        return {}
+
+def save_cache_index(index):
+    """儲存快取索引 (先寫暫存檔再取代，避免多個 Client 同時寫入時損毀)"""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    index_path = os.path.join(CACHE_DIR, 'index.json')
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=4)
+    os.replace(tmp_path, index_path)
+
+def cache_object_dir(digest):
+    """取得快取項目的目錄"""
+    return os.path.join(CACHE_DIR, 'objects', digest)
+
+def cache_lookup(digest):
+    """查詢快取，命中時更新最後使用時間並回傳目錄"""
+    if not digest:
+        return None
+    
+    object_dir = cache_object_dir(digest)
+    if not os.path.isdir(object_dir):
+        return None
+    
+    index = load_cache_index()
+    entry = index.setdefault(digest, {})
+    if "size" not in entry:
+        entry["size"] = directory_size(object_dir)
+    entry["last_used"] = time.time()
+    save_cache_index(index)
+    return object_dir
+
+def cache_store(digest, zip_path, game_id, version):
+    """將下載檔解壓縮到快取，回傳快取目錄"""
+    object_dir = cache_object_dir(digest)
+    
+    if not os.path.isdir(object_dir):
+        staging_dir = os.path.join(CACHE_DIR, 'objects', f".tmp-{digest[:16]}-{os.getpid()}")
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            zip_ref.extractall(staging_dir)
+        try:
+            os.rename(staging_dir, object_dir)
+        except OSError:
+            # 其他 Client 已經放入相同內容
+            shutil.rmtree(staging_dir, ignore_errors=True)
+    
+    index = load_cache_index()
+    index[digest] = {
+        "size": directory_size(object_dir),
+        "last_used": time.time(),
+        "game_id": game_id,
+        "version": version
+    }
+    evict_cache(index, keep=digest)
+    save_cache_index(index)
+    return object_dir
+
+def evict_cache(index, keep=None):
+    """依最後使用時間淘汰快取，直到總大小不超過上限"""
+    total = sum(entry.get("size", 0) for entry in index.values())
+    
+    for digest, entry in sorted(index.items(), key=lambda item: item[1].get("last_used", 0)):
+        if total <= CACHE_MAX_BYTES:
+            break
+        if digest == keep:
+            continue
+        shutil.rmtree(cache_object_dir(digest), ignore_errors=True)
+        total -= entry.get("size", 0)
+        del index[digest]
+
+def directory_size(path):
+    """計算目錄下所有檔案的總大小"""
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            total += os.path.getsize(os.path.join(root, file))
+    return total
+
+def materialize_game(cache_dir, game_dir):
+    """以硬連結 (不支援時改用複製) 從快取建立玩家的遊戲目錄"""
+    tmp_dir = game_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    
+    for root, dirs, files in os.walk(cache_dir):
+        target_root = os.path.join(tmp_dir, os.path.relpath(root, cache_dir))
+        os.makedirs(target_root, exist_ok=True)
+        for file in files:
+            src = os.path.join(root, file)
+            dst = os.path.join(target_root, file)
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copy2(src, dst)
+    
+    if os.path.exists(game_dir):
+        shutil.rmtree(game_dir)
+    os.rename(tmp_dir, game_dir)
+
 # ========================= 房間功能 =========================
 
 def rooms_menu():
@@ -458,13 +698,14 @@ def rooms_menu():
         print_menu([
             "建立新房間",
             "加入房間",
+            "快速配對",
             "查看房間列表",
             "返回"
         ])
         
-        choice = get_choice("請選擇: ", 4)
+        choice = get_choice("請選擇: ", 5)
         
-        if choice == 'q' or choice == 4:
+        if choice == 'q' or choice == 5:
             return
         
         if choice == 1:
@@ -472,24 +713,25 @@ def rooms_menu():
         elif choice == 2:
             join_room_flow()
         elif choice == 3:
+            quick_match_flow()
+        elif choice == 4:
             show_rooms()
 
-def create_room_flow():
-    """建立房間流程"""
-    # 先選擇遊戲
+def select_game():
+    """列出可遊玩的遊戲讓玩家選擇，回傳選擇的遊戲 (取消時回傳 None)"""
     response = send_request("LIST_GAMES")
     
     if not response or not response.get("success"):
         print(f"  ❌ {response.get('message', '查詢失敗')}")
         input("  按 Enter 返回...")
-        return
+        return None
     
     games = response["data"]["games"]
     
     if not games:
         print("  ⚠️ 目前沒有可遊玩的遊戲")
         input("  按 Enter 返回...")
-        return
+        return None
     
     print_header("選擇遊戲")
     print("\n  可用遊戲:")
@@ -502,10 +744,16 @@ def create_room_flow():
     choice = get_choice("\n  選擇遊戲: ", len(games) + 1)
     
     if choice == 'q' or choice == len(games) + 1:
-        return
+        return None
     
-    game = games[choice - 1]
-    create_room(game['game_id'])
+    return games[choice - 1]
+
+def create_room_flow():
+    """建立房間流程"""
+    # 先選擇遊戲
+    game = select_game()
+    if game:
+        create_room(game['game_id'])
 
 def create_room(game_id):
     """建立房間"""
@@ -543,16 +791,134 @@ def create_room(game_id):
     
     enter_room(data['room_id'])
 
+def add_chat_messages(room_id, messages):
+    """將聊天訊息合併到目前房間的快取 (依序號排序、去重，推播與查詢結果可能重疊)"""
+    if room_id != room_chat["room_id"] or not messages:
+        return
+    merged = {msg["seq"]: msg for msg in room_chat["messages"]}
+    for msg in messages:
+        merged[msg["seq"]] = msg
+    room_chat["messages"] = deque(
+        (merged[seq] for seq in sorted(merged)), maxlen=CHAT_DISPLAY_COUNT
+    )
+    room_chat["last_seq"] = max(room_chat["last_seq"], max(merged))
+
+def refresh_room_chat(room_id):
+    """只向伺服器查詢上次之後的新訊息，回傳是否成功"""
+    if room_chat["room_id"] != room_id:
+        room_chat["room_id"] = room_id
+        room_chat["last_seq"] = 0
+        room_chat["messages"].clear()
+    
+    chat_resp = send_request("GET_ROOM_CHAT", {
+        "room_id": room_id,
+        "after_seq": room_chat["last_seq"],
+        "limit": CHAT_DISPLAY_COUNT
+    })
+    if not chat_resp or not chat_resp.get("success"):
+        return False
+    
+    add_chat_messages(room_id, chat_resp["data"]["chat_history"])
+    return True
+
+def quick_match_flow():
+    """快速配對流程：由伺服器自動分組並開始遊戲"""
+    global current_room
+    
+    game = select_game()
+    if not game:
+        return
+    
+    game_id = game['game_id']
+    
+    # 配對成功後會直接開始，必須先有最新版本
+    if get_local_version(game_id) != game['version']:
+        print("  ⚠️ 需要先下載最新版本才能配對")
+        confirm = input("  要現在下載嗎? (y/n): ").strip().lower()
+        if confirm != 'y':
+            return
+        download_game(game_id, game['name'], game['version'])
+        if get_local_version(game_id) != game['version']:
+            return
+    
+    response = send_request("QUICK_MATCH", {"game_id": game_id})
+    
+    if not response or not response.get("success"):
+        print(f"  ❌ {response.get('message', '配對失敗')}")
+        input("  按 Enter 返回...")
+        return
+    
+    data = response["data"]
+    print(f"\n  🔍 配對中... (目前排隊 {data['queue_size']} 人，按 Ctrl+C 取消)")
+    
+    event = wait_for_match(game_id, data.get("max_wait", 120))
+    if not event:
+        return
+    
+    room_id = event.get("room_id")
+    if event.get("type") == "GAME_STARTED":
+        print(f"\n  🎯 配對成功！房間 {room_id}，玩家: {', '.join(event.get('players', []))}")
+        current_room = room_id
+        join_started_game(room_id, game_id, event.get("port"), event.get("server_host"), event.get("attach_token"))
+    else:
+        # 已建立房間但遊戲未能啟動，進入房間畫面處理
+        print(f"\n  ❌ {event.get('message')}")
+        input("  按 Enter 進入房間...")
+    
+    if room_id:
+        enter_room(room_id)
+
+def wait_for_match(game_id, max_wait):
+    """
+    等待配對結果，回傳 GAME_STARTED 或帶有 room_id 的 MATCH_CANCELLED 事件
+    配對取消、逾時或連線中斷時回傳 None
+    """
+    deadline = time.time() + max_wait + ROOM_EVENT_TIMEOUT
+    
+    try:
+        while time.time() < deadline:
+            readable, _, _ = select.select([sock], [], [], 1)
+            if not readable:
+                continue
+            
+            event = recv_json(sock)
+            if not event:
+                print("  ❌ 連線中斷")
+                input("  按 Enter 返回...")
+                return None
+            
+            if event.get("type") == "GAME_STARTED" and event.get("match") and event.get("game_id") == game_id:
+                return event
+            
+            if event.get("type") == "MATCH_CANCELLED" and event.get("game_id") == game_id:
+                if event.get("room_id"):
+                    return event
+                print(f"\n  ⚠️ {event.get('message')}")
+                input("  按 Enter 返回...")
+                return None
+            
+            handle_push_event(event)
+    except KeyboardInterrupt:
+        pass
+    
+    # 使用者取消或等待過久
+    response = send_request("CANCEL_MATCH")
+    if response and response.get("success"):
+        print("\n  已取消配對")
+    input("  按 Enter 返回...")
+    return None
+
 def join_room_flow():
     """加入房間流程"""
-    response = send_request("LIST_ROOMS")
+    # 只查詢還在等待且有空位的房間，依房內玩家與自己的積分差距排序
+    response = send_request("LIST_ROOMS", {"status": "waiting", "has_free_slot": True, "sort": "rating"})
     
     if not response or not response.get("success"):
         print(f"  ❌ {response.get('message', '查詢失敗')}")
         input("  按 Enter 返回...")
         return
     
-    rooms = [r for r in response["data"]["rooms"] if r['status'] == 'waiting']
+    rooms = response["data"]["rooms"]
     
     if not rooms:
         print("  ⚠️ 目前沒有可加入的房間")
@@ -562,7 +928,8 @@ def join_room_flow():
     print_header("選擇房間")
     for i, room in enumerate(rooms, 1):
         print(f"  {i}. [{room['room_id']}] {room['game_name']}")
-        print(f"     房主: {room['host']} | 人數: {room['player_count']}/{room['max_players']}")
+        print(f"     房主: {room['host']} | 人數: {room['player_count']}/{room['max_players']}"
+              f" | 平均積分: {room['avg_rating']:.0f} (差距 {room['rating_gap']:.0f})")
     print(f"  {len(rooms) + 1}. 返回")
     
     choice = get_choice("\n  選擇房間: ", len(rooms) + 1)
@@ -584,19 +951,46 @@ def join_room_flow():
     print(f"  ✅ 加入成功！")
     enter_room(room['room_id'])
 
+def fetch_rooms():
+    """
+    取得房間列表，回傳 (rooms, error)
+    已有快取時只查詢上次 revision 之後的變動
+    """
+    response = send_request("LIST_ROOMS", {
+        "since_revision": room_list_cache["revision"],
+        "epoch": room_list_cache["epoch"]
+    })
+    
+    if not response or not response.get("success"):
+        return None, (response or {}).get('message', '查詢失敗')
+    
+    data = response["data"]
+    if data.get("full", True):
+        room_list_cache["rooms"] = {}
+    for room_id in data.get("removed", []):
+        room_list_cache["rooms"].pop(room_id, None)
+    for room in data["rooms"]:
+        room_list_cache["rooms"][room["room_id"]] = room
+    room_list_cache["revision"] = data.get("revision")
+    room_list_cache["epoch"] = data.get("epoch")
+    
+    return list(room_list_cache["rooms"].values()), None
+
+def reset_room_list_cache():
+    """登入或重新連線後清除房間列表快取，下次查詢取得完整列表"""
+    room_list_cache.update(epoch=None, revision=None, rooms={})
+
 def show_rooms():
     """顯示房間列表"""
     print_header("房間列表")
     
-    response = send_request("LIST_ROOMS")
+    rooms, error = fetch_rooms()
     
-    if not response or not response.get("success"):
-        print(f"  ❌ {response.get('message', '查詢失敗')}")
+    if error:
+        print(f"  ❌ {error}")
         input("  按 Enter 返回...")
         return
     
-    rooms = response["data"]["rooms"]
-    
     if not rooms:
         print("  ⚠️ 目前沒有房間")
     else:
@@ -621,20 +1015,16 @@ def enter_room(room_id):
         clear_screen()
         print_header(f"房間 {room_id}")
         
-        # 取得房間狀態
-        response = send_request("LIST_ROOMS")
+        # 取得房間狀態 (只查詢這一間)
+        response = send_request("GET_ROOM", {"room_id": room_id})
         
-        if not response or not response.get("success"):
+        if not response:
             print("  ❌ 無法取得房間資訊")
             current_room = None
             input("  按 Enter 返回...")
             return
         
-        room = None
-        for r in response["data"]["rooms"]:
-            if r['room_id'] == room_id:
-                room = r
-                break
+        room = response["data"] if response.get("success") else None
         
         if not room:
             print("  ⚠️ 房間已解散")
@@ -682,15 +1072,14 @@ def enter_room(room_id):
             print(f"\n  💬 聊天室 (Plugin v{chat_plugin_ver}):")
             print("  " + "-" * 40)
             
-            # 取得聊天紀錄
-            chat_resp = send_request("GET_ROOM_CHAT", {"room_id": room_id})
-            if chat_resp and chat_resp.get("success"):
-                history = chat_resp["data"]["chat_history"]
+            # 取得聊天紀錄 (只補抓新訊息)
+            if refresh_room_chat(room_id):
+                history = room_chat["messages"]
                 if not history:
                     print("  (無訊息)")
                 else:
                     # 顯示最近 5 則
-                    for msg in history[-5:]:
+                    for msg in history:
                         print(f"  [{msg['time']}] {msg['username']}: {msg['message']}")
             else:
                 print("  (無法取得聊天紀錄)")
@@ -739,7 +1128,7 @@ def enter_room(room_id):
         if action == "START":
             start_game(room_id, room['game_name'])
         elif action == "JOIN_GAME":
-            join_started_game(room_id, game_id, room.get('port'))
+            join_started_game(room_id, game_id, room.get('port'), room.get('server_host'), room.get('attach_token'))
         elif action == "UPDATE":
             download_game(game_id, room['game_name'], latest_version)
         elif action == "LEAVE":
@@ -753,12 +1142,13 @@ def enter_room(room_id):
         elif action == "REFRESH":
             pass
 
-def launch_game_client(game_id, port, client_cmd=None):
-    """啟動遊戲客戶端"""
+def launch_game_client(game_id, port, client_cmd=None, room_id=None, host=None, attach_token=None):
+    """啟動遊戲客戶端 (host 為 Game Server 所在的遊戲主機，未指定時連線到大廳)"""
     global game_process
     
+    host = host or SERVER_HOST
     print(f"  ✅ 遊戲已啟動！")
-    print(f"  連線 Port: {port}")
+    print(f"  連線位址: {host}:{port}")
     
     # 啟動遊戲客戶端
     game_dir = os.path.join(player_download_dir, game_id)
@@ -780,7 +1170,10 @@ def launch_game_client(game_id, port, client_cmd=None):
 
         if cmd:
             # 加入連線參數
-            full_cmd = cmd + ["--host", SERVER_HOST, "--port", str(port)]
+            full_cmd = cmd + ["--host", host, "--port", str(port)]
+            if room_id and config.get("hosting") == "in_process":
+                # 支援大廳託管模式的遊戲共用一個 Port，需要告知房間、帳號與大廳發給自己的 token
+                full_cmd += ["--room-id", room_id, "--username", username, "--token", attach_token or ""]
             print(f"  啟動指令: {' '.join(full_cmd)}")
             
             try:
@@ -826,43 +1219,17 @@ def start_game(room_id, game_name):
         print(f"\n  ✅ 已準備！等待其他玩家... ({ready_count}/{total_count})")
         print("  (請勿關閉視窗，遊戲將自動開始)")
         
-        while True:
-            time.sleep(1)
-            # 輪詢房間狀態
-            resp = send_request("LIST_ROOMS")
-            if not resp or not resp.get("success"):
-                print("  ❌ 連線中斷")
-                input("  按 Enter 返回...")
-                return
-                
-            room = None
-            for r in resp["data"]["rooms"]:
-                if r['room_id'] == room_id:
-                    room = r
-                    break
-            
-            if not room:
-                print("  ⚠️ 房間已解散")
-                input("  按 Enter 返回...")
-                return
-                
-            if room['status'] == 'playing':
-                # 遊戲開始了！
-                # 這裡需要再次呼叫 START_GAME 或是直接取得 Port
-                # 但因為 START_GAME 會回傳 Port，所以我們可以再次呼叫它
-                # 或者更簡單：直接加入遊戲
-                print("\n  🚀 所有玩家已準備，遊戲開始！")
-                join_started_game(room_id, room['game_id'], room.get('port'))
-                return
-            
-            # 更新等待訊息 (可選)
-            # print(".", end="", flush=True)
+        # 等待伺服器推播 ROOM_READY_UPDATE / GAME_STARTED，不再輪詢
+        data = wait_for_game_start(room_id)
+        if not data:
+            return
+        print("\n  🚀 所有玩家已準備，遊戲開始！")
             
     port = data["port"]
     client_cmd = data.get("client_command", [])
     game_id = data.get("game_id", room_id.split('-')[0]) # Fallback for old server
     
-    launch_game_client(game_id, port, client_cmd)
+    launch_game_client(game_id, port, client_cmd, room_id, data.get("server_host"), data.get("attach_token"))
     
     print("\n  遊戲進行中... (關閉遊戲視窗以返回)")
     
@@ -880,12 +1247,64 @@ def start_game(room_id, game_name):
     # 詢問是否評分
     prompt_review_after_game(game_id)
 
-def join_started_game(room_id, game_id, port):
+def wait_for_game_start(room_id):
+    """
+    阻塞等待房間的推播事件，遊戲開始時回傳 GAME_STARTED 的內容
+    房間解散、準備狀態被重置或連線中斷時回傳 None
+    """
+    while True:
+        readable, _, _ = select.select([sock], [], [], ROOM_EVENT_TIMEOUT)
+        
+        if not readable:
+            # 一段時間沒有事件，主動確認房間是否還在 (避免漏接事件)
+            resp = send_request("GET_ROOM", {"room_id": room_id})
+            if not resp:
+                print("  ❌ 連線中斷")
+                input("  按 Enter 返回...")
+                return None
+            
+            room = resp["data"] if resp.get("success") else None
+            if not room:
+                print("  ⚠️ 房間已解散")
+                input("  按 Enter 返回...")
+                return None
+            
+            if room['status'] == 'playing':
+                return {"game_id": room['game_id'], "port": room.get('port'), "server_host": room.get('server_host')}
+            continue
+        
+        event = recv_json(sock)
+        if not event:
+            print("  ❌ 連線中斷")
+            input("  按 Enter 返回...")
+            return None
+        
+        if event.get("room_id") != room_id:
+            handle_push_event(event)
+            continue
+        
+        if event.get("type") == "GAME_STARTED":
+            return event
+        
+        if event.get("type") == "ROOM_CLOSED":
+            print(f"\n  ⚠️ {event.get('message')}")
+            input("  按 Enter 返回...")
+            return None
+        
+        if event.get("type") == "ROOM_READY_UPDATE":
+            if event.get("status") == "waiting" and username not in event.get("ready_players", []):
+                # 遊戲啟動失敗，伺服器已重置準備狀態
+                print(f"\n  ❌ {event.get('message') or '遊戲未能開始'}")
+                input("  按 Enter 返回...")
+                return None
+            print(f"  ⏳ 已準備 {event['ready_count']}/{event['total_count']}")
+
+def join_started_game(room_id, game_id, port, host=None, attach_token=None):
     """加入已開始的遊戲 (非房主)"""
     global game_process
     
     print("\n  ⏳ 正在啟動遊戲客戶端...")
-    launch_game_client(game_id, port)
+    launch_game_client(game_id, port, room_id=room_id, host=host, attach_token=attach_token)
     
     print("\n  遊戲進行中... (關閉遊戲視窗以返回)")
     
@@ -1328,6 +1747,23 @@ def show_my_history():
         return
     
     played_games = response["data"]["played_games"]
+    stats = response["data"].get("stats")
+    
+    # 累計戰績與最近的對戰
+    if stats:
+        print(f"\n  📊 戰績: {stats['played']} 場 {stats['wins']} 勝 (勝率 {stats['win_rate'] * 100:.1f}%)")
+        history = send_request("GET_MATCH_HISTORY", {"limit": 5})
+        if history and history.get("success") and history["data"]["matches"]:
+            print("\n  最近的對戰:")
+            for match in history["data"]["matches"]:
+                played_at = time.strftime('%m-%d %H:%M', time.localtime(match["time"]))
+                if match["winner"] == username:
+                    outcome = "勝"
+                elif match["winner"]:
+                    outcome = f"負 (勝者 {match['winner']})"
+                else:
+                    outcome = "無勝負"
+                print(f"    {played_at}  {match['game_id']}  {outcome}")
     
     if not played_games:
         print("  ⚠️ 尚未遊玩過任何遊戲")
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Game Store System - 遊戲主機註冊表與配置
+遊戲主機 (game_agent.py) 連線到大廳註冊容量、可用 Port 與已載入的遊戲版本，
+大廳啟動遊戲時挑選負載最低的主機，透過同一條連線下達啟動 / 停止指令
+"""
+
+import time
+import itertools
+import threading
+
+from utils import send_json
+
+# 遊戲主機超過這麼久沒有任何訊息就不再配置新的遊戲
+AGENT_STALE_SECONDS = 30
+
+class GameAgent:
+    """一台已註冊的遊戲主機"""
+    __slots__ = ("agent_id", "host", "sock", "capacity", "free_ports", "versions",
+                 "rooms", "load", "usage", "last_seen", "registered_at", "send_lock", "pending")
+    
+    def __init__(self, agent_id, host, sock, capacity, free_ports, versions):
+        self.agent_id = agent_id
+        self.host = host                  # Client 連線到此主機上 Game Server 的位址
+        self.sock = sock                  # 控制連線
+        self.capacity = capacity          # 最多同時執行的 Game Server 數量
+        self.free_ports = free_ports
+        self.versions = set(versions)     # 已有檔案的 "game_id/version_dir"
+        self.rooms = set()                # 配置在此主機上的房間 (含啟動中)
+        self.load = None                  # 主機回報的系統負載
+        self.usage = {}                   # 主機回報的各遊戲資源用量
+        self.last_seen = time.monotonic()
+        self.registered_at = time.time()
+        self.send_lock = threading.Lock()
+        self.pending = {}                 # request_id -> [Event, 回覆]
+    
+    def utilization(self):
+        return len(self.rooms) / self.capacity if self.capacity else 1
+
+class AgentRegistry:
+    """
+    遊戲主機註冊表
+    - place() 依 (使用率, 是否需要下載遊戲, 系統負載) 挑選主機，並立即預留名額避免同時配置到同一台
+    - call() 送出指令並等待主機以 REPLY 回覆 (回覆由讀取控制連線的執行緒呼叫 deliver() 送達)
+    - START 等不到回覆時送出 STOP 取消該房間，主機也會放棄超過期限仍未開始的啟動
+    """
+    
+    def __init__(self, call_timeout=30):
+        self.call_timeout = call_timeout
+        self.lock = threading.Lock()
+        self.agents = {}       # agent_id -> GameAgent
+        self.placements = {}   # room_id -> GameAgent
+        self.counter = itertools.count(1)
+        
+        # 統計
+        self.placed = 0
+        self.rejected = 0
+    
+    # ---------- 註冊 ----------
+    
+    def register(self, agent_id, host, sock, capacity, free_ports, versions):
+        """註冊遊戲主機，回傳 (agent, error)"""
+        with self.lock:
+            if agent_id in self.agents:
+                return None, "相同 ID 的遊戲主機已連線"
+            agent = GameAgent(agent_id, host, sock, capacity, free_ports, versions)
+            self.agents[agent_id] = agent
+            return agent, None
+    
+    def unregister(self, agent):
+        """主機離線，回傳原本配置在上面的房間"""
+        with self.lock:
+            if self.agents.get(agent.agent_id) is agent:
+                del self.agents[agent.agent_id]
+            room_ids = list(agent.rooms)
+            for room_id in room_ids:
+                if self.placements.get(room_id) is agent:
+                    del self.placements[room_id]
+            agent.rooms.clear()
+            pending = list(agent.pending.values())
+        
+        # 喚醒還在等待回覆的呼叫
+        for waiter in pending:
+            waiter[0].set()
+        return room_ids
+    
+    def update(self, agent, status):
+        """主機定期回報的狀態"""
+        with self.lock:
+            agent.last_seen = time.monotonic()
+            agent.free_ports = status.get("free_ports", agent.free_ports)
+            agent.load = status.get("load")
+            agent.usage = status.get("usage", agent.usage)
+            if "versions" in status:
+                agent.versions = set(status["versions"])
+    
+    # ---------- 配置 ----------
+    
+    def place(self, room_id, game_id, version_dir):
+        """挑選負載最低的遊戲主機並預留名額，沒有可用主機時回傳 None"""
+        version_key = f"{game_id}/{version_dir}"
+        now = time.monotonic()
+        
+        with self.lock:
+            candidates = [
+                agent for agent in self.agents.values()
+                if len(agent.rooms) < agent.capacity and agent.free_ports > 0
+                and now - agent.last_seen < AGENT_STALE_SECONDS
+            ]
+            if not candidates:
+                self.rejected += 1
+                return None
+            
+            agent = min(candidates, key=lambda a: (
+                a.utilization(), version_key not in a.versions, a.load if a.load is not None else 0, a.agent_id
+            ))
+            agent.rooms.add(room_id)
+            agent.free_ports -= 1
+            self.placements[room_id] = agent
+            self.placed += 1
+            return agent
+    
+    def release(self, room_id, agent=None):
+        """房間的 Game Server 已結束 (或啟動失敗)，歸還名額；agent 不符時回傳 False"""
+        with self.lock:
+            placed = self.placements.get(room_id)
+            if placed is None or (agent is not None and placed is not agent):
+                return False
+            del self.placements[room_id]
+            placed.rooms.discard(room_id)
+            placed.free_ports += 1
+            return True
+    
+    def agent_of(self, room_id):
+        with self.lock:
+            return self.placements.get(room_id)
+    
+    # ---------- 指令 ----------
+    
+    def send(self, agent, message):
+        with agent.send_lock:
+            return send_json(agent.sock, message)
+    
+    def call(self, agent, message, timeout=None):
+        """送出指令並等待回覆，主機離線或逾時回傳 None"""
+        request_id = next(self.counter)
+        waiter = [threading.Event(), None]
+        with self.lock:
+            agent.pending[request_id] = waiter
+        
+        try:
+            if not self.send(agent, {**message, "request_id": request_id}):
+                return None
+            waiter[0].wait(timeout or self.call_timeout)
+            return waiter[1]
+        finally:
+            with self.lock:
+                agent.pending.pop(request_id, None)
+    
+    def deliver(self, agent, reply):
+        """控制連線收到 REPLY"""
+        with self.lock:
+            agent.last_seen = time.monotonic()
+            waiter = agent.pending.get(reply.get("request_id"))
+        if waiter:
+            waiter[1] = reply
+            waiter[0].set()
+    
+    def start(self, agent, room_id, game_id, version_dir, server_cmd, token, attach_tokens=None):
+        """
+        請主機啟動 Game Server，回傳 (port, error)
+        token 為控制通道的驗證碼，attach_tokens 由主機在控制連線建立時轉交給 Game Server
+        """
+        reply = self.call(agent, {
+            "type": "START",
+            "room_id": room_id,
+            "game_id": game_id,
+            "version_dir": version_dir,
+            "server_command": server_cmd,
+            "lobby_token": token,
+            "attach_tokens": attach_tokens or {},
+            "expires_in": self.call_timeout  # 主機超過這麼久仍未開始啟動就放棄
+        })
+        if reply is None:
+            # 大廳不再等待，回覆較晚送達時主機上的 Game Server 也要停止
+            self.send(agent, {"type": "STOP", "room_id": room_id})
+            return None, "遊戲主機沒有回應"
+        if not reply.get("success"):
+            return None, reply.get("message", "遊戲主機啟動失敗")
+        
+        with self.lock:
+            agent.versions.add(f"{game_id}/{version_dir}")
+        return reply["port"], None
+    
+    def stop(self, room_id):
+        """請主機停止房間的 Game Server (不在任何主機上時回傳 False)"""
+        agent = self.agent_of(room_id)
+        if agent is None:
+            return False
+        self.send(agent, {"type": "STOP", "room_id": room_id})
+        return True
+    
+    def metrics(self):
+        """各主機的負載"""
+        now = time.monotonic()
+        with self.lock:
+            return {
+                "agents": {
+                    agent.agent_id: {
+                        "host": agent.host,
+                        "rooms": len(agent.rooms),
+                        "capacity": agent.capacity,
+                        "free_ports": agent.free_ports,
+                        "versions": len(agent.versions),
+                        "load": agent.load,
+                        "usage": agent.usage,
+                        "last_seen": round(now - agent.last_seen, 1)
+                    }
+                    for agent in self.agents.values()
+                },
+                "placed": self.placed,
+                "rejected": self.rejected
+            }
@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Game Store System - 遊戲主機 (Game Host Agent)
+在其他機器 (或同一台機器) 上執行，向大廳註冊後接受大廳配置的 Game Server
+- 啟動時從大廳下載尚未有的遊戲版本，大廳已刪除的版本 (PRUNE) 在沒有 Game Server 使用後刪除
+- 使用自己的 Port 範圍與 GameSupervisor 啟動、監管 Game Server
+- Game Server 的 --lobby-port 指向本機的轉送 Port，Game Server 的控制連線 (心跳、統計、結果)
+  在這裡以大廳發的 token 驗證後，經由主機的控制連線轉給大廳
+
+用法: python game_agent.py --agent-id node1 --host 127.0.0.1 --ports 13000-13100 --capacity 20
+"""
+
+import os
+import hmac
+import time
+import shutil
+import socket
+import zipfile
+import argparse
+import tempfile
+import threading
+
+from utils import send_json, recv_json, recv_file_with_metadata, create_response
+from port_allocator import PortAllocator, parse_port_ranges
+from game_supervisor import GameSupervisor, ResourceLimits
+
+HEARTBEAT_SECONDS = 5
+RECONNECT_SECONDS = 3
+START_MARGIN_SECONDS = 5   # 距離大廳放棄等待不到這麼久時不再啟動 (避免啟動後才收到 STOP)
+CANCEL_TTL_SECONDS = 600   # 已取消但一直沒有收到 START 的房間保留多久
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'agent_data')
+
+class HostAgent:
+    """遊戲主機：維持與大廳的控制連線並執行大廳下達的指令"""
+    
+    def __init__(self, args):
+        self.args = args
+        self.agent_id = args.agent_id
+        self.bind_host = args.bind_host or args.host
+        
+        data_dir = os.path.join(args.data_dir, self.agent_id)
+        self.games_dir = os.path.join(data_dir, 'games')
+        os.makedirs(self.games_dir, exist_ok=True)
+        
+        # 資源限制與大廳相同，由 GAME_CPU_SECONDS 等環境變數設定
+        self.supervisor = GameSupervisor(os.path.join(data_dir, 'logs'), limits=ResourceLimits.from_env())
+        self.ports = PortAllocator(parse_port_ranges(args.ports), probe_host=self.bind_host)
+        
+        self.lock = threading.Lock()
+        self.room_ports = {}     # room_id -> port
+        self.room_tokens = {}    # room_id -> 大廳發給房間的控制通道 token
+        self.attach_tokens = {}  # room_id -> {username: ATTACH token}，控制連線建立時交給 Game Server
+        self.room_versions = {}  # room_id -> "game_id/version_dir" (清理舊版本時略過)
+        self.cancelled = {}      # room_id -> 收到 STOP 的時間 (monotonic)，START 尚未完成時用來放棄啟動
+        self.fetch_locks = {}    # "game_id/version_dir" -> lock，同一版本只下載一次
+        
+        self.sock = None
+        self.send_lock = threading.Lock()
+        self.relay_socket = None
+        self.relay_port = None
+    
+    # ---------- 與大廳的連線 ----------
+    
+    def run(self):
+        """主迴圈：連線、註冊、處理指令，斷線後停止所有 Game Server 並重新連線"""
+        self.start_relay()
+        print(f"[Agent] {self.agent_id} relay listening on {self.bind_host}:{self.relay_port}")
+        
+        while True:
+            sock = self.register()
+            if sock:
+                self.sock = sock
+                try:
+                    self.serve(sock)
+                finally:
+                    self.sock = None
+                    sock.close()
+                    print("[Agent] Disconnected from lobby, stopping game servers")
+                    self.supervisor.stop_all()
+            time.sleep(RECONNECT_SECONDS)
+    
+    def register(self):
+        """連線到大廳並註冊，失敗時回傳 None"""
+        try:
+            sock = socket.create_connection((self.args.lobby_host, self.args.lobby_port), timeout=10)
+            sock.settimeout(None)
+        except OSError as e:
+            print(f"[Agent] Cannot connect to lobby: {e}")
+            return None
+        
+        send_json(sock, {
+            "action": "AGENT_REGISTER",
+            "client_type": "agent",
+            "agent_id": self.agent_id,
+            "secret": self.args.secret,
+            "host": self.args.host,
+            "capacity": self.args.capacity,
+            "free_ports": self.ports.metrics()["free"],
+            "versions": self.versions()
+        })
+        response = recv_json(sock)
+        if not response or not response.get("success"):
+            print(f"[Agent] Register failed: {response.get('message') if response else 'no response'}")
+            sock.close()
+            return None
+        
+        print(f"[Agent] Registered with lobby {self.args.lobby_host}:{self.args.lobby_port} as {self.agent_id}")
+        return sock
+    
+    def serve(self, sock):
+        """處理大廳的指令直到斷線"""
+        stop = threading.Event()
+        threading.Thread(target=self.heartbeat, args=(stop,), daemon=True).start()
+        
+        try:
+            while True:
+                message = recv_json(sock)
+                if message is None:
+                    return
+                
+                kind = message.get("type")
+                if kind == "START":
+                    # 可能需要下載遊戲，不阻塞控制連線
+                    threading.Thread(target=self.handle_start, args=(message,), daemon=True).start()
+                elif kind == "STOP":
+                    self.handle_stop(message.get("room_id"))
+                elif kind == "PRUNE":
+                    # 大廳已不再使用的版本，刪除可能較久，不阻塞控制連線
+                    threading.Thread(target=self.prune_versions, args=(message.get("versions") or [],),
+                                     daemon=True).start()
+        finally:
+            stop.set()
+    
+    def heartbeat(self, stop):
+        """定期回報狀態"""
+        while not stop.wait(HEARTBEAT_SECONDS):
+            self.expire_cancelled()
+            if not self.send(self.status()):
+                return
+    
+    def send(self, message):
+        sock = self.sock
+        if sock is None:
+            return False
+        with self.send_lock:
+            return send_json(sock, message)
+    
+    def status(self):
+        try:
+            load = round(os.getloadavg()[0], 2)
+        except (AttributeError, OSError):
+            load = None
+        return {
+            "type": "STATUS",
+            "running": self.supervisor.metrics()["running"],
+            "free_ports": self.ports.metrics()["free"],
+            "versions": self.versions(),
+            "load": load,
+            "usage": self.supervisor.resource_usage()["games"]
+        }
+    
+    # ---------- 啟動 Game Server ----------
+    
+    def handle_start(self, message):
+        room_id = message.get("room_id")
+        reply = {"type": "REPLY", "request_id": message.get("request_id")}
+        # 大廳只等待 expires_in 秒，之後才開始啟動的 Game Server 沒有人使用
+        deadline = time.monotonic() + message.get("expires_in", 30) - START_MARGIN_SECONDS
+        
+        try:
+            game_dir = self.ensure_version(message["game_id"], message["version_dir"])
+        except Exception as e:
+            self.send({**reply, "success": False, "message": f"下載遊戲失敗: {e}"})
+            return
+        
+        with self.lock:
+            cancelled = self.cancelled.pop(room_id, None) is not None
+        if cancelled or time.monotonic() > deadline:
+            print(f"[Agent] Start for room {room_id} abandoned ({'cancelled' if cancelled else 'expired'})")
+            self.send({**reply, "success": False, "message": "啟動已逾時或已取消"})
+            return
+        
+        port = self.ports.allocate()
+        if not port:
+            self.send({**reply, "success": False, "message": "遊戲主機沒有可用的 Port"})
+            return
+        
+        token = message.get("lobby_token")
+        cmd = list(message["server_command"]) + [
+            "--port", str(port),
+            "--host", self.bind_host,
+            "--lobby-port", str(self.relay_port),
+            "--room-id", room_id
+        ]
+        if token:
+            cmd += ["--lobby-token", token]
+        
+        try:
+            with self.lock:
+                self.room_ports[room_id] = port
+                self.room_tokens[room_id] = token
+                self.attach_tokens[room_id] = message.get("attach_tokens") or {}
+                self.room_versions[room_id] = f"{message['game_id']}/{message['version_dir']}"
+            self.supervisor.spawn(room_id, cmd, game_dir, on_exit=self.on_game_exit, group=message["game_id"])
+        except Exception as e:
+            with self.lock:
+                self.room_ports.pop(room_id, None)
+                self.room_tokens.pop(room_id, None)
+                self.attach_tokens.pop(room_id, None)
+                self.room_versions.pop(room_id, None)
+            self.ports.release(port)
+            self.send({**reply, "success": False, "message": f"啟動遊戲伺服器失敗: {e}"})
+            return
+        
+        print(f"[Agent] Game server started on port {port} for room {room_id}")
+        self.send({**reply, "success": True, "port": port})
+    
+    def handle_stop(self, room_id):
+        """停止房間的 Game Server；還在下載或啟動中時記下，由 handle_start 放棄啟動"""
+        with self.lock:
+            if room_id not in self.room_ports:
+                self.cancelled[room_id] = time.monotonic()
+                return
+        self.supervisor.stop(room_id, timeout=5)
+    
+    def expire_cancelled(self):
+        """移除一直沒有對應 START 的取消紀錄"""
+        now = time.monotonic()
+        with self.lock:
+            for room_id in [r for r, since in self.cancelled.items() if now - since > CANCEL_TTL_SECONDS]:
+                del self.cancelled[room_id]
+    
+    def on_game_exit(self, room_id, returncode, expected, stderr_tail):
+        """Game Server 結束：歸還 Port 並通知大廳"""
+        with self.lock:
+            port = self.room_ports.pop(room_id, None)
+            self.room_tokens.pop(room_id, None)
+            self.attach_tokens.pop(room_id, None)
+            self.room_versions.pop(room_id, None)
+        if port:
+            self.ports.release(port)
+        self.send({
+            "type": "GAME_EXIT",
+            "room_id": room_id,
+            "returncode": returncode,
+            "expected": expected,
+            "stderr_tail": stderr_tail
+        })
+    
+    # ---------- 遊戲檔案 ----------
+    
+    def versions(self):
+        """本機已有的遊戲版本"""
+        result = []
+        for game_id in os.listdir(self.games_dir):
+            game_path = os.path.join(self.games_dir, game_id)
+            if os.path.isdir(game_path):
+                result.extend(f"{game_id}/{entry}" for entry in os.listdir(game_path) if not entry.startswith('.'))
+        return result
+    
+    def ensure_version(self, game_id, version_dir):
+        """回傳遊戲版本目錄，本機沒有時向大廳下載"""
+        game_dir = os.path.join(self.games_dir, game_id, version_dir)
+        key = f"{game_id}/{version_dir}"
+        
+        with self.lock:
+            lock = self.fetch_locks.setdefault(key, threading.Lock())
+        
+        with lock:
+            if not os.path.isdir(game_dir):
+                self.fetch_version(game_id, version_dir, game_dir)
+        return game_dir
+    
+    def prune_versions(self, versions):
+        """刪除大廳已不再使用的遊戲版本 (仍有 Game Server 使用中的版本保留)"""
+        for key in versions:
+            game_id, sep, version_dir = str(key).partition('/')
+            if not sep or not game_id or version_dir in ('', '.', '..') or '/' in version_dir or game_id.startswith('.'):
+                continue
+            
+            with self.lock:
+                if key in self.room_versions.values():
+                    continue
+                lock = self.fetch_locks.setdefault(key, threading.Lock())
+            
+            game_dir = os.path.join(self.games_dir, game_id, version_dir)
+            with lock:
+                if not os.path.isdir(game_dir):
+                    continue
+                shutil.rmtree(game_dir, ignore_errors=True)
+            print(f"[Agent] Removed unused version {key}")
+    
+    def fetch_version(self, game_id, version_dir, game_dir):
+        """以另一條連線向大廳下載遊戲版本，解壓縮後再原子地放到定位"""
+        print(f"[Agent] Fetching {game_id}/{version_dir} from lobby")
+        recv_dir = tempfile.mkdtemp(prefix='agent-fetch-')
+        staging = os.path.join(os.path.dirname(game_dir), f".{version_dir}.{os.getpid()}")
+        
+        try:
+            with socket.create_connection((self.args.lobby_host, self.args.lobby_port), timeout=30) as sock:
+                send_json(sock, {
+                    "action": "AGENT_FETCH_GAME",
+                    "client_type": "agent",
+                    "agent_id": self.agent_id,
+                    "secret": self.args.secret,
+                    "game_id": game_id,
+                    "version_dir": version_dir
+                })
+                response = recv_json(sock)
+                if not response or not response.get("success"):
+                    raise RuntimeError(response.get("message") if response else "大廳沒有回應")
+                
+                send_json(sock, {"status": "READY"})
+                metadata = recv_json(sock)
+                if not metadata or metadata.get("type") != "FILE_TRANSFER":
+                    raise RuntimeError("未收到檔案")
+                
+                success, msg, zip_path = recv_file_with_metadata(sock, metadata, recv_dir)
+                if not success:
+                    raise RuntimeError(msg)
+            
+            shutil.rmtree(staging, ignore_errors=True)
+            with zipfile.ZipFile(zip_path, 'r') as zipf:
+                zipf.extractall(staging)
+            os.replace(staging, game_dir)
+        finally:
+            shutil.rmtree(recv_dir, ignore_errors=True)
+            shutil.rmtree(staging, ignore_errors=True)
+    
+    # ---------- 控制通道轉送 ----------
+    
+    def start_relay(self):
+        """本機的轉送 Port：Game Server 的控制連線接到這裡，再經由主機的控制連線轉給大廳"""
+        self.relay_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.relay_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.relay_socket.bind((self.bind_host, self.args.relay_port))
+        self.relay_socket.listen(16)
+        self.relay_port = self.relay_socket.getsockname()[1]
+        threading.Thread(target=self.run_relay, daemon=True).start()
+    
+    def run_relay(self):
+        while True:
+            try:
+                conn, _ = self.relay_socket.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.relay_connection, args=(conn,), daemon=True).start()
+    
+    def verify_token(self, room_id, token):
+        with self.lock:
+            expected = self.room_tokens.get(room_id)
+        return bool(expected) and isinstance(token, str) and hmac.compare_digest(expected, token)
+    
+    def forward(self, room_id, message):
+        """把 Game Server 的控制訊息轉給大廳"""
+        if message.get("type") == "RESULT":
+            # 之後 Game Server 結束屬於正常結束
+            self.supervisor.finish(room_id)
+        self.send({"type": "GAME_CONTROL", "room_id": room_id, "message": message})
+    
+    def relay_connection(self, conn):
+        with conn:
+            request = recv_json(conn)
+            if not request:
+                return
+            
+            room_id = request.get("room_id")
+            if not self.verify_token(room_id, request.get("token")):
+                send_json(conn, create_response(False, "驗證失敗"))
+                return
+            
+            action = request.get("action")
+            if action == "REPORT_GAME_RESULT":
+                # 單次回報
+                self.forward(room_id, {"type": "RESULT", "result": request.get("result")})
+                send_json(conn, create_response(True, "結果已轉送"))
+                return
+            if action != "GAME_CONTROL":
+                send_json(conn, create_response(False, "未知的操作"))
+                return
+            
+            with self.lock:
+                attach_tokens = self.attach_tokens.get(room_id, {})
+            send_json(conn, create_response(True, "控制連線已建立", {"attach_tokens": attach_tokens}))
+            self.forward(room_id, {"type": "CONNECTED"})
+            try:
+                while True:
+                    message = recv_json(conn)
+                    if message is None:
+                        break
+                    self.forward(room_id, message)
+                    if message.get("type") == "RESULT":
+                        send_json(conn, create_response(True, "結果已轉送"))
+            finally:
+                self.forward(room_id, {"type": "DISCONNECTED"})
+
+def main():
+    parser = argparse.ArgumentParser(description='Game Store 遊戲主機')
+    parser.add_argument('--lobby-host', type=str, default='127.0.0.1', help='大廳位址')
+    parser.add_argument('--lobby-port', type=int, default=16969, help='大廳 Port')
+    parser.add_argument('--agent-id', type=str, default=f"{socket.gethostname()}-{os.getpid()}", help='遊戲主機 ID')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Client 連線 Game Server 使用的位址')
+    parser.add_argument('--bind-host', type=str, help='Game Server 監聽的位址 (預設同 --host)')
+    parser.add_argument('--ports', type=str, default='13000-13100', help='Game Server 使用的 Port 範圍')
+    parser.add_argument('--capacity', type=int, default=20, help='最多同時執行的 Game Server 數量')
+    parser.add_argument('--relay-port', type=int, default=0, help='結果轉送 Port (0 表示自動選擇)')
+    parser.add_argument('--data-dir', type=str, default=DATA_DIR, help='遊戲檔案與 log 的存放位置')
+    parser.add_argument('--secret', type=str, default=os.environ.get("GAME_AGENT_SECRET", ""),
+                        help='與大廳的 GAME_AGENT_SECRET 相同')
+    args = parser.parse_args()
+    
+    agent = HostAgent(args)
+    try:
+        agent.run()
+    except KeyboardInterrupt:
+        print("\n[Agent] Shutting down")
+    finally:
+        agent.supervisor.stop_all()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Game Store System - Game Server 預熱啟動器
+由大廳預先啟動，先載入並編譯 Game Server 程式、import 它用到的模組，
+等到從 stdin (控制通道) 收到房間設定後才真正執行
+
+用法: python game_bootstrap.py <server_script>
+控制通道: 一行 JSON {"args": ["--port", "12000", ...]}；stdin 關閉表示不再需要，直接結束
+"""
+
+import os
+import sys
+import ast
+import json
+import importlib
+
+def preload(script_path):
+    """編譯 Game Server 程式並預先 import 最上層用到的模組，回傳 code object"""
+    with open(script_path, 'rb') as f:
+        source = f.read()
+    
+    code = compile(source, script_path, 'exec')
+    
+    for node in ast.parse(source).body:
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names = [node.module]
+        else:
+            continue
+        for name in names:
+            try:
+                importlib.import_module(name)
+            except Exception:
+                # 載入失敗就留給 Game Server 自己處理
+                pass
+    
+    return code
+
+def main():
+    if len(sys.argv) < 2:
+        print("用法: python game_bootstrap.py <server_script>", file=sys.stderr)
+        sys.exit(2)
+    
+    script_path = os.path.abspath(sys.argv[1])
+    
+    # 模組搜尋路徑改為 Game Server 所在目錄 (與直接執行腳本相同)
+    sys.path[0] = os.path.dirname(script_path)
+    
+    code = preload(script_path)
+    
+    line = sys.stdin.readline()
+    if not line.strip():
+        return
+    
+    assignment = json.loads(line)
+    sys.argv = [script_path] + [str(arg) for arg in assignment.get("args", [])]
+    sys.stdin.close()
+    sys.stdin = open(os.devnull, 'r')
+    
+    exec(code, {"__name__": "__main__", "__file__": script_path, "__builtins__": __builtins__})
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Game Store System - Game Server 控制通道
+大廳啟動 Game Server 時發給每個房間一組 token (--lobby-token)，
+Game Server 以 token 建立一條持續的控制連線，回報心跳、在線人數、對戰統計與結果
+建立連線時大廳會一併給出每位玩家的 ATTACH token，Game Server 以此確認 Client 自稱的帳號
+"""
+
+import time
+import hmac
+import secrets
+import threading
+
+# 控制連線接受的訊息類型
+CONTROL_MESSAGE_TYPES = ("HEARTBEAT", "STATS", "RESULT")
+
+class GameChannel:
+    """單一房間的控制通道狀態"""
+    __slots__ = ("room_id", "token", "attach_tokens", "issued_at", "connected", "last_heartbeat",
+                 "heartbeats", "players", "state", "stats")
+    
+    def __init__(self, room_id, token, attach_tokens=None):
+        self.room_id = room_id
+        self.token = token
+        self.attach_tokens = attach_tokens or {}  # username -> 玩家 ATTACH 時需附上的 token
+        self.issued_at = time.time()
+        self.connected = False
+        self.last_heartbeat = None   # monotonic，None 表示尚未收到心跳
+        self.heartbeats = 0
+        self.players = None          # Game Server 回報的在線人數
+        self.state = None            # Game Server 自訂的進度描述 (例如 "round 2")
+        self.stats = {}              # 對戰統計，RESULT 時附在結果中
+    
+    def progress(self):
+        return {
+            "connected": self.connected,
+            "players": self.players,
+            "state": self.state,
+            "stats": dict(self.stats),
+            "last_heartbeat": round(time.monotonic() - self.last_heartbeat, 1) if self.last_heartbeat else None
+        }
+
+class GameChannels:
+    """
+    所有房間的控制通道
+    - issue() 在啟動 Game Server 前產生 token，revoke() 在遊戲結束或房間重置時作廢
+    - Game Server 斷線後可用同一組 token 重新連線
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.channels = {}  # room_id -> GameChannel
+        
+        # 統計
+        self.connections = 0
+        self.rejected = 0
+        self.messages = 0
+        self.results = 0
+    
+    def issue(self, room_id, players=()):
+        """產生房間的 token 與每位玩家的 ATTACH token (取代先前的 token)，回傳 GameChannel"""
+        channel = GameChannel(room_id, secrets.token_urlsafe(24),
+                              {player: secrets.token_urlsafe(16) for player in players})
+        with self.lock:
+            self.channels[room_id] = channel
+        return channel
+    
+    def revoke(self, room_id):
+        with self.lock:
+            self.channels.pop(room_id, None)
+    
+    def get(self, room_id):
+        with self.lock:
+            return self.channels.get(room_id)
+    
+    def verify(self, room_id, token):
+        """檢查 token，成功時回傳 GameChannel"""
+        with self.lock:
+            channel = self.channels.get(room_id)
+        if channel is None or not isinstance(token, str) or not hmac.compare_digest(channel.token, token):
+            with self.lock:
+                self.rejected += 1
+            return None
+        return channel
+    
+    def connect(self, channel):
+        with self.lock:
+            channel.connected = True
+            channel.last_heartbeat = time.monotonic()
+            self.connections += 1
+    
+    def disconnect(self, channel):
+        with self.lock:
+            channel.connected = False
+    
+    def update(self, room_id, message):
+        """
+        套用 HEARTBEAT / STATS 訊息，RESULT 時回傳附上統計的結果 (其他情況回傳 None)
+        房間已沒有通道 (token 已作廢) 時回傳 False
+        """
+        kind = message.get("type")
+        with self.lock:
+            channel = self.channels.get(room_id)
+            if channel is None:
+                return False
+            self.messages += 1
+            channel.last_heartbeat = time.monotonic()
+            
+            if kind == "HEARTBEAT":
+                channel.heartbeats += 1
+                if isinstance(message.get("players"), int):
+                    channel.players = message["players"]
+                if message.get("state") is not None:
+                    channel.state = str(message["state"])[:200]
+            elif kind == "STATS" and isinstance(message.get("stats"), dict):
+                channel.stats.update(message["stats"])
+            elif kind == "RESULT":
+                self.results += 1
+                result = message.get("result")
+                result = dict(result) if isinstance(result, dict) else {"result": result}
+                if isinstance(message.get("stats"), dict):
+                    channel.stats.update(message["stats"])
+                if channel.stats:
+                    result.setdefault("stats", dict(channel.stats))
+                return result
+        return None
+    
+    def progress(self, room_id):
+        """房間的即時進度，沒有控制通道時回傳 None"""
+        with self.lock:
+            channel = self.channels.get(room_id)
+            return channel.progress() if channel else None
+    
+    def silent(self, timeout):
+        """曾建立控制連線、但超過 timeout 秒沒有任何訊息的房間"""
+        deadline = time.monotonic() - timeout
+        with self.lock:
+            return [
+                room_id for room_id, channel in self.channels.items()
+                if channel.last_heartbeat is not None and channel.last_heartbeat < deadline
+            ]
+    
+    def metrics(self):
+        with self.lock:
+            return {
+                "issued": len(self.channels),
+                "connected": sum(1 for channel in self.channels.values() if channel.connected),
+                "connections": self.connections,
+                "rejected": self.rejected,
+                "messages": self.messages,
+                "results": self.results
+            }
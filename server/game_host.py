@@ -0,0 +1,491 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Game Store System - 大廳內託管的遊戲房間
+信任的遊戲不必每個房間啟動一個 Game Server process 並佔用一個 Port，
+改由大廳在同一個 process 內執行，所有房間共用一個 Port，連線依 room_id 分派
+
+託管遊戲的介面 (config.json: "hosting": "in_process", "hosted_class": "<類別名稱>")
+    class MyGame:
+        def __init__(self, room): ...           # room: HostedRoom
+        def on_join(self, player): ...          # player: HostedPlayer (player.name 為玩家帳號)
+        def on_message(self, player, message): ...
+        def on_leave(self, player): ...
+
+所有回呼都在同一個執行緒中依序執行，遊戲本身不需要 lock，但也不可以阻塞
+(要延遲執行請用 room.call_later)。遊戲結束時呼叫 room.report(result) 回報結果，
+再呼叫 room.finish() 結束房間
+
+Client 連上共用 Port 後先送出 {"action": "ATTACH", "room_id": ..., "username": ..., "token": ...}，
+token 為開房時發給每位玩家的 attach token (大廳在 GAME_STARTED 中個別送給玩家)，
+之後的封包格式與獨立的 Game Server 相同 (4 bytes 長度 + JSON)
+"""
+
+import hmac
+import json
+import time
+import heapq
+import socket
+import secrets
+import itertools
+import selectors
+import threading
+import traceback
+from collections import deque
+
+READ_SIZE = 64 * 1024
+MAX_MESSAGE_SIZE = 1024 * 1024       # 單一封包上限
+MAX_PENDING_OUTPUT = 1024 * 1024     # 送不出去的資料超過此大小就斷線
+ATTACH_TIMEOUT = 10                  # 連線後多久內必須送出 ATTACH
+JOIN_TIMEOUT = 60                    # 房間開啟後多久沒有玩家連上就結束
+FINISH_GRACE = 3                     # finish() 後等待最後的訊息送出的時間
+
+class HostedPlayer:
+    """託管房間中的一條玩家連線"""
+    __slots__ = ("host", "sock", "address", "name", "room", "inbox", "outbox", "closing", "closed")
+    
+    def __init__(self, host, sock, address):
+        self.host = host
+        self.sock = sock
+        self.address = address
+        self.name = None
+        self.room = None
+        self.inbox = bytearray()
+        self.outbox = bytearray()
+        self.closing = False   # 送完 outbox 後關閉
+        self.closed = False
+    
+    def send(self, message):
+        """送出一個封包 (只寫入緩衝區，由事件迴圈送出)"""
+        if self.closed or self.closing:
+            return False
+        data = json.dumps(message, ensure_ascii=False).encode('utf-8')
+        self.outbox += len(data).to_bytes(4, 'big') + data
+        self.host.dirty.add(self)
+        return True
+    
+    def close(self):
+        """送完已排入的訊息後關閉連線"""
+        self.closing = True
+        self.host.dirty.add(self)
+
+class HostedRoom:
+    """提供給託管遊戲使用的房間介面"""
+    
+    def __init__(self, host, room_id, players, on_exit):
+        self.host = host
+        self.room_id = room_id
+        self.players = list(players)   # 房間成員帳號
+        self.tokens = {player: secrets.token_urlsafe(16) for player in self.players}  # username -> attach token
+        self.on_exit = on_exit
+        self.connections = {}          # username -> HostedPlayer
+        self.game = None
+        self.started_at = time.time()
+        self.reported = False
+        self.finished = False
+        self.error = None
+    
+    def broadcast(self, message, exclude=None):
+        """送給房間內所有連線中的玩家"""
+        for player in list(self.connections.values()):
+            if player is not exclude:
+                player.send(message)
+    
+    def call_later(self, delay, callback, *args):
+        """delay 秒後在事件迴圈中執行 callback"""
+        self.host.schedule(delay, self, callback, args)
+    
+    def report(self, result):
+        """回報遊戲結果給大廳"""
+        if self.reported:
+            return
+        self.reported = True
+        self.host.report(self, result)
+    
+    def finish(self):
+        """遊戲結束：送完剩下的訊息後關閉所有連線並移除房間"""
+        if self.finished:
+            return
+        self.finished = True
+        for player in list(self.connections.values()):
+            player.close()
+        self.host.schedule(FINISH_GRACE, self, self.host.close_room_now, (self.room_id,))
+
+class GameHost:
+    """
+    託管遊戲的事件迴圈
+    - 單一執行緒以 selector 處理共用 Port 上的所有連線與計時器
+    - 遊戲回呼拋出例外時視為 Game Server 異常結束
+    - 處理單一連線或指令時發生其他例外，只關閉該連線 (或該房間)，事件迴圈繼續執行
+    - 房間結束時呼叫 on_exit(room_id, returncode, expected, error)，與 GameSupervisor 相同
+    """
+    
+    def __init__(self, host, port):
+        self.host_address = host
+        self.port = port
+        self.on_result = None
+        
+        self.lock = threading.Lock()
+        self.rooms = {}                # room_id -> HostedRoom (只在事件迴圈中修改)
+        self.commands = deque()        # 其他執行緒送來的 (callable, args)
+        self.timers = []               # [(when, seq, room, callback, args)]
+        self.counter = itertools.count()
+        self.dirty = set()             # 有待送出資料或待關閉的連線 (只在事件迴圈中使用)
+        self.selector = None
+        self.server_socket = None
+        self.wakeup_r = None
+        self.wakeup_w = None
+        self.thread = None
+        
+        # 統計
+        self.opened = 0
+        self.finished = 0
+        self.crashed = 0
+        self.connections = 0
+    
+    # ---------- 對外操作 (任何執行緒) ----------
+    
+    def start(self, on_result):
+        """
+        開始監聽共用 Port 並啟動事件迴圈 (已啟動時不做任何事，Port 無法使用時拋出 OSError)
+        on_result(room_id, result): 遊戲回報結果，在背景執行緒呼叫
+        """
+        if self.started:
+            return
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server_socket.bind((self.host_address, self.port))
+            server_socket.listen(128)
+            server_socket.setblocking(False)
+        except OSError:
+            server_socket.close()
+            raise
+        self.on_result = on_result
+        self.server_socket = server_socket
+        
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, "wakeup")
+        self.selector.register(self.server_socket, selectors.EVENT_READ, "accept")
+        
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    
+    @property
+    def started(self):
+        return self.thread is not None
+    
+    def open_room(self, room_id, game_class, players, on_exit=None):
+        """
+        開啟託管房間 (實際建立在事件迴圈中進行，建構失敗時透過 on_exit 通知)
+        回傳的 HostedRoom.tokens 為每位玩家 ATTACH 時需附上的 token
+        """
+        room = HostedRoom(self, room_id, players, on_exit)
+        with self.lock:
+            self.opened += 1
+        self.post(self.start_room, room, game_class)
+        return room
+    
+    def close_room(self, room_id):
+        """大廳主動結束房間"""
+        self.post(self.close_room_now, room_id, True)
+    
+    def running(self, room_id):
+        with self.lock:
+            return room_id in self.rooms
+    
+    def metrics(self):
+        with self.lock:
+            return {
+                "port": self.port,
+                "rooms": len(self.rooms),
+                "players": sum(len(room.connections) for room in self.rooms.values()),
+                "opened": self.opened,
+                "finished": self.finished,
+                "crashed": self.crashed,
+                "connections": self.connections
+            }
+    
+    def post(self, func, *args):
+        """把操作交給事件迴圈執行"""
+        with self.lock:
+            self.commands.append((func, args))
+        try:
+            self.wakeup_w.send(b'\0')
+        except (OSError, AttributeError):
+            pass
+    
+    # ---------- 房間 (事件迴圈) ----------
+    
+    def schedule(self, delay, room, callback, args):
+        with self.lock:
+            heapq.heappush(self.timers, (time.monotonic() + delay, next(self.counter), room, callback, args))
+    
+    def report(self, room, result):
+        """在背景執行緒回報結果，避免大廳的處理阻塞事件迴圈"""
+        threading.Thread(target=self.on_result, args=(room.room_id, result), daemon=True).start()
+    
+    def start_room(self, room, game_class):
+        with self.lock:
+            self.rooms[room.room_id] = room
+        try:
+            room.game = game_class(room)
+        except Exception:
+            self.fail(room)
+            return
+        self.schedule(JOIN_TIMEOUT, room, self.check_joined, (room,))
+    
+    def check_joined(self, room):
+        """房間開啟後一直沒有玩家連上，結束房間"""
+        if not room.connections and not room.finished:
+            room.finish()
+    
+    def invoke(self, room, callback, *args):
+        """執行遊戲回呼，例外時結束房間並視為異常結束"""
+        if room.error:
+            return
+        try:
+            callback(*args)
+        except Exception:
+            self.fail(room)
+    
+    def fail(self, room):
+        """遊戲拋出例外 (需在 except 區塊中呼叫)"""
+        room.error = traceback.format_exc()
+        print(f"[Host] Game error in room {room.room_id}:\n{room.error}")
+        self.close_room_now(room.room_id)
+    
+    def close_room_now(self, room_id, stopped=False):
+        """關閉房間的所有連線並通知大廳"""
+        with self.lock:
+            room = self.rooms.pop(room_id, None)
+            if room is None:
+                return
+            if room.error:
+                self.crashed += 1
+            else:
+                self.finished += 1
+        
+        for player in list(room.connections.values()):
+            self.disconnect(player, notify=False)
+        
+        if room.on_exit:
+            expected = stopped or room.reported
+            returncode = 1 if room.error else 0
+            try:
+                room.on_exit(room_id, returncode, expected, room.error or "")
+            except Exception as e:
+                print(f"[Host] Exit handler failed for room {room_id}: {e}")
+    
+    # ---------- 連線 (事件迴圈) ----------
+    
+    def accept(self):
+        try:
+            sock, address = self.server_socket.accept()
+        except (BlockingIOError, OSError):
+            return
+        sock.setblocking(False)
+        player = HostedPlayer(self, sock, address)
+        self.selector.register(sock, selectors.EVENT_READ, player)
+        with self.lock:
+            self.connections += 1
+        self.schedule(ATTACH_TIMEOUT, None, self.check_attached, (player,))
+    
+    def check_attached(self, player):
+        if player.room is None and not player.closed:
+            self.disconnect(player)
+    
+    def attach(self, player, message):
+        """處理連線的第一個封包，把連線分派到房間"""
+        room_id = message.get("room_id")
+        username = message.get("username")
+        token = message.get("token")
+        with self.lock:
+            room = self.rooms.get(room_id) if isinstance(room_id, str) else None
+        
+        if message.get("action") != "ATTACH" or room is None or room.finished:
+            player.send({"type": "ERROR", "message": "房間不存在或遊戲已結束"})
+            player.close()
+            return
+        expected = room.tokens.get(username) if isinstance(username, str) else None
+        if expected is None or not isinstance(token, str) or not hmac.compare_digest(token, expected):
+            player.send({"type": "ERROR", "message": "您不在此房間中或驗證失敗"})
+            player.close()
+            return
+        if username in room.connections:
+            player.send({"type": "ERROR", "message": "已經有相同帳號的連線"})
+            player.close()
+            return
+        
+        player.name = username
+        player.room = room
+        room.connections[username] = player
+        self.invoke(room, room.game.on_join, player)
+    
+    def receive(self, player):
+        try:
+            data = player.sock.recv(READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.disconnect(player)
+            return
+        
+        player.inbox += data
+        while len(player.inbox) >= 4 and not player.closed:
+            length = int.from_bytes(player.inbox[:4], 'big')
+            if length > MAX_MESSAGE_SIZE:
+                self.disconnect(player)
+                return
+            if len(player.inbox) < 4 + length:
+                break
+            body = bytes(player.inbox[4:4 + length])
+            del player.inbox[:4 + length]
+            
+            try:
+                message = json.loads(body.decode('utf-8'))
+            except (UnicodeDecodeError, json.JSONDecodeError):
+                self.disconnect(player)
+                return
+            if not isinstance(message, dict) or player.closing:
+                continue
+            
+            if player.room is None:
+                self.attach(player, message)
+            else:
+                self.invoke(player.room, player.room.game.on_message, player, message)
+    
+    def flush(self, player):
+        """盡量送出 outbox，送不完時等待可寫入事件"""
+        if player.closed:
+            return
+        if player.outbox:
+            try:
+                sent = player.sock.send(player.outbox)
+                del player.outbox[:sent]
+            except BlockingIOError:
+                pass
+            except OSError:
+                self.disconnect(player)
+                return
+        
+        if not player.outbox and player.closing:
+            self.disconnect(player)
+        elif len(player.outbox) > MAX_PENDING_OUTPUT:
+            self.disconnect(player)
+        else:
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if player.outbox else 0)
+            self.selector.modify(player.sock, events, player)
+    
+    def disconnect(self, player, notify=True):
+        if player.closed:
+            return
+        player.closed = True
+        self.dirty.discard(player)
+        try:
+            self.selector.unregister(player.sock)
+        except (KeyError, ValueError):
+            pass
+        try:
+            player.sock.close()
+        except OSError:
+            pass
+        
+        room = player.room
+        if room and room.connections.get(player.name) is player:
+            del room.connections[player.name]
+            if notify and room.room_id in self.rooms:
+                self.invoke(room, room.game.on_leave, player)
+    
+    # ---------- 主迴圈 ----------
+    
+    def run_timers(self):
+        """執行到期的計時器，回傳下一個計時器的等待秒數"""
+        while True:
+            with self.lock:
+                if not self.timers:
+                    return None
+                when = self.timers[0][0]
+                delay = when - time.monotonic()
+                if delay > 0:
+                    return delay
+                _, _, room, callback, args = heapq.heappop(self.timers)
+            
+            if room is None:
+                try:
+                    callback(*args)
+                except Exception:
+                    print(f"[Host] Timer error:\n{traceback.format_exc()}")
+            elif room.room_id in self.rooms and self.rooms[room.room_id] is room:
+                self.invoke(room, callback, *args)
+    
+    def run_commands(self):
+        try:
+            while self.wakeup_r.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+        
+        while True:
+            with self.lock:
+                if not self.commands:
+                    return
+                func, args = self.commands.popleft()
+            try:
+                func(*args)
+            except Exception:
+                # 指令屬於某個房間時只關閉該房間
+                room = args[0] if args and isinstance(args[0], HostedRoom) else None
+                print(f"[Host] Command {func.__name__} failed:\n{traceback.format_exc()}")
+                if room is not None:
+                    self.drop_room(room)
+    
+    def drop_player(self, player):
+        """處理連線時發生非預期的例外 (需在 except 區塊中呼叫)，只關閉這條連線"""
+        print(f"[Host] Connection error from {player.address}:\n{traceback.format_exc()}")
+        try:
+            self.disconnect(player)
+        except Exception:
+            player.closed = True
+            self.dirty.discard(player)
+    
+    def drop_room(self, room):
+        """房間的指令發生非預期的例外，以異常結束關閉房間"""
+        room.error = room.error or traceback.format_exc()
+        try:
+            self.close_room_now(room.room_id)
+        except Exception:
+            print(f"[Host] Failed to close room {room.room_id}:\n{traceback.format_exc()}")
+    
+    def run(self):
+        while True:
+            timeout = self.run_timers()
+            for key, events in self.selector.select(timeout):
+                if key.data == "wakeup":
+                    self.run_commands()
+                elif key.data == "accept":
+                    try:
+                        self.accept()
+                    except Exception:
+                        print(f"[Host] Accept failed:\n{traceback.format_exc()}")
+                else:
+                    player = key.data
+                    try:
+                        if events & selectors.EVENT_READ:
+                            self.receive(player)
+                        if events & selectors.EVENT_WRITE:
+                            self.dirty.add(player)
+                    except Exception:
+                        self.drop_player(player)
+            
+            # 回呼中排入的訊息統一在這裡送出
+            while self.dirty:
+                player = self.dirty.pop()
+                try:
+                    self.flush(player)
+                except Exception:
+                    self.drop_player(player)
@@ -0,0 +1,613 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Game Store System - Game Server 監管
+啟動 Game Server、把 stdout/stderr 寫入每個房間的輪替 log，並在結束時回收 process
+Linux 上啟動後立即套用資源限制 (prlimit)，並定期取樣 CPU / 記憶體處理超出預算的房間
+"""
+
+import os
+import time
+import socket
+import selectors
+import threading
+import subprocess
+from collections import deque
+
+# 異常結束時保留多少 stderr 供顯示
+STDERR_TAIL_BYTES = 2048
+READ_SIZE = 64 * 1024
+PROC_DIR = '/proc'
+if os.path.isdir(PROC_DIR) and hasattr(os, 'sysconf'):
+    CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+else:
+    CLOCK_TICKS = PAGE_SIZE = None  # 沒有 /proc 時不取樣
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+def env_number(name, default, cast=int):
+    """讀取數值環境變數，0 或負數表示不限制"""
+    value = cast(os.environ.get(name, default))
+    return value if value > 0 else None
+
+class ResourceLimits:
+    """
+    Game Server 的資源限制
+    - 啟動後由大廳以 prlimit / setpriority 套用 (Linux)：CPU 秒數 (RLIMIT_CPU)、位址空間 (RLIMIT_AS)、
+      開啟檔案數 (RLIMIT_NOFILE) 與 nice 值；不在子行程 exec 前執行 Python 程式碼，多執行緒的大廳 fork 後不會卡在鎖上
+    - 執行中的預算 (Linux，每 sample_interval 秒取樣)：
+      CPU 使用率連續 throttle_after 次超過 cpu_percent 時調降優先權，連續 kill_after 次則終止；
+      RSS 超過 rss_mb 立即終止
+    """
+    
+    def __init__(self, cpu_seconds=None, memory_mb=None, max_files=None, nice=None,
+                 cpu_percent=None, rss_mb=None, sample_interval=5, throttle_after=3, kill_after=12):
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+        self.max_files = max_files
+        self.nice = nice
+        self.cpu_percent = cpu_percent
+        self.rss_mb = rss_mb
+        self.sample_interval = sample_interval
+        self.throttle_after = throttle_after
+        self.kill_after = kill_after
+    
+    @classmethod
+    def from_env(cls):
+        """由環境變數建立 (GAME_CPU_SECONDS / GAME_MEMORY_MB / GAME_MAX_FILES / GAME_NICE / GAME_CPU_PERCENT / GAME_RSS_MB)"""
+        return cls(
+            cpu_seconds=env_number("GAME_CPU_SECONDS", "3600"),
+            memory_mb=env_number("GAME_MEMORY_MB", "1024"),
+            max_files=env_number("GAME_MAX_FILES", "256"),
+            nice=env_number("GAME_NICE", "5"),
+            cpu_percent=env_number("GAME_CPU_PERCENT", "90", float),
+            rss_mb=env_number("GAME_RSS_MB", "512")
+        )
+    
+    def rlimits(self):
+        """要套用的 [(resource 種類, (soft, hard))]"""
+        limits = []
+        if self.cpu_seconds:
+            # 超過軟限制時收到 SIGXCPU，再多 5 秒仍未結束則被 SIGKILL
+            limits.append((resource.RLIMIT_CPU, (self.cpu_seconds, self.cpu_seconds + 5)))
+        if self.memory_mb and hasattr(resource, 'RLIMIT_AS'):
+            size = self.memory_mb * 1024 * 1024
+            limits.append((resource.RLIMIT_AS, (size, size)))
+        if self.max_files:
+            limits.append((resource.RLIMIT_NOFILE, (self.max_files, self.max_files)))
+        return limits
+    
+    def apply(self, pid):
+        """對剛啟動的行程套用限制 (沒有 prlimit 的平台不套用)，行程已結束時忽略"""
+        if resource is not None and hasattr(resource, 'prlimit'):
+            for kind, (soft, hard) in self.rlimits():
+                try:
+                    # 不能超過行程目前的硬限制 (繼承自大廳)
+                    _, current_hard = resource.prlimit(pid, kind)
+                    if current_hard != resource.RLIM_INFINITY:
+                        soft, hard = min(soft, current_hard), min(hard, current_hard)
+                    resource.prlimit(pid, kind, (soft, hard))
+                except (OSError, ValueError):
+                    pass
+        
+        if self.nice and hasattr(os, 'setpriority'):
+            try:
+                priority = os.getpriority(os.PRIO_PROCESS, pid)
+                os.setpriority(os.PRIO_PROCESS, pid, min(priority + self.nice, 19))
+            except OSError:
+                pass
+    
+    def metrics(self):
+        return {
+            "cpu_seconds": self.cpu_seconds,
+            "memory_mb": self.memory_mb,
+            "max_files": self.max_files,
+            "nice": self.nice,
+            "cpu_percent": self.cpu_percent,
+            "rss_mb": self.rss_mb
+        }
+
+def read_proc_usage(pid):
+    """讀取 /proc 中 process 累計的 CPU 秒數與 RSS (bytes)，失敗時回傳 None"""
+    try:
+        with open(f"{PROC_DIR}/{pid}/stat", 'rb') as f:
+            stat = f.read()
+        with open(f"{PROC_DIR}/{pid}/statm", 'rb') as f:
+            statm = f.read().split()
+    except OSError:
+        return None
+    
+    # comm 欄位可能含空白，從最後一個 ')' 之後開始算 (utime / stime 為第 14、15 欄)
+    fields = stat[stat.rfind(b')') + 2:].split()
+    cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    return cpu, int(statm[1]) * PAGE_SIZE
+
+class RotatingLog:
+    """
+    大小超過上限時輪替的 log 檔 (<name>.log -> <name>.log.1 -> ...)
+    有自己的鎖，寫入不需要持有監管器的鎖；關閉後的寫入直接略過 (例如預熱 process 改登記到房間時)
+    """
+    
+    def __init__(self, path, max_bytes, backup_count):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, 'ab')
+        self.size = self.file.tell()
+    
+    def write(self, data):
+        with self.lock:
+            if self.file.closed:
+                return
+            if self.max_bytes and self.size + len(data) > self.max_bytes and self.size > 0:
+                self.rotate()
+            self.file.write(data)
+            self.file.flush()
+            self.size += len(data)
+    
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.file = open(self.path, 'wb')
+        self.size = 0
+    
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+class GameProcess:
+    """一個受監管的 Game Server"""
+    __slots__ = ("room_id", "process", "log", "open_streams", "expected_exit",
+                 "started_at", "stderr_tail", "on_exit", "group",
+                 "cpu_seconds", "cpu_percent", "rss", "sampled_at", "strikes", "throttled", "kill_reason")
+    
+    def __init__(self, room_id, process, log, on_exit, group=None):
+        self.room_id = room_id
+        self.process = process
+        self.log = log
+        self.open_streams = 2          # stdout + stderr，都關閉後回收 process
+        self.expected_exit = False     # 已回報結果或由大廳主動停止
+        self.started_at = time.time()
+        self.stderr_tail = bytearray()
+        self.on_exit = on_exit
+        self.group = group             # 統計資源用量的分組 (game_id)
+        
+        # 資源取樣
+        self.cpu_seconds = 0.0
+        self.cpu_percent = 0.0
+        self.rss = 0
+        self.sampled_at = None
+        self.strikes = 0               # 連續超過 CPU 預算的取樣次數
+        self.throttled = False
+        self.kill_reason = None
+
+class GameSupervisor:
+    """
+    Game Server 監管
+    - POSIX 使用單一 selector 執行緒讀取所有 Game Server 的輸出，避免 pipe 寫滿導致 Game Server 卡住
+    - Windows 的 pipe 不支援 select，改為每個 stream 一個讀取執行緒
+    - 輸出結束後 wait() 回收 process，並呼叫 on_exit(room_id, returncode, expected, stderr_tail)
+    - 有 /proc 時由取樣執行緒記錄每個房間的 CPU / RSS，累計到各遊戲 (group) 的用量
+    """
+    
+    def __init__(self, log_dir, max_log_bytes=1024 * 1024, backup_count=2, limits=None):
+        self.log_dir = log_dir
+        self.max_log_bytes = max_log_bytes
+        self.backup_count = backup_count
+        self.limits = limits or ResourceLimits()
+        self.sampler = None
+        self.usage = {}  # group -> 累計用量
+        
+        self.lock = threading.Lock()
+        self.processes = {}  # room_id -> GameProcess
+        
+        self.use_selector = os.name != 'nt'
+        self.selector = None
+        self.thread = None
+        self.pending = deque()  # 等待 selector 執行緒註冊的 (stream, record, is_stderr)
+        self.wakeup_r = None
+        self.wakeup_w = None
+        
+        # 統計
+        self.started = 0
+        self.exited = 0
+        self.crashed = 0
+        self.killed = 0
+        self.throttled = 0
+        self.pruned_logs = 0
+    
+    # ---------- 對外操作 ----------
+    
+    def spawn(self, room_id, cmd, cwd, on_exit=None, control=False, group=None):
+        """
+        啟動 Game Server 並開始監管，回傳 Popen
+        control=True 時保留 stdin 作為控制通道 (預熱池使用)
+        group 為資源用量統計的分組 (game_id)
+        """
+        process = subprocess.Popen(
+            cmd,
+            cwd=cwd,
+            stdin=subprocess.PIPE if control else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        self.limits.apply(process.pid)
+        log = RotatingLog(self.log_path(room_id), self.max_log_bytes, self.backup_count)
+        log.write(f"===== {time.strftime('%Y-%m-%d %H:%M:%S')} start pid={process.pid}: {' '.join(cmd)}\n".encode('utf-8'))
+        record = GameProcess(room_id, process, log, on_exit, group)
+        
+        with self.lock:
+            self.processes[room_id] = record
+            self.started += 1
+            if group is not None:
+                self.group_usage(group)["runs"] += 1
+            if self.sampler is None and CLOCK_TICKS and self.limits.sample_interval:
+                self.sampler = threading.Thread(target=self.run_sampler, daemon=True)
+                self.sampler.start()
+        
+        self.watch(record, process.stdout, False)
+        self.watch(record, process.stderr, True)
+        return process
+    
+    def assign(self, key, room_id, on_exit=None):
+        """把預熱中的 Game Server (以 key 登記) 改登記到房間，之後的輸出寫入房間的 log"""
+        room_log = RotatingLog(self.log_path(room_id), self.max_log_bytes, self.backup_count)
+        
+        with self.lock:
+            record = self.processes.pop(key, None)
+            if record is None or record.process.poll() is not None:
+                # 已結束的預熱 process 交給 reap 收尾
+                if record is not None:
+                    self.processes[key] = record
+                room_log.close()
+                return False
+            
+            warm_log = record.log
+            record.room_id = room_id
+            record.log = room_log
+            record.on_exit = on_exit
+            self.processes[room_id] = record
+        
+        room_log.write(f"===== {time.strftime('%Y-%m-%d %H:%M:%S')} assign pid={record.process.pid} (pre-warmed)\n".encode('utf-8'))
+        warm_log.close()
+        try:
+            os.remove(warm_log.path)
+        except OSError:
+            pass
+        return True
+    
+    def log_path(self, room_id):
+        """房間 Game Server 的 log 檔路徑"""
+        return os.path.join(self.log_dir, f"{room_id}.log")
+    
+    def prune_logs(self, max_age=None, max_rooms=None):
+        """
+        刪除已結束房間的 log (含輪替檔)，回傳刪除的房間數
+        超過 max_age 秒沒有更新的刪除；剩下的超過 max_rooms 個房間時從最久沒更新的刪起
+        """
+        try:
+            names = os.listdir(self.log_dir)
+        except OSError:
+            return 0
+        with self.lock:
+            running = set(self.processes)
+        
+        rooms = {}  # room_id -> [最後更新時間, 檔案路徑...]
+        for name in names:
+            room_id, sep, _ = name.partition('.log')
+            if not sep or room_id in running:
+                continue
+            path = os.path.join(self.log_dir, name)
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            entry = rooms.setdefault(room_id, [0])
+            entry[0] = max(entry[0], mtime)
+            entry.append(path)
+        
+        now = time.time()
+        ordered = sorted(rooms.values(), key=lambda entry: entry[0])
+        stale = [entry for entry in ordered if max_age and now - entry[0] > max_age]
+        kept = ordered[len(stale):]
+        if max_rooms and len(kept) > max_rooms:
+            stale += kept[:len(kept) - max_rooms]
+        
+        for entry in stale:
+            for path in entry[1:]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        with self.lock:
+            self.pruned_logs += len(stale)
+        return len(stale)
+    
+    def finish(self, room_id):
+        """Game Server 已回報結果，之後的結束屬於正常結束"""
+        with self.lock:
+            record = self.processes.get(room_id)
+            if record:
+                record.expected_exit = True
+    
+    def stop(self, room_id, timeout=5):
+        """主動停止 Game Server"""
+        with self.lock:
+            record = self.processes.get(room_id)
+            if not record:
+                return
+            record.expected_exit = True
+        
+        try:
+            record.process.terminate()
+            record.process.wait(timeout=timeout)
+        except:
+            record.process.kill()
+    
+    def stop_all(self):
+        """停止所有 Game Server (伺服器關閉時)"""
+        with self.lock:
+            room_ids = list(self.processes)
+        for room_id in room_ids:
+            self.stop(room_id, timeout=1)
+    
+    def running(self, room_id):
+        """房間的 Game Server 是否仍在執行"""
+        with self.lock:
+            record = self.processes.get(room_id)
+        return record is not None and record.process.poll() is None
+    
+    def metrics(self):
+        """執行中數量與累計統計"""
+        with self.lock:
+            return {
+                "running": len(self.processes),
+                "started": self.started,
+                "exited": self.exited,
+                "crashed": self.crashed,
+                "killed": self.killed,
+                "throttled": self.throttled,
+                "pruned_logs": self.pruned_logs
+            }
+    
+    def resource_usage(self):
+        """各遊戲累計的資源用量與執行中房間的最近一次取樣"""
+        with self.lock:
+            return {
+                "limits": self.limits.metrics(),
+                "games": {group: dict(usage, cpu_seconds=round(usage["cpu_seconds"], 2))
+                          for group, usage in self.usage.items()},
+                "rooms": {
+                    record.room_id: {
+                        "game_id": record.group,
+                        "cpu_seconds": round(record.cpu_seconds, 2),
+                        "cpu_percent": round(record.cpu_percent, 1),
+                        "rss_mb": round(record.rss / (1024 * 1024), 1),
+                        "throttled": record.throttled
+                    }
+                    for record in self.processes.values() if record.sampled_at is not None
+                }
+            }
+    
+    def group_usage(self, group):
+        """取得分組的用量紀錄 (需持有 self.lock)"""
+        usage = self.usage.get(group)
+        if usage is None:
+            usage = self.usage[group] = {"runs": 0, "cpu_seconds": 0.0, "peak_rss_mb": 0, "throttled": 0, "killed": 0}
+        return usage
+    
+    # ---------- 資源取樣 ----------
+    
+    def run_sampler(self):
+        """取樣執行緒：定期讀取所有 Game Server 的 CPU / RSS 並檢查預算"""
+        while True:
+            time.sleep(self.limits.sample_interval)
+            with self.lock:
+                records = list(self.processes.values())
+            for record in records:
+                self.sample(record)
+    
+    def sample(self, record):
+        """取樣單一 Game Server，超過預算時調降優先權或終止"""
+        usage = read_proc_usage(record.process.pid)
+        if usage is None or record.process.poll() is not None:
+            return
+        cpu_seconds, rss = usage
+        now = time.monotonic()
+        limits = self.limits
+        action = None
+        
+        with self.lock:
+            if record.sampled_at is not None:
+                elapsed = now - record.sampled_at
+                delta = max(cpu_seconds - record.cpu_seconds, 0.0)
+                record.cpu_percent = delta / elapsed * 100 if elapsed > 0 else 0.0
+            else:
+                delta = cpu_seconds
+            record.cpu_seconds = cpu_seconds
+            record.rss = rss
+            record.sampled_at = now
+            
+            if record.group is not None:
+                group = self.group_usage(record.group)
+                group["cpu_seconds"] += delta
+                group["peak_rss_mb"] = max(group["peak_rss_mb"], round(rss / (1024 * 1024), 1))
+            
+            if record.kill_reason:
+                return
+            if limits.rss_mb and rss > limits.rss_mb * 1024 * 1024:
+                action = f"記憶體超出預算 ({rss // (1024 * 1024)}MB > {limits.rss_mb}MB)"
+            elif limits.cpu_percent and record.cpu_percent > limits.cpu_percent:
+                record.strikes += 1
+                if limits.kill_after and record.strikes >= limits.kill_after:
+                    action = f"CPU 持續超出預算 ({record.cpu_percent:.0f}% > {limits.cpu_percent:.0f}%)"
+                elif record.strikes >= limits.throttle_after and not record.throttled:
+                    action = "throttle"
+            else:
+                record.strikes = 0
+            
+            if action == "throttle":
+                record.throttled = True
+                self.throttled += 1
+                if record.group is not None:
+                    self.group_usage(record.group)["throttled"] += 1
+            elif action:
+                record.kill_reason = action
+                self.killed += 1
+                if record.group is not None:
+                    self.group_usage(record.group)["killed"] += 1
+        
+        if action == "throttle":
+            try:
+                os.setpriority(os.PRIO_PROCESS, record.process.pid, 19)
+            except (AttributeError, OSError):
+                pass
+            print(f"[Supervisor] Throttled game server for room {record.room_id} ({record.cpu_percent:.0f}% CPU)")
+        elif action:
+            print(f"[Supervisor] Killing game server for room {record.room_id}: {action}")
+            record.process.kill()
+    
+    # ---------- 讀取輸出 ----------
+    
+    def watch(self, record, stream, is_stderr):
+        """開始讀取 stream"""
+        if not self.use_selector:
+            threading.Thread(target=self.drain_blocking, args=(record, stream, is_stderr), daemon=True).start()
+            return
+        
+        with self.lock:
+            if self.thread is None:
+                self.selector = selectors.DefaultSelector()
+                self.wakeup_r, self.wakeup_w = socket.socketpair()
+                self.wakeup_r.setblocking(False)
+                self.selector.register(self.wakeup_r, selectors.EVENT_READ, None)
+                self.thread = threading.Thread(target=self.run_selector, daemon=True)
+                self.thread.start()
+            self.pending.append((stream, record, is_stderr))
+        
+        # 喚醒 selector 執行緒來註冊新的 stream
+        try:
+            self.wakeup_w.send(b'\0')
+        except OSError:
+            pass
+    
+    def run_selector(self):
+        """selector 執行緒：讀取所有 Game Server 的輸出"""
+        while True:
+            for key, _ in self.selector.select():
+                if key.data is None:
+                    self.register_pending()
+                    continue
+                
+                stream, record, is_stderr = key.data
+                try:
+                    data = os.read(stream.fileno(), READ_SIZE)
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    data = b''
+                
+                if data:
+                    self.record_output(record, data, is_stderr)
+                else:
+                    self.selector.unregister(stream)
+                    self.close_stream(record, stream)
+    
+    def register_pending(self):
+        """註冊其他執行緒送來的 stream (在 selector 執行緒執行)"""
+        try:
+            while self.wakeup_r.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+        
+        while True:
+            with self.lock:
+                if not self.pending:
+                    return
+                stream, record, is_stderr = self.pending.popleft()
+            os.set_blocking(stream.fileno(), False)
+            self.selector.register(stream, selectors.EVENT_READ, (stream, record, is_stderr))
+    
+    def drain_blocking(self, record, stream, is_stderr):
+        """Windows：以阻塞讀取的執行緒處理單一 stream"""
+        while True:
+            try:
+                data = stream.read1(READ_SIZE)
+            except (OSError, ValueError):
+                data = b''
+            if not data:
+                break
+            self.record_output(record, data, is_stderr)
+        self.close_stream(record, stream)
+    
+    def record_output(self, record, data, is_stderr):
+        """保留 stderr 最後一段，並寫入 log (寫檔在監管器的鎖外進行)"""
+        with self.lock:
+            log = record.log
+            if is_stderr:
+                record.stderr_tail += data
+                del record.stderr_tail[:-STDERR_TAIL_BYTES]
+        log.write(data)
+    
+    def close_stream(self, record, stream):
+        """stream 結束；兩個都結束後回收 process"""
+        try:
+            stream.close()
+        except OSError:
+            pass
+        
+        with self.lock:
+            record.open_streams -= 1
+            done = record.open_streams == 0
+        if not done:
+            return
+        
+        if record.process.poll() is None:
+            # 輸出已關閉但 process 還沒結束，另開執行緒等待，不阻塞其他 Game Server 的輸出
+            threading.Thread(target=self.reap, args=(record,), daemon=True).start()
+        else:
+            self.reap(record)
+    
+    # ---------- 回收 ----------
+    
+    def reap(self, record):
+        """等待 process 結束並通知"""
+        returncode = record.process.wait()
+        
+        with self.lock:
+            # 同一房間已啟動新的 Game Server 時，舊的結束不影響房間
+            current = self.processes.get(record.room_id) is record
+            if current:
+                del self.processes[record.room_id]
+            expected = record.expected_exit or not current
+            self.exited += 1
+            if returncode != 0 and not expected:
+                self.crashed += 1
+            if record.kill_reason:
+                record.stderr_tail += f"\n[Supervisor] {record.kill_reason}\n".encode('utf-8')
+            log = record.log
+            stderr_tail = bytes(record.stderr_tail).decode('utf-8', errors='replace')
+        
+        log.write(f"===== {time.strftime('%Y-%m-%d %H:%M:%S')} exit code={returncode}"
+                  f"{' (' + record.kill_reason + ')' if record.kill_reason else ''}\n".encode('utf-8'))
+        log.close()
+        
+        if record.on_exit:
+            try:
+                record.on_exit(record.room_id, returncode, expected, stderr_tail)
+            except Exception as e:
+                print(f"[Supervisor] Exit handler failed for room {record.room_id}: {e}")
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Game Store System - 排行榜
+每個遊戲維護積分、勝場與勝率三種排行，隨對戰紀錄增量更新，
+以可依名次存取的跳躍串列 (indexable skiplist) 保持排序：更新 O(log n)、前 K 名 O(log n + K)、查詢名次 O(log n)
+"""
+
+import random
+import threading
+
+from match_store import counts_as_win
+
+# 排行種類
+LEADERBOARD_BOARDS = ("rating", "wins", "win_rate")
+
+class RankedSet:
+    """
+    可依名次存取的排序集合 (indexable skiplist)
+    每個節點的每一層記錄「跳到下一個節點會經過幾個元素」，依此可在 O(log n) 內算出名次或跳到第 i 名
+    元素需可比較且不重複 (排行榜的 key 最後一欄為玩家名稱)
+    """
+    
+    MAX_LEVEL = 24  # 約可容納 2^24 個元素仍維持 O(log n)
+    
+    def __init__(self):
+        self.head = [None, [None] * self.MAX_LEVEL, [1] * self.MAX_LEVEL]  # [key, next[], width[]]
+        self.level = 1  # 目前使用到的最高層數
+        self.size = 0
+    
+    def __len__(self):
+        return self.size
+    
+    def random_level(self):
+        level = 1
+        while level < self.MAX_LEVEL and random.random() < 0.5:
+            level += 1
+        return level
+    
+    def insert(self, key):
+        level = self.random_level()
+        self.level = max(self.level, level)
+        
+        # 記錄每一層最後一個小於 key 的節點，以及它之前有幾個元素
+        update = [None] * self.level
+        before = [0] * self.level
+        node, position = self.head, 0
+        for i in range(self.level - 1, -1, -1):
+            while node[1][i] is not None and node[1][i][0] < key:
+                position += node[2][i]
+                node = node[1][i]
+            update[i] = node
+            before[i] = position
+        
+        new = [key, [None] * level, [0] * level]
+        for i in range(self.level):
+            prev = update[i]
+            if i < level:
+                # 新節點插在 prev 之後，拆分 prev 原本的跨距
+                skipped = position - before[i]
+                new[1][i] = prev[1][i]
+                new[2][i] = prev[2][i] - skipped
+                prev[1][i] = new
+                prev[2][i] = skipped + 1
+            else:
+                prev[2][i] += 1
+        self.size += 1
+    
+    def remove(self, key):
+        """移除元素 (不存在時回傳 False)"""
+        update = [None] * self.level
+        node = self.head
+        for i in range(self.level - 1, -1, -1):
+            while node[1][i] is not None and node[1][i][0] < key:
+                node = node[1][i]
+            update[i] = node
+        
+        target = node[1][0]
+        if target is None or target[0] != key:
+            return False
+        
+        for i in range(self.level):
+            prev = update[i]
+            if prev[1][i] is target:
+                prev[1][i] = target[1][i]
+                prev[2][i] += target[2][i] - 1
+            else:
+                prev[2][i] -= 1
+        self.size -= 1
+        return True
+    
+    def rank(self, key):
+        """元素的名次 (從 0 起算)，不存在時回傳 None"""
+        node, position = self.head, 0
+        for i in range(self.level - 1, -1, -1):
+            while node[1][i] is not None and node[1][i][0] <= key:
+                position += node[2][i]
+                node = node[1][i]
+            if node is not self.head and node[0] == key:
+                return position - 1
+        return None
+    
+    def slice(self, start, count):
+        """依序取出第 start 名起的 count 個元素"""
+        if start >= self.size or count <= 0:
+            return []
+        
+        # 先以跨距跳到第 start 名，再沿最底層往後走
+        node, position = self.head, -1
+        for i in range(self.level - 1, -1, -1):
+            while node[1][i] is not None and position + node[2][i] <= start:
+                position += node[2][i]
+                node = node[1][i]
+        
+        keys = []
+        while node is not None and len(keys) < count:
+            keys.append(node[0])
+            node = node[1][0]
+        return keys
+
+class GameBoard:
+    """單一遊戲的排行"""
+    
+    def __init__(self):
+        self.players = {}  # username -> {"played", "wins", "rating"} (rating 為最後一次更新時的積分)
+        self.boards = {name: RankedSet() for name in LEADERBOARD_BOARDS}
+        self.keys = {name: {} for name in LEADERBOARD_BOARDS}  # board -> username -> 目前在排行中的 key
+    
+    def board_key(self, board, username, stats, min_games):
+        """玩家在排行中的排序 key (越小越前面)，不列入排行時回傳 None"""
+        if board == "rating":
+            return (-stats["rating"], -stats["played"], username)
+        if board == "wins":
+            return (-stats["wins"], stats["played"], username)
+        if stats["played"] < min_games:
+            return None
+        return (-stats["wins"] / stats["played"], -stats["played"], username)
+    
+    def refresh(self, username, min_games):
+        """玩家的統計改變後，重新放進各排行"""
+        stats = self.players[username]
+        for board in LEADERBOARD_BOARDS:
+            old = self.keys[board].pop(username, None)
+            if old is not None:
+                self.boards[board].remove(old)
+            key = self.board_key(board, username, stats, min_games)
+            if key is not None:
+                self.boards[board].insert(key)
+                self.keys[board][username] = key
+    
+    def entry(self, username, rank):
+        stats = self.players[username]
+        return {
+            "rank": rank + 1,
+            "username": username,
+            "played": stats["played"],
+            "wins": stats["wins"],
+            "win_rate": round(stats["wins"] / stats["played"], 4) if stats["played"] else 0,
+            "rating": round(stats["rating"], 1)
+        }
+
+class Leaderboards:
+    """
+    所有遊戲的排行榜
+    - 以 MatchStore.subscribe(leaderboards.on_match) 接收每一場對戰 (含啟動時重播的紀錄)
+    - 積分由 rating(game_id, username) 提供 (RatingEngine.rating)，積分引擎需比排行榜先訂閱
+    - 勝率排行只列入至少玩過 min_games 場的玩家
+    - 勝場與對戰紀錄的玩家統計相同，以 counts_as_win() 判定 (單人場次不計勝場)
+    """
+    
+    def __init__(self, rating, min_games=5):
+        self.rating = rating
+        self.min_games = min_games
+        self.lock = threading.Lock()
+        self.games = {}  # game_id -> GameBoard
+    
+    def on_match(self, match):
+        players = match["players"]
+        
+        with self.lock:
+            game = self.games.get(match["game_id"])
+            if game is None:
+                game = self.games[match["game_id"]] = GameBoard()
+            for player in players:
+                stats = game.players.get(player)
+                if stats is None:
+                    stats = game.players[player] = {"played": 0, "wins": 0}
+                stats["played"] += 1
+                if counts_as_win(match, player):
+                    stats["wins"] += 1
+                stats["rating"] = self.rating(match["game_id"], player)
+                game.refresh(player, self.min_games)
+    
+    def top(self, game_id, board, offset=0, limit=10):
+        """排行中第 offset+1 名起的 limit 位玩家，回傳 (entries, 排行總人數)"""
+        with self.lock:
+            game = self.games.get(game_id)
+            if game is None:
+                return [], 0
+            ranked = game.boards[board]
+            keys = ranked.slice(offset, limit)
+            return [game.entry(key[-1], offset + i) for i, key in enumerate(keys)], len(ranked)
+    
+    def lookup(self, game_id, board, username):
+        """玩家在排行中的名次與統計，未列入排行時回傳 None"""
+        with self.lock:
+            game = self.games.get(game_id)
+            if game is None:
+                return None
+            key = game.keys[board].get(username)
+            if key is None:
+                return None
+            return game.entry(username, game.boards[board].rank(key))
+    
+    def metrics(self):
+        with self.lock:
+            return {
+                "games": len(self.games),
+                "ranked_players": sum(len(game.players) for game in self.games.values())
+            }
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Game Store System - 對戰紀錄
+每場遊戲結果附加寫入 JSON Lines 對戰紀錄檔 (只附加不改寫)，
+同時在記憶體中增量維護每位玩家的統計與查詢用的索引，查詢時不掃描整個紀錄檔
+"""
+
+import os
+import json
+import time
+import bisect
+import threading
+
+def counts_as_win(match, player):
+    """
+    玩家在這場是否算一場勝利：需是紀錄的勝利者，且這場至少有兩位玩家 (單人遊戲不計勝場)
+    玩家統計、排行榜與積分都以這個規則計算
+    """
+    return player == match.get("winner") and len(match["players"]) > 1
+
+class MatchStore:
+    """
+    對戰紀錄
+    - 紀錄檔每行一場：{"match_id", "time", "game_id", "room_id", "players", "winner", "result"}
+    - 啟動時 load() 依序讀過一次紀錄檔，重建統計與索引；之後每場只做 O(玩家數) 的增量更新
+    - 索引記錄每場在檔案中的位移，依 (全部 / 玩家 / 遊戲 / 玩家+遊戲) 分組，分頁查詢只讀取需要的那幾行
+    - 訂閱者 (排行榜、積分) 以 subscribe() 註冊，載入時與新增紀錄時都會收到每一場
+    - 勝場以 counts_as_win() 判定：只有一位玩家的場次計入場數但不計勝場
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+        self.next_id = 1
+        self.index = {}    # key -> ([match_id, ...], [offset, ...])，兩者都依 match_id 遞增
+        self.players = {}  # username -> 統計
+        self.subscribers = []
+        self.skipped = 0   # 載入時略過的損毀紀錄數
+    
+    # ---------- 載入 / 寫入 ----------
+    
+    def subscribe(self, callback):
+        """註冊 callback(match)，在 load() 與 record() 時依序收到每一場 (需在 load() 前註冊)"""
+        self.subscribers.append(callback)
+    
+    def load(self):
+        """
+        讀取紀錄檔重建統計與索引
+        - 沒有換行結尾的最後一行是寫到一半的紀錄，會被截掉
+        - 中間格式錯誤的行 (或 match_id 沒有遞增) 記錄後略過，不影響之後的紀錄
+        """
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            valid_end = 0
+            if os.path.exists(self.path):
+                with open(self.path, 'rb') as f:
+                    line_no = 0
+                    while True:
+                        offset = f.tell()
+                        line = f.readline()
+                        if not line.endswith(b'\n'):
+                            break
+                        line_no += 1
+                        valid_end = f.tell()
+                        
+                        match = self.parse(line)
+                        if match is None:
+                            self.skipped += 1
+                            print(f"[Match] Skipped corrupt record at line {line_no} of {self.path}")
+                            continue
+                        self.apply(match, offset)
+            
+            self.file = open(self.path, 'ab')
+            if self.file.tell() != valid_end:
+                self.file.truncate(valid_end)
+                self.file.seek(valid_end)
+            return self.next_id - 1
+    
+    def parse(self, line):
+        """解析紀錄檔的一行，格式錯誤或 match_id 沒有遞增時回傳 None (需持有 self.lock)"""
+        try:
+            match = json.loads(line)
+        except ValueError:
+            return None
+        if not isinstance(match, dict):
+            return None
+        match_id = match.get("match_id")
+        if not isinstance(match_id, int) or match_id < self.next_id:
+            return None
+        players = match.get("players")
+        if not isinstance(players, list) or not all(isinstance(player, str) for player in players):
+            return None
+        if not isinstance(match.get("game_id"), str) or "time" not in match:
+            return None
+        return match
+    
+    def record(self, game_id, room_id, players, winner, result):
+        """附加一場對戰紀錄，回傳該筆紀錄"""
+        with self.lock:
+            match = {
+                "match_id": self.next_id,
+                "time": round(time.time(), 3),
+                "game_id": game_id,
+                "room_id": room_id,
+                "players": list(players),
+                "winner": winner,
+                "result": result
+            }
+            offset = self.file.tell()
+            self.file.write((json.dumps(match, ensure_ascii=False) + "\n").encode('utf-8'))
+            self.file.flush()
+            self.apply(match, offset)
+        return match
+    
+    def apply(self, match, offset):
+        """把一場對戰加入統計與索引 (需持有 self.lock)"""
+        match_id = match["match_id"]
+        self.next_id = max(self.next_id, match_id + 1)
+        game_id = match["game_id"]
+        
+        self.add_index(None, match_id, offset)
+        self.add_index(("game", game_id), match_id, offset)
+        for player in match["players"]:
+            self.add_index(("player", player), match_id, offset)
+            self.add_index(("player", player, game_id), match_id, offset)
+            
+            stats = self.players.get(player)
+            if stats is None:
+                stats = self.players[player] = {"played": 0, "wins": 0, "last_played": None, "games": {}}
+            game_stats = stats["games"].setdefault(game_id, {"played": 0, "wins": 0})
+            stats["played"] += 1
+            game_stats["played"] += 1
+            if counts_as_win(match, player):
+                stats["wins"] += 1
+                game_stats["wins"] += 1
+            stats["last_played"] = match["time"]
+        
+        for callback in self.subscribers:
+            callback(match)
+    
+    def add_index(self, key, match_id, offset):
+        entry = self.index.get(key)
+        if entry is None:
+            entry = self.index[key] = ([], [])
+        entry[0].append(match_id)
+        entry[1].append(offset)
+    
+    # ---------- 查詢 ----------
+    
+    def history(self, username=None, game_id=None, before=None, limit=20):
+        """
+        由新到舊的對戰紀錄，before 為上一頁最後一筆的 match_id
+        回傳 (matches, next_before)，next_before 為 None 表示沒有更舊的紀錄
+        """
+        if username is not None:
+            key = ("player", username, game_id) if game_id is not None else ("player", username)
+        else:
+            key = ("game", game_id) if game_id is not None else None
+        
+        with self.lock:
+            entry = self.index.get(key)
+            if not entry:
+                return [], None
+            ids, offsets = entry
+            end = bisect.bisect_left(ids, before) if before is not None else len(ids)
+            start = max(end - limit, 0)
+            wanted = offsets[start:end]
+            next_before = ids[start] if start > 0 else None
+            self.file.flush()
+        
+        matches = []
+        with open(self.path, 'rb') as f:
+            for offset in reversed(wanted):
+                f.seek(offset)
+                matches.append(json.loads(f.readline()))
+        return matches, next_before
+    
+    def player_stats(self, username):
+        """玩家的累計統計 (含各遊戲勝率)，沒有紀錄時回傳 None"""
+        with self.lock:
+            stats = self.players.get(username)
+            if stats is None:
+                return None
+            games = {
+                game_id: {
+                    "played": game["played"],
+                    "wins": game["wins"],
+                    "win_rate": round(game["wins"] / game["played"], 4)
+                }
+                for game_id, game in stats["games"].items()
+            }
+            return {
+                "played": stats["played"],
+                "wins": stats["wins"],
+                "win_rate": round(stats["wins"] / stats["played"], 4) if stats["played"] else 0,
+                "last_played": stats["last_played"],
+                "games": games
+            }
+    
+    def metrics(self):
+        with self.lock:
+            return {
+                "matches": self.next_id - 1,
+                "players": len(self.players),
+                "log_bytes": self.file.tell() if self.file else 0,
+                "skipped_records": self.skipped
+            }
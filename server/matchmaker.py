@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Game Store System - 快速配對
+每個遊戲一條配對佇列，背景執行緒把排隊的玩家分組後交給工作執行緒建立房間並開始遊戲
+"""
+
+import time
+import heapq
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+class MatchQueue:
+    """
+    單一遊戲的配對佇列
+    以 heap 依排隊時間排序，取消時只標記 (lazy deletion)，加入/取消/取出都是 O(log n)
+    """
+    __slots__ = ("game_id", "min_players", "max_players", "heap", "size")
+    
+    def __init__(self, game_id, min_players, max_players):
+        self.game_id = game_id
+        self.min_players = min_players
+        self.max_players = max_players
+        self.heap = []  # [enqueued_at, seq, username, active]
+        self.size = 0   # 有效 (未取消) 的人數
+    
+    def prune(self):
+        """移除堆頂已取消的項目"""
+        while self.heap and not self.heap[0][3]:
+            heapq.heappop(self.heap)
+    
+    def head(self):
+        """排最久的有效項目"""
+        self.prune()
+        return self.heap[0] if self.heap else None
+    
+    def pop(self, count):
+        """依排隊順序取出 count 個有效項目"""
+        entries = []
+        while len(entries) < count:
+            self.prune()
+            if not self.heap:
+                break
+            entries.append(heapq.heappop(self.heap))
+        self.size -= len(entries)
+        return entries
+
+class Matchmaker:
+    """
+    配對器
+    - 排隊人數達到 max_players 立刻成團
+    - 達到 min_players 後最多再等 wait_seconds 湊人，時間到就以目前人數成團
+    - 排超過 max_wait_seconds 仍湊不到 min_players 的玩家會被移出佇列
+    - 成團的組合交給最多 workers 個工作執行緒同時啟動，一場啟動較慢不會擋住其他組合
+    """
+    
+    def __init__(self, wait_seconds=10, max_wait_seconds=120, tick_seconds=0.5, workers=4):
+        self.wait_seconds = wait_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self.tick_seconds = tick_seconds
+        self.workers = workers
+        
+        self.cond = threading.Condition()
+        self.queues = {}    # game_id -> MatchQueue
+        self.entries = {}   # username -> 佇列項目 (每人同時只能排一個遊戲)
+        self.counter = itertools.count()
+        self.thread = None
+        self.pool = None
+        
+        # 統計
+        self.enqueued = 0
+        self.cancelled = 0
+        self.matched_players = 0
+        self.matches = 0
+        self.expired = 0
+        self.starting = 0  # 已成團、正在啟動中的組合數
+    
+    def start(self, on_match, on_expire):
+        """
+        啟動配對執行緒
+        on_match(game_id, usernames): 建立房間並開始遊戲，回傳需要放回佇列的玩家
+        on_expire(game_id, usernames): 通知等待逾時的玩家
+        """
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="match")
+        self.thread = threading.Thread(target=self.run, args=(on_match, on_expire), daemon=True)
+        self.thread.start()
+    
+    # ---------- 佇列操作 ----------
+    
+    def enqueue(self, username, game_id, min_players, max_players):
+        """加入配對佇列，回傳 (目前排隊人數, error)"""
+        with self.cond:
+            if username in self.entries:
+                return None, "您已在配對佇列中"
+            
+            queue = self.queues.get(game_id)
+            if queue is None:
+                queue = self.queues[game_id] = MatchQueue(game_id, min_players, max_players)
+            else:
+                # 遊戲設定可能已更新
+                queue.min_players = min_players
+                queue.max_players = max_players
+            
+            entry = [time.monotonic(), next(self.counter), username, True]
+            heapq.heappush(queue.heap, entry)
+            queue.size += 1
+            self.entries[username] = (game_id, entry)
+            self.enqueued += 1
+            
+            # 人數足夠時立即喚醒配對執行緒
+            if queue.size >= queue.min_players:
+                self.cond.notify()
+            return queue.size, None
+    
+    def cancel(self, username):
+        """取消排隊 (只做標記，實際移除延後到 heap 取出時)"""
+        with self.cond:
+            found = self.entries.pop(username, None)
+            if not found:
+                return False
+            game_id, entry = found
+            entry[3] = False
+            self.queues[game_id].size -= 1
+            self.cancelled += 1
+            return True
+    
+    def requeue(self, game_id, entries):
+        """把配對失敗的玩家以原本的排隊時間放回佇列"""
+        with self.cond:
+            queue = self.queues.get(game_id)
+            if queue is None:
+                return
+            for entry in entries:
+                username = entry[2]
+                if username in self.entries:
+                    continue
+                entry[3] = True
+                heapq.heappush(queue.heap, entry)
+                queue.size += 1
+                self.entries[username] = (game_id, entry)
+    
+    def is_queued(self, username):
+        """玩家是否正在排隊"""
+        with self.cond:
+            return username in self.entries
+    
+    def metrics(self):
+        """佇列狀況統計"""
+        with self.cond:
+            return {
+                "queued": len(self.entries),
+                "queues": {game_id: queue.size for game_id, queue in self.queues.items() if queue.size},
+                "enqueued": self.enqueued,
+                "cancelled": self.cancelled,
+                "matches": self.matches,
+                "matched_players": self.matched_players,
+                "expired": self.expired,
+                "starting": self.starting
+            }
+    
+    # ---------- 配對 ----------
+    
+    def collect(self, now):
+        """
+        取出所有可成團的組合與逾時的玩家 (需持有 self.cond)
+        回傳 ([(game_id, entries), ...], [(game_id, entries), ...])
+        """
+        groups = []
+        expired = []
+        
+        for game_id, queue in self.queues.items():
+            while True:
+                head = queue.head()
+                if head is None:
+                    break
+                
+                waited = now - head[0]
+                if queue.size >= queue.max_players:
+                    entries = queue.pop(queue.max_players)
+                elif queue.size >= queue.min_players and waited >= self.wait_seconds:
+                    entries = queue.pop(queue.size)
+                elif waited >= self.max_wait_seconds:
+                    entries = queue.pop(1)
+                    for entry in entries:
+                        del self.entries[entry[2]]
+                    expired.append((game_id, entries))
+                    self.expired += len(entries)
+                    continue
+                else:
+                    break
+                
+                for entry in entries:
+                    del self.entries[entry[2]]
+                groups.append((game_id, entries))
+        
+        return groups, expired
+    
+    def run(self, on_match, on_expire):
+        """配對執行緒主迴圈"""
+        while True:
+            with self.cond:
+                self.cond.wait(timeout=self.tick_seconds)
+                groups, expired = self.collect(time.monotonic())
+            
+            # 建立房間與啟動遊戲在 lock 外進行，不阻擋其他玩家排隊
+            for game_id, entries in expired:
+                try:
+                    on_expire(game_id, [entry[2] for entry in entries])
+                except Exception as e:
+                    print(f"[Match] Failed to notify expired players: {e}")
+            
+            for game_id, entries in groups:
+                with self.cond:
+                    self.starting += 1
+                self.pool.submit(self.dispatch, on_match, game_id, entries)
+    
+    def dispatch(self, on_match, game_id, entries):
+        """在工作執行緒啟動一個成團的組合，把需要重試的玩家放回佇列"""
+        try:
+            retry = set(on_match(game_id, [entry[2] for entry in entries]) or [])
+        except Exception as e:
+            print(f"[Match] Failed to start match for {game_id}: {e}")
+            retry = {entry[2] for entry in entries}
+        
+        matched = len(entries) - len(retry)
+        with self.cond:
+            self.starting -= 1
+            if matched:
+                self.matches += 1
+                self.matched_players += matched
+        if retry:
+            self.requeue(game_id, [entry for entry in entries if entry[2] in retry])
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Game Store System - Port 分配器
+提供 Game Server 使用的 Port，支援多個範圍、釋放後的隔離期與實際可用性檢查
+"""
+
+import os
+import errno
+import socket
+import threading
+import time
+from collections import deque
+
+# bind 時代表 Port 已被佔用的 errno (Windows socket 錯誤使用 WSA 代碼)
+ADDR_IN_USE = {errno.EADDRINUSE, getattr(errno, 'WSAEADDRINUSE', errno.EADDRINUSE)}
+
+def parse_port_ranges(text):
+    """
+    解析 Port 範圍設定，例如 "12000-13000,14000-14100"
+    每個範圍包含起點、不包含終點 (與 range() 相同)
+    """
+    ranges = []
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-', 1)
+            ranges.append((int(start), int(end)))
+        else:
+            ranges.append((int(part), int(part) + 1))
+    return ranges
+
+class PortAllocator:
+    """
+    執行緒安全的 Port 分配器
+    - 可用 Port 放在 free list (deque)，分配與釋放都是 O(1)
+    - 釋放的 Port 先進入隔離區，一段時間後才重新分配 (避免舊 Game Server 尚未完全結束)
+    - 可選擇在分配前實際 bind 一次，確認 OS 上沒有其他程式佔用
+    """
+    
+    def __init__(self, ranges, quarantine_seconds=30, probe_host=None):
+        self.lock = threading.Lock()
+        self.ranges = list(ranges)
+        self.quarantine_seconds = quarantine_seconds
+        self.probe_host = probe_host  # None 表示不檢查
+        
+        self.free = deque()
+        self.in_use = set()
+        self.quarantine = deque()  # (釋放時間, port)，依時間先後排列
+        self.known = set()
+        
+        for start, end in self.ranges:
+            for port in range(start, end):
+                if port not in self.known:
+                    self.known.add(port)
+                    self.free.append(port)
+        
+        # 統計
+        self.allocations = 0
+        self.releases = 0
+        self.probe_failures = 0
+        self.exhausted = 0
+    
+    def allocate(self):
+        """分配一個可用的 Port，沒有可用 Port 時回傳 None"""
+        with self.lock:
+            self._reclaim()
+            
+            for _ in range(len(self.free)):
+                port = self.free.popleft()
+                if not self._probe(port):
+                    # 仍被 OS 佔用 (例如當掉的 Game Server)，放回隔離區稍後再試
+                    self.probe_failures += 1
+                    self.quarantine.append((time.monotonic(), port))
+                    continue
+                self.in_use.add(port)
+                self.allocations += 1
+                return port
+            
+            self.exhausted += 1
+            return None
+    
+    def release(self, port):
+        """釋放 Port，進入隔離區"""
+        with self.lock:
+            if port not in self.in_use:
+                return
+            self.in_use.discard(port)
+            self.quarantine.append((time.monotonic(), port))
+            self.releases += 1
+    
+    def metrics(self):
+        """回傳使用狀況統計"""
+        with self.lock:
+            self._reclaim()
+            total = len(self.known)
+            return {
+                "ranges": [f"{start}-{end}" for start, end in self.ranges],
+                "total": total,
+                "in_use": len(self.in_use),
+                "free": len(self.free),
+                "quarantined": len(self.quarantine),
+                "utilization": round(len(self.in_use) / total, 4) if total else 0,
+                "allocations": self.allocations,
+                "releases": self.releases,
+                "probe_failures": self.probe_failures,
+                "exhausted": self.exhausted
+            }
+    
+    def _reclaim(self):
+        """將隔離期已過的 Port 放回 free list (呼叫時需持有 lock)"""
+        deadline = time.monotonic() - self.quarantine_seconds
+        while self.quarantine and self.quarantine[0][0] <= deadline:
+            self.free.append(self.quarantine.popleft()[1])
+    
+    def listening(self, port):
+        """
+        不建立連線地檢查 Port 是否仍被 Game Server 佔用 (健康檢查用，連線會佔掉 Game Server 的玩家名額)
+        回傳 True / False，無法檢查時回傳 None
+        """
+        if self.probe_host is None:
+            return None
+        error = self._bind(port)
+        if error is None:
+            return False
+        if error in ADDR_IN_USE:
+            return True
+        return None
+    
+    def _probe(self, port):
+        """實際 bind 一次，確認 Port 沒有被其他程式佔用"""
+        if self.probe_host is None:
+            return True
+        
+        # 位址不屬於本機時無法檢查，視為可用
+        error = self._bind(port)
+        return error is None or error == errno.EADDRNOTAVAIL
+    
+    def _bind(self, port):
+        """嘗試 bind，成功回傳 None，失敗回傳 errno"""
+        probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            # 與 Game Server 相同設定 SO_REUSEADDR，TIME_WAIT 中的 Port 仍視為可用
+            # (Windows 的 SO_REUSEADDR 允許搶用已監聽的 Port，因此不設定)
+            if os.name != 'nt':
+                probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            probe.bind((self.probe_host, port))
+            return None
+        except OSError as e:
+            return e.errno
+        finally:
+            probe.close()
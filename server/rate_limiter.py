@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Game Store System - 登入保護
+RateLimiter 以 token bucket 限制每個來源 (IP / 帳號) 的嘗試頻率，
+CredentialCache 記住最近驗證成功的帳密，大量重新登入時不必每次讀取資料庫，
+SingleFlight 讓同時快取未命中的登入共用同一次資料庫讀取
+"""
+
+import hmac
+import time
+import hashlib
+import secrets
+import threading
+from collections import OrderedDict
+
+class RateLimiter:
+    """
+    Token bucket 限流
+    - 每個 key 最多累積 burst 個 token，每秒補充 rate 個，每次嘗試消耗一個
+    - 只保留最近使用的 max_keys 個 key (LRU)，被淘汰的 key 下次視為全新的 bucket
+    - allow() 嘗試並消耗一個 token；只想在失敗時才扣 token 時，先以 wait_time() 檢查、失敗後再 allow()
+    """
+    
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()  # key -> [tokens, 上次更新時間 (monotonic)]
+        
+        # 統計
+        self.allowed = 0
+        self.rejected = 0
+    
+    def allow(self, key):
+        """嘗試消耗一個 token，回傳 (是否允許, 需等待的秒數)"""
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.burst, now]
+                if len(self.buckets) > self.max_keys:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                self.allowed += 1
+                return True, 0
+            self.rejected += 1
+            return False, (1 - bucket[0]) / self.rate
+    
+    def wait_time(self, key):
+        """不消耗 token，回傳還需等待的秒數 (0 表示目前可以嘗試)"""
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                return 0
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            if tokens >= 1:
+                return 0
+            self.rejected += 1
+            return (1 - tokens) / self.rate
+    
+    def metrics(self):
+        with self.lock:
+            return {"keys": len(self.buckets), "allowed": self.allowed, "rejected": self.rejected}
+
+class CredentialCache:
+    """
+    最近驗證成功的帳密 (LRU，最多 max_entries 筆)
+    只保存密碼以隨機金鑰計算的 HMAC，不保存密碼本身；金鑰每次啟動重新產生
+    """
+    
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.key = secrets.token_bytes(32)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # (user_type, username) -> (digest, 使用者資料)
+        
+        # 統計
+        self.hits = 0
+        self.misses = 0
+    
+    def digest(self, password):
+        return hmac.new(self.key, password.encode('utf-8'), hashlib.sha256).digest()
+    
+    def check(self, user_type, username, password):
+        """帳密與快取相符時回傳快取的使用者資料，否則回傳 None (需查詢資料庫)"""
+        with self.lock:
+            entry = self.entries.get((user_type, username))
+            if entry is not None and hmac.compare_digest(entry[0], self.digest(password)):
+                self.entries.move_to_end((user_type, username))
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+    
+    def store(self, user_type, username, password, profile):
+        with self.lock:
+            self.entries[(user_type, username)] = (self.digest(password), profile)
+            self.entries.move_to_end((user_type, username))
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+    
+    def metrics(self):
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+class SingleFlight:
+    """
+    合併同時進行的相同工作
+    同一個 key 已有執行緒在執行時，其他執行緒等待並共用它的結果 (或例外)，結果需視為唯讀
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # key -> [Event, 結果, 例外]
+        
+        # 統計
+        self.executed = 0
+        self.shared = 0
+    
+    def do(self, key, func):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = [threading.Event(), None, None]
+                self.executed += 1
+            else:
+                self.shared += 1
+        
+        if not leader:
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2]
+            return call[1]
+        
+        try:
+            call[1] = func()
+            return call[1]
+        except Exception as e:
+            call[2] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call[0].set()
+    
+    def metrics(self):
+        with self.lock:
+            return {"executed": self.executed, "shared": self.shared, "in_flight": len(self.calls)}
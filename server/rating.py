@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Game Store System - 積分
+以 Glicko 計算每位玩家在每個遊戲的積分 (rating) 與不確定度 (RD)，隨對戰紀錄增量更新，
+定期寫出快照；啟動時先讀快照，對戰紀錄重播時只計算快照之後的場次
+"""
+
+import os
+import json
+import math
+import time
+import threading
+
+# Glicko 參數
+INITIAL_RATING = 1500
+INITIAL_RD = 350          # 新玩家 / 很久沒玩的玩家的不確定度
+MIN_RD = 30
+RD_DECAY_DAYS = 100       # 不確定度從 50 回到 350 需要的天數
+GLICKO_Q = math.log(10) / 400
+GLICKO_C2 = (INITIAL_RD ** 2 - 50 ** 2) / RD_DECAY_DAYS
+
+def glicko_g(rd):
+    return 1 / math.sqrt(1 + 3 * GLICKO_Q ** 2 * rd ** 2 / math.pi ** 2)
+
+class RatingEngine:
+    """
+    積分引擎
+    - 以 MatchStore.subscribe(ratings.on_match) 接收每一場對戰；match_id 不大於快照的場次已計入，直接略過
+    - 勝利者對每位落敗者各算一場勝、落敗者各對勝利者算一場敗，全部以賽前積分計算；沒有勝利者的場次不影響積分
+    - 每 snapshot_every 場寫出一次快照 (先寫暫存檔再取代)，關機前可呼叫 save() 寫出最新狀態
+    """
+    
+    def __init__(self, path, snapshot_every=50):
+        self.path = path
+        self.snapshot_every = snapshot_every
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.ratings = {}        # game_id -> {username: [rating, rd, last_played]}
+        self.last_match_id = 0   # 已計入的最後一場
+        self.pending = 0         # 上次快照後新計入的場數
+        self.snapshots = 0
+    
+    # ---------- 快照 ----------
+    
+    def load(self):
+        """讀取快照，回傳快照涵蓋到的 match_id (需在 MatchStore.load() 前呼叫)"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        
+        with self.lock:
+            self.ratings = snapshot.get("ratings", {})
+            self.last_match_id = snapshot.get("last_match_id", 0)
+            return self.last_match_id
+    
+    def rewind(self, match_id):
+        """對戰紀錄比快照舊 (例如紀錄檔被清除) 時，從 match_id 之後繼續計入，保留既有積分"""
+        with self.lock:
+            self.last_match_id = min(self.last_match_id, match_id)
+    
+    def save(self):
+        """寫出快照"""
+        with self.save_lock:
+            with self.lock:
+                data = json.dumps({
+                    "last_match_id": self.last_match_id,
+                    "saved_at": time.time(),
+                    "ratings": self.ratings
+                }, ensure_ascii=False)
+                self.pending = 0
+            
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_path, self.path)
+            with self.lock:
+                self.snapshots += 1
+    
+    # ---------- 更新 ----------
+    
+    def current(self, game_id, username, now):
+        """玩家目前的 (rating, rd)，rd 依未出賽的天數放大"""
+        entry = self.ratings.get(game_id, {}).get(username)
+        if entry is None:
+            return INITIAL_RATING, INITIAL_RD
+        rating, rd, last_played = entry
+        days = max(now - last_played, 0) / 86400
+        return rating, min(math.sqrt(rd ** 2 + GLICKO_C2 * days), INITIAL_RD)
+    
+    def on_match(self, match):
+        winner = match.get("winner")
+        players = match["players"]
+        
+        with self.lock:
+            if match["match_id"] <= self.last_match_id:
+                return
+            self.last_match_id = match["match_id"]
+            if winner not in players or len(players) < 2:
+                return
+            
+            now = match["time"]
+            game_id = match["game_id"]
+            before = {player: self.current(game_id, player, now) for player in players}
+            games = self.ratings.setdefault(game_id, {})
+            
+            for player in players:
+                if player == winner:
+                    results = [(before[other], 1) for other in players if other != winner]
+                else:
+                    results = [(before[winner], 0)]
+                
+                rating, rd = before[player]
+                impact = 0
+                variance_inv = 0
+                for (other_rating, other_rd), score in results:
+                    g = glicko_g(other_rd)
+                    expected = 1 / (1 + 10 ** (-g * (rating - other_rating) / 400))
+                    impact += g * (score - expected)
+                    variance_inv += GLICKO_Q ** 2 * g ** 2 * expected * (1 - expected)
+                
+                denominator = 1 / rd ** 2 + variance_inv
+                games[player] = [
+                    rating + GLICKO_Q / denominator * impact,
+                    max(math.sqrt(1 / denominator), MIN_RD),
+                    now
+                ]
+            self.pending += 1
+            due = self.pending >= self.snapshot_every
+        
+        if due:
+            try:
+                self.save()
+            except OSError as e:
+                print(f"[Rating] Failed to save snapshot: {e}")
+    
+    # ---------- 查詢 ----------
+    
+    def rating(self, game_id, username):
+        """玩家在遊戲中的積分 (沒有紀錄時為初始積分)"""
+        with self.lock:
+            entry = self.ratings.get(game_id, {}).get(username)
+            return entry[0] if entry else INITIAL_RATING
+    
+    def profile(self, game_id, username):
+        """玩家的積分、不確定度與是否已有紀錄"""
+        with self.lock:
+            rating, rd = self.current(game_id, username, time.time())
+            return {
+                "rating": round(rating, 1),
+                "rd": round(rd, 1),
+                "rated": username in self.ratings.get(game_id, {})
+            }
+    
+    def average(self, game_id, usernames):
+        """一組玩家的平均積分"""
+        if not usernames:
+            return None
+        with self.lock:
+            games = self.ratings.get(game_id, {})
+            return sum(games[name][0] if name in games else INITIAL_RATING for name in usernames) / len(usernames)
+    
+    def metrics(self):
+        with self.lock:
+            return {
+                "games": len(self.ratings),
+                "rated_players": sum(len(players) for players in self.ratings.values()),
+                "last_match_id": self.last_match_id,
+                "unsaved": self.pending,
+                "snapshots": self.snapshots
+            }
@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Game Store System - 房間註冊表
+集中管理所有遊戲房間，提供原子的加入/離開/準備狀態切換，並維護各種索引
+"""
+
+import time
+import uuid
+import threading
+from collections import OrderedDict, deque
+
+ROOM_STATUSES = ("waiting", "starting", "playing")
+# 每個房間保留的聊天訊息數量
+CHAT_HISTORY_SIZE = 50
+# 保留最近多少筆已刪除房間的紀錄，供增量查詢回報；更舊的查詢改回傳完整列表
+MAX_TOMBSTONES = 1024
+
+class Room:
+    """
+    單一房間的紀錄
+    使用 __slots__ 取代 dict，減少每個房間佔用的記憶體
+    """
+    __slots__ = (
+        "room_id", "game_id", "game_name", "game_version", "host",
+        "players", "player_set", "ready_players",
+        "max_players", "min_players", "status", "port", "agent_id", "server_host",
+        "created_at", "updated_at", "status_since", "chat_history", "chat_seq", "version_dir", "match_players", "attach_tokens", "closed", "revision", "lock"
+    )
+    
+    def __init__(self, room_id, game_id, game_name, game_version, host, max_players, min_players, port):
+        self.room_id = room_id
+        self.game_id = game_id
+        self.game_name = game_name
+        self.game_version = game_version
+        self.host = host
+        self.players = [host]       # 依加入順序排列，房主轉移時取第一位
+        self.player_set = {host}    # 成員檢查用
+        self.ready_players = set()
+        self.max_players = max_players
+        self.min_players = min_players
+        self.status = "waiting"
+        self.port = port
+        self.agent_id = None        # Game Server 所在的遊戲主機 (None 表示大廳本機)
+        self.server_host = None     # Client 連線的位址 (None 表示與大廳相同)
+        self.created_at = time.time()
+        self.updated_at = self.created_at    # 最後一次有玩家活動 (加入、準備、聊天等) 的時間
+        self.status_since = self.created_at  # 進入目前狀態的時間
+        self.chat_history = deque(maxlen=CHAT_HISTORY_SIZE)  # 環狀緩衝區，舊訊息自動淘汰
+        self.chat_seq = 0           # 最後一則訊息的序號
+        self.version_dir = None     # 遊戲進行中使用的版本目錄
+        self.match_players = []     # 這場遊戲開始時的玩家 (記錄對戰結果用)
+        self.attach_tokens = {}     # 託管遊戲中每位玩家連線時需附上的 token (username -> token)
+        self.closed = False         # 已從註冊表移除
+        self.revision = 0           # 最後一次異動時的註冊表版本
+        self.lock = threading.Lock()
+    
+    def summary(self):
+        """房間列表使用的摘要"""
+        with self.lock:
+            return {
+                "room_id": self.room_id,
+                "game_id": self.game_id,
+                "game_name": self.game_name,
+                "host": self.host,
+                "players": list(self.players),
+                "player_count": len(self.players),
+                "max_players": self.max_players,
+                "status": self.status,
+                "port": self.port,
+                "server_host": self.server_host,
+                "revision": self.revision
+            }
+    
+    def detail(self):
+        """單一房間的完整資訊 (GET_ROOM 使用)"""
+        with self.lock:
+            return {
+                "room_id": self.room_id,
+                "game_id": self.game_id,
+                "game_name": self.game_name,
+                "game_version": self.game_version,
+                "host": self.host,
+                "players": list(self.players),
+                "player_count": len(self.players),
+                "max_players": self.max_players,
+                "min_players": self.min_players,
+                "ready_players": [p for p in self.players if p in self.ready_players],
+                "status": self.status,
+                "port": self.port,
+                "server_host": self.server_host,
+                "revision": self.revision
+            }
+    
+    def add_chat(self, username, message, sent_time):
+        """
+        新增聊天訊息並回傳該筆紀錄 (含序號)
+        不在房間內時回傳 None
+        """
+        with self.lock:
+            if self.closed or username not in self.player_set:
+                return None
+            self.chat_seq += 1
+            self.updated_at = time.time()
+            entry = {
+                "seq": self.chat_seq,
+                "username": username,
+                "message": message,
+                "time": sent_time
+            }
+            self.chat_history.append(entry)
+            return entry
+    
+    def chat_since(self, after_seq=0, limit=None):
+        """
+        取得序號大於 after_seq 的訊息 (依序號排列)，limit 指定時只取最新的 limit 則
+        回傳 (messages, last_seq, truncated)，truncated 表示有訊息已被緩衝區淘汰
+        """
+        with self.lock:
+            messages = []
+            for entry in reversed(self.chat_history):
+                if entry["seq"] <= after_seq or (limit is not None and len(messages) >= limit):
+                    break
+                messages.append(entry)
+            messages.reverse()
+            
+            first_seq = self.chat_history[0]["seq"] if self.chat_history else self.chat_seq + 1
+            truncated = after_seq < first_seq - 1
+            return messages, self.chat_seq, truncated
+    
+    def matches(self, game_id=None, status=None, has_free_slot=False):
+        """是否符合 LIST_ROOMS 的篩選條件"""
+        if game_id is not None and self.game_id != game_id:
+            return False
+        if status is not None and self.status != status:
+            return False
+        if has_free_slot and len(self.players) >= self.max_players:
+            return False
+        return True
+
+class RoomRegistry:
+    """
+    房間註冊表
+    - 每個房間有自己的 lock，不同房間的操作互不阻塞
+    - 註冊表的 lock 只保護索引 (room_id、玩家、遊戲、狀態)
+    - 需要同時持有兩者時，一律先取房間 lock 再取註冊表 lock
+    - 每次異動都會遞增 revision，Client 可只查詢某個 revision 之後變動的房間
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rooms = {}        # room_id -> Room
+        self.user_rooms = {}   # username -> room_id (每人最多一間)
+        self.by_game = {}      # game_id -> {room_id, ...}
+        self.by_status = {status: set() for status in ROOM_STATUSES}
+        
+        self.epoch = uuid.uuid4().hex   # 註冊表實例 id (大廳重啟後改變)，revision 只在同一個 epoch 內可比較
+        self.revision = 0
+        self.changelog = OrderedDict()  # room_id -> Room，依最後異動順序排列 (最新在尾端)
+        self.tombstones = deque()       # (revision, room_id)，已刪除的房間
+        self.tombstone_floor = 0        # 已丟棄的刪除紀錄中最大的 revision
+    
+    def __len__(self):
+        return len(self.rooms)
+    
+    # ---------- 查詢 ----------
+    
+    def get(self, room_id):
+        """依 room_id 取得房間，不存在時回傳 None"""
+        return self.rooms.get(room_id)
+    
+    def room_of(self, username):
+        """取得玩家目前所在的房間"""
+        with self.lock:
+            return self.rooms.get(self.user_rooms.get(username))
+    
+    def find(self, game_id=None, status=None):
+        """依遊戲與狀態查詢房間 (使用索引，不掃描全部房間)，依建立時間排序"""
+        with self.lock:
+            return self.find_unlocked(game_id, status)
+    
+    def find_unlocked(self, game_id=None, status=None):
+        """同 find (需持有 self.lock)"""
+        if game_id is None and status is None:
+            return list(self.rooms.values())
+        
+        if game_id is not None:
+            ids = self.by_game.get(game_id, set())
+            if status is not None:
+                ids = ids & self.by_status.get(status, set())
+        else:
+            ids = self.by_status.get(status, set())
+        
+        found = [self.rooms[room_id] for room_id in ids]
+        found.sort(key=lambda room: room.created_at)
+        return found
+    
+    def changes(self, since_revision, game_id=None, status=None, has_free_slot=False, epoch=None):
+        """
+        取得 since_revision 之後變動的房間，回傳 (revision, rooms, removed, full)
+        - rooms: 變動且符合條件的房間
+        - removed: 已刪除、或變動後不再符合條件的 room_id
+        - full: since_revision 太舊 (刪除紀錄已丟棄)、無效，或 epoch 與目前不同時改回傳完整列表
+        """
+        with self.lock:
+            revision = self.revision
+            # 伺服器重啟後 revision 會從頭計算，epoch 不同或比目前還新的 revision 都視為需要完整列表
+            if (since_revision is None or (epoch is not None and epoch != self.epoch)
+                    or not self.tombstone_floor <= since_revision <= revision):
+                rooms = [
+                    room for room in self.find_unlocked(game_id, status)
+                    if room.matches(game_id, status, has_free_slot)
+                ]
+                return revision, rooms, [], True
+            
+            changed = []
+            for room in reversed(self.changelog.values()):
+                if room.revision <= since_revision:
+                    break
+                changed.append(room)
+            
+            removed = []
+            for tomb_revision, room_id in reversed(self.tombstones):
+                if tomb_revision <= since_revision:
+                    break
+                removed.append(room_id)
+        
+        rooms = []
+        for room in reversed(changed):
+            if room.matches(game_id, status, has_free_slot):
+                rooms.append(room)
+            else:
+                removed.append(room.room_id)
+        return revision, rooms, removed, False
+    
+    def has_active(self, game_id):
+        """遊戲是否有正在啟動或進行中的房間"""
+        with self.lock:
+            ids = self.by_game.get(game_id)
+            if not ids:
+                return False
+            return not ids.isdisjoint(self.by_status["starting"]) or not ids.isdisjoint(self.by_status["playing"])
+    
+    def stale(self, status, seconds, since="updated_at"):
+        """狀態為 status 且超過 seconds 秒沒有異動 (since="status_since" 時為進入該狀態的時間) 的房間"""
+        deadline = time.time() - seconds
+        with self.lock:
+            rooms = [self.rooms[room_id] for room_id in self.by_status[status]]
+        return [room for room in rooms if getattr(room, since) < deadline]
+    
+    def metrics(self):
+        """各狀態的房間數量"""
+        with self.lock:
+            return {
+                "total": len(self.rooms),
+                "players": len(self.user_rooms),
+                "revision": self.revision,
+                **{status: len(ids) for status, ids in self.by_status.items()}
+            }
+    
+    # ---------- 異動 ----------
+    
+    def create(self, room_id, host, game_id, game_name, game_version, max_players, min_players, port):
+        """建立房間，回傳 (room, error)"""
+        with self.lock:
+            if host in self.user_rooms:
+                return None, "您已在其他房間中"
+            if room_id in self.rooms:
+                return None, "房間 ID 重複，請重試"
+            
+            room = Room(room_id, game_id, game_name, game_version, host, max_players, min_players, port)
+            self.rooms[room_id] = room
+            self.user_rooms[host] = room_id
+            self.by_game.setdefault(game_id, set()).add(room_id)
+            self.by_status[room.status].add(room_id)
+            self._touch(room)
+        return room, None
+    
+    def join(self, room_id, username):
+        """加入房間 (檢查狀態與人數上限)，回傳 (room, error)"""
+        room = self.get(room_id)
+        if not room:
+            return None, "房間不存在"
+        
+        with room.lock:
+            if room.closed:
+                return None, "房間不存在"
+            if room.status != "waiting":
+                return None, "遊戲已經開始"
+            if len(room.players) >= room.max_players:
+                return None, "房間已滿"
+            
+            with self.lock:
+                current = self.user_rooms.get(username)
+                if current == room_id:
+                    return None, "您已在此房間中"
+                if current:
+                    return None, "您已在其他房間中"
+                self.user_rooms[username] = room_id
+                
+                room.players.append(username)
+                room.player_set.add(username)
+                self._touch(room)
+        return room, None
+    
+    def leave(self, room_id, username):
+        """
+        離開房間，回傳 (room, deleted, error)
+        deleted 為 True 代表房間已空並被移除，呼叫者需負責釋放 Port 等資源
+        """
+        room = self.get(room_id)
+        if not room:
+            return None, False, "房間不存在"
+        
+        with room.lock:
+            if room.closed or username not in room.player_set:
+                return None, False, "您不在此房間中"
+            deleted = self._remove_member(room, username)
+        return room, deleted, None
+    
+    def leave_current(self, username):
+        """玩家離開目前所在的房間 (斷線清理用)，回傳 (room, deleted)"""
+        room = self.room_of(username)
+        if not room:
+            return None, False
+        room, deleted, error = self.leave(room.room_id, username)
+        return room, deleted
+    
+    def mark_ready(self, room_id, username):
+        """
+        玩家準備，回傳 (room, all_ready, error)
+        最後一位玩家準備時房間轉為 starting，由該次呼叫負責啟動遊戲
+        """
+        room = self.get(room_id)
+        if not room:
+            return None, False, "房間不存在"
+        
+        with room.lock:
+            if room.closed:
+                return None, False, "房間不存在"
+            if username not in room.player_set:
+                return None, False, "您不在此房間中"
+            if len(room.players) < room.min_players:
+                return None, False, f"人數不足，至少需要 {room.min_players} 人"
+            if room.status != "waiting":
+                return None, False, "遊戲已經開始"
+            
+            room.ready_players.add(username)
+            if len(room.ready_players) < len(room.players):
+                with self.lock:
+                    self._touch(room)
+                return room, False, None
+            
+            self._set_status(room, "starting")
+        return room, True, None
+    
+    def set_status(self, room, status, expected=None):
+        """切換房間狀態並清空準備狀態；指定 expected 時只有目前狀態相符才切換"""
+        with room.lock:
+            if room.closed or (expected is not None and room.status != expected):
+                return False
+            self._set_status(room, status)
+            return True
+    
+    def set_port(self, room, port, agent_id=None, server_host=None):
+        """
+        更換房間的 Game Server Port (與所在的遊戲主機)
+        回傳舊的 (port, agent_id)，房間已移除時回傳 (None, None)
+        """
+        with room.lock:
+            if room.closed:
+                return None, None
+            old = (room.port, room.agent_id)
+            room.port = port
+            room.agent_id = agent_id
+            room.server_host = server_host
+            with self.lock:
+                self._touch(room)
+            return old
+    
+    def remove(self, room_id):
+        """直接移除房間 (不論成員)，回傳被移除的房間"""
+        room = self.get(room_id)
+        if not room:
+            return None
+        
+        with room.lock:
+            if room.closed:
+                return None
+            with self.lock:
+                self._unregister(room)
+        return room
+    
+    # ---------- 內部 (需持有對應的 lock) ----------
+    
+    def _remove_member(self, room, username):
+        """移除成員並維護索引，房間空了就移除 (需持有 room.lock)"""
+        room.players.remove(username)
+        room.player_set.discard(username)
+        room.ready_players.discard(username)
+        
+        with self.lock:
+            if self.user_rooms.get(username) == room.room_id:
+                del self.user_rooms[username]
+            if not room.players:
+                self._unregister(room)
+                return True
+            
+            # 如果是房主離開，轉移房主
+            if room.host == username:
+                room.host = room.players[0]
+                print(f"[Room] Host transferred to {room.host} in room {room.room_id}")
+            self._touch(room)
+        return False
+    
+    def _set_status(self, room, status):
+        """更新狀態索引 (需持有 room.lock)"""
+        with self.lock:
+            self.by_status[room.status].discard(room.room_id)
+            self.by_status[status].add(room.room_id)
+            room.status = status
+            room.status_since = time.time()
+            room.ready_players.clear()
+            self._touch(room)
+    
+    def _touch(self, room):
+        """遞增 revision 並將房間移到異動紀錄尾端 (需持有 self.lock)"""
+        self.revision += 1
+        room.revision = self.revision
+        room.updated_at = time.time()
+        self.changelog[room.room_id] = room
+        self.changelog.move_to_end(room.room_id)
+    
+    def _unregister(self, room):
+        """從所有索引移除房間 (需持有 room.lock 與 self.lock)"""
+        room.closed = True
+        del self.rooms[room.room_id]
+        self.changelog.pop(room.room_id, None)
+        
+        self.revision += 1
+        room.revision = self.revision
+        self.tombstones.append((self.revision, room.room_id))
+        while len(self.tombstones) > MAX_TOMBSTONES:
+            self.tombstone_floor = self.tombstones.popleft()[0]
+        
+        game_rooms = self.by_game.get(room.game_id)
+        if game_rooms is not None:
+            game_rooms.discard(room.room_id)
+            if not game_rooms:
+                del self.by_game[room.game_id]
+        
+        self.by_status[room.status].discard(room.room_id)
+        
+        for player in room.players:
+            if self.user_rooms.get(player) == room.room_id:
+                del self.user_rooms[player]
@@ -7,34 +7,134 @@ Game Store System - Main Server
 
 import socket
 import threading
+import time
 import json
+import math
 import os
-import sys
 import uuid
+import heapq
+import hmac
+import weakref
+import importlib.util
 import shutil
 import zipfile
-import subprocess
 from datetime import datetime
+from contextlib import contextmanager
 
 # 導入自定義的通訊協定
-from utils import send_json, recv_json, recv_file_with_metadata, create_response, send_file
+from utils import (send_json, recv_json, recv_file_with_metadata, create_response, send_file,
+                   build_manifest, hash_file, walk_files, is_safe_relpath, describe_file,
+                   MANIFEST_ALGORITHM, HASHINFO_SUFFIX)
+from port_allocator import PortAllocator, parse_port_ranges
+from room_registry import RoomRegistry
+from matchmaker import Matchmaker
+from game_supervisor import GameSupervisor, ResourceLimits
+from warm_pool import WarmPool
+from game_host import GameHost
+from agent_registry import AgentRegistry
+from game_channel import GameChannels, CONTROL_MESSAGE_TYPES
+from match_store import MatchStore
+from leaderboard import Leaderboards, LEADERBOARD_BOARDS
+from rating import RatingEngine
+from session_manager import SessionManager
+from rate_limiter import RateLimiter, CredentialCache, SingleFlight
 
 # ========================= 配置 =========================
 SERVER_HOST = '140.113.17.11'
 SERVER_PORT = 16969
 STORAGE_DIR = os.path.join(os.path.dirname(__file__), 'storage')
 DATABASE_FILE = os.path.join(os.path.dirname(__file__), 'database.json')
+MATCH_LOG_FILE = os.path.join(os.path.dirname(__file__), 'matches.jsonl')  # 對戰紀錄 (只附加)
+RATING_FILE = os.path.join(os.path.dirname(__file__), 'ratings.json')      # 積分快照
+GAME_LOG_DIR = os.path.join(os.path.dirname(__file__), 'logs', 'games')  # 每個房間的 Game Server 輸出
+GAME_LOG_MAX_BYTES = 1024 * 1024
+GAME_LOG_BACKUPS = 2
+# 已結束房間的 log 保留天數與最多保留的房間數 (可用 GAME_LOG_MAX_AGE_DAYS / GAME_LOG_MAX_ROOMS 覆寫，0 表示不限制)
+GAME_LOG_MAX_AGE = float(os.environ.get("GAME_LOG_MAX_AGE_DAYS", "7")) * 86400
+GAME_LOG_MAX_ROOMS = int(os.environ.get("GAME_LOG_MAX_ROOMS", "1000"))
+GAME_HOST_PORT = 16970  # 大廳內託管遊戲共用的 Port (只有 database.json 中 trusted_games 列出的遊戲會使用)
+GAME_AGENT_SECRET = os.environ.get("GAME_AGENT_SECRET", "")  # 遊戲主機註冊用的密鑰，未設定時只接受本機的遊戲主機
 
 # ========================= 全域變數 =========================
-db_lock = threading.Lock()
-active_sessions = {}  # session_id -> {"username": ..., "type": ..., "socket": ...}
-rooms = {}  # room_id -> {"game_id": ..., "players": [...], "status": ..., "port": ...}
-game_servers = {}  # room_id -> subprocess
+db_lock = threading.RLock()  # 可重入：update_database() 在持有鎖時呼叫 load_database() / save_database()
+# 登入中的使用者 (只存在記憶體，超過 SESSION_IDLE_TTL 秒沒有任何請求即過期，0 表示不過期；
+# 斷線後保留 SESSION_RESUME_GRACE 秒 (含房間) 等待以 RESUME 接回，0 表示斷線立即登出)
+sessions = SessionManager(idle_ttl=int(os.environ.get("SESSION_IDLE_TTL", str(12 * 3600))),
+                          resume_grace=int(os.environ.get("SESSION_RESUME_GRACE", "60")))
+# 註冊 / 登入的嘗試頻率：每個 IP 最多連續 20 次、每秒補 0.5 次 (每次嘗試都計入)；
+# 每個帳號最多連續失敗 5 次、每 10 秒補 1 次 (只計入登入失敗，成功登入與註冊不計入)
+login_ip_limiter = RateLimiter(rate=0.5, burst=20)
+login_user_limiter = RateLimiter(rate=0.1, burst=5)
+credential_cache = CredentialCache(max_entries=1024)  # 最近登入 / 註冊成功的帳密，重複登入不必讀取資料庫
+credential_loads = SingleFlight()  # 同時快取未命中的登入共用同一次資料庫讀取
+send_locks = weakref.WeakKeyDictionary()  # socket -> lock，避免回應與推播的封包交錯
+send_locks_guard = threading.Lock()
+transfer_queues = weakref.WeakKeyDictionary()  # socket -> 傳檔期間暫存的推播 (依序在傳檔結束後送出)
+room_registry = RoomRegistry()  # 所有遊戲房間 (含玩家、遊戲、狀態索引)
+match_store = MatchStore(MATCH_LOG_FILE)  # 對戰紀錄與玩家統計 (啟動時載入)
+ratings = RatingEngine(RATING_FILE)  # 各遊戲的 Glicko 積分 (需比排行榜先收到每一場)
+leaderboards = Leaderboards(ratings.rating, min_games=int(os.environ.get("LEADERBOARD_MIN_GAMES", "5")))  # 各遊戲排行榜
+match_store.subscribe(ratings.on_match)
+match_store.subscribe(leaderboards.on_match)
+# Game Server 的資源限制與預算 (GAME_CPU_SECONDS / GAME_MEMORY_MB / GAME_MAX_FILES / GAME_NICE / GAME_CPU_PERCENT / GAME_RSS_MB，0 表示不限制)
+GAME_LIMITS = ResourceLimits.from_env()
+game_supervisor = GameSupervisor(GAME_LOG_DIR, max_log_bytes=GAME_LOG_MAX_BYTES, backup_count=GAME_LOG_BACKUPS,
+                                 limits=GAME_LIMITS)
 
-# 動態分配的 Port 範圍
+# 預熱池：常被啟動的遊戲版本預先啟動的閒置 Game Server 數量上限 (預設 0 表示停用，以 GAME_WARM_POOL_SIZE 開啟)
+WARM_POOL_SIZE = int(os.environ.get("GAME_WARM_POOL_SIZE", "0"))
+warm_pool = WarmPool(game_supervisor, max_per_game=WARM_POOL_SIZE)
+
+# 大廳內託管的遊戲房間 (所有房間共用 GAME_HOST_PORT，第一次有託管房間時才開始監聽)
+game_host = GameHost(SERVER_HOST, GAME_HOST_PORT)
+game_host_lock = threading.Lock()
+hosted_classes = {}  # 版本目錄 -> 託管遊戲類別
+hosted_classes_lock = threading.Lock()
+# 解析房間要使用的版本與清理舊版本互斥，避免版本目錄在房間啟動前被刪除
+version_lock = threading.Lock()
+
+# 已註冊的遊戲主機 (game_agent.py)，有可用主機時 Game Server 配置到負載最低的主機
+agent_registry = AgentRegistry()
+
+# Game Server 的控制通道 (以每個房間的 token 驗證)，建立後超過這麼久沒有任何訊息視為無回應
+game_channels = GameChannels()
+CONTROL_SILENCE_TIMEOUT = 30
+
+# 快速配對：人數達下限後最多再等多久湊滿，以及排隊的最長時間 (秒)
+MATCH_WAIT_SECONDS = 10
+MATCH_MAX_WAIT_SECONDS = 120
+MATCH_WORKERS = int(os.environ.get("MATCH_WORKERS", "4"))  # 同時啟動成團組合的工作執行緒數
+matchmaker = Matchmaker(wait_seconds=MATCH_WAIT_SECONDS, max_wait_seconds=MATCH_MAX_WAIT_SECONDS,
+                        workers=MATCH_WORKERS)
+
+# 玩家玩過的遊戲：開始遊戲時只記在記憶體，由回收執行緒批次寫入資料庫的 played_games
+# (寫入後下一次批次確認資料庫中確實存在才移除，被其他請求的寫入覆蓋時會再補寫一次)
+played_lock = threading.Lock()
+played_pending = {}  # username -> 尚未確認寫入的 game_id 集合
+
+# 房間回收：檢查間隔、等待中房間多久沒有活動就解散 (可用 ROOM_IDLE_TTL 覆寫，0 表示不解散)、
+# Game Server 啟動後多久開始檢查 Port，以及連續幾次檢查不到才視為無回應
+REAPER_INTERVAL = 15
+LOG_PRUNE_PASSES = 240  # 每隔幾次回收清理一次舊的 Game Server log (約每小時)
+ROOM_IDLE_TTL = int(os.environ.get("ROOM_IDLE_TTL", "1800"))
+GAME_START_GRACE = 30
+UNRESPONSIVE_CHECKS = 3
+reaper_lock = threading.Lock()
+reaper_strikes = {}  # room_id -> 連續檢查不到 Port 的次數
+reaper_stats = {"passes": 0, "dead_servers": 0, "unresponsive_servers": 0, "idle_rooms": 0, "orphan_rooms": 0}
+
+# 動態分配的 Port 範圍 (可用 GAME_PORT_RANGES="12000-13000,14000-14100" 覆寫，不含終點)
 GAME_PORT_START = 12000
 GAME_PORT_END = 13000
-used_ports = set()
+GAME_PORT_RANGES = parse_port_ranges(os.environ.get("GAME_PORT_RANGES", f"{GAME_PORT_START}-{GAME_PORT_END}"))
+PORT_QUARANTINE_SECONDS = 30  # 釋放後多久才重新分配
+PORT_BIND_PROBE = True        # 分配前實際 bind 檢查 Port 是否被佔用
+
+port_allocator = PortAllocator(
+    GAME_PORT_RANGES,
+    quarantine_seconds=PORT_QUARANTINE_SECONDS,
+    probe_host=SERVER_HOST if PORT_BIND_PROBE else None
+)
 
 # ========================= 資料庫操作 =========================
 
@@ -75,14 +175,43 @@ def save_database(db):
         with open(DATABASE_FILE, 'w', encoding='utf-8') as f:
             json.dump(db, f, indent=4, ensure_ascii=False)
 
+def update_database(mutate):
+    """在同一把鎖內讀取、修改、儲存資料庫；mutate(db) 回傳 False 時不寫回"""
+    with db_lock:
+        db = load_database()
+        if mutate(db) is not False:
+            save_database(db)
+        return db
+
 # ========================= 帳號系統 =========================
 
-def handle_register(request, user_type):
+def check_login_rate(client_address, user_type=None, username=None):
+    """
+    註冊 / 登入前檢查嘗試頻率，超過時回傳拒絕的回應 (不讀取資料庫)
+    每次嘗試都計入 IP；有帳號時另外檢查該帳號最近的登入失敗次數 (只檢查，失敗時由 record_login_failure 計入)
+    """
+    allowed, wait = login_ip_limiter.allow(client_address[0] if client_address else None)
+    if allowed and username:
+        wait = login_user_limiter.wait_time((user_type, username))
+        allowed = not wait
+    if allowed:
+        return None
+    return create_response(False, f"嘗試次數過多，請 {math.ceil(wait)} 秒後再試", {"retry_after": math.ceil(wait)})
+
+def record_login_failure(user_type, username):
+    """登入失敗，計入帳號的嘗試次數"""
+    login_user_limiter.allow((user_type, username))
+
+def handle_register(request, user_type, client_address=None):
     """處理註冊請求"""
     username = request.get("username", "").strip()
     password = request.get("password", "").strip()
     display_name = request.get("display_name", username)
     
+    rejected = check_login_rate(client_address)
+    if rejected:
+        return rejected
+    
     if not username or not password:
         return create_response(False, "帳號和密碼不可為空")
     
@@ -101,8 +230,7 @@ def handle_register(request, user_type):
     users[username] = {
         "password": password,
         "display_name": display_name,
-        "created_at": datetime.now().isoformat(),
-        "session_id": None
+        "created_at": datetime.now().isoformat()
     }
     
     if user_type == "players":
@@ -110,88 +238,365 @@ def handle_register(request, user_type):
     
     db[user_type] = users
     save_database(db)
+    # 註冊後通常緊接著登入，直接放進快取 (也避免登入共用到註冊前開始的資料庫讀取)
+    credential_cache.store(user_type, username, password, {"display_name": display_name})
     
     print(f"[Register] New {user_type[:-1]}: {username}")
     return create_response(True, "註冊成功")
 
-def handle_login(request, user_type, client_socket):
+def handle_login(request, user_type, client_socket, client_address=None):
     """處理登入請求"""
     username = request.get("username", "").strip()
     password = request.get("password", "").strip()
     
+    rejected = check_login_rate(client_address, user_type, username)
+    if rejected:
+        return rejected
+    
     if not username or not password:
         return create_response(False, "帳號和密碼不可為空")
     
-    db = load_database()
-    users = db.get(user_type, {})
-    
-    if username not in users:
-        return create_response(False, "帳號不存在，請先註冊")
-    
-    if users[username]["password"] != password:
-        return create_response(False, "密碼錯誤")
-    
-    # 檢查是否已有 session（踢掉舊的）
-    old_session = users[username].get("session_id")
-    if old_session and old_session in active_sessions:
-        old_socket = active_sessions[old_session].get("socket")
-        if old_socket:
-            try:
-                send_json(old_socket, {
-                    "type": "FORCE_LOGOUT",
-                    "message": "您的帳號已在其他裝置登入"
-                })
-                old_socket.close()
-            except:
-                pass
-        del active_sessions[old_session]
-    
-    # 產生新 session
-    session_id = str(uuid.uuid4())
-    users[username]["session_id"] = session_id
-    db[user_type] = users
-    save_database(db)
+    # 最近登入成功過的帳密直接比對快取，否則查詢資料庫 (同時未命中的登入共用同一次讀取，users 為唯讀)
+    profile = credential_cache.check(user_type, username, password)
+    if profile is None:
+        users = credential_loads.do(user_type, lambda: load_database().get(user_type, {}))
+        
+        if username not in users:
+            record_login_failure(user_type, username)
+            return create_response(False, "帳號不存在，請先註冊")
+        
+        if users[username]["password"] != password:
+            record_login_failure(user_type, username)
+            return create_response(False, "密碼錯誤")
+        
+        profile = {"display_name": users[username]["display_name"]}
+        credential_cache.store(user_type, username, password, profile)
     
-    active_sessions[session_id] = {
-        "username": username,
-        "type": user_type,
-        "socket": client_socket
-    }
+    # 產生新 session (取代已有的 session，並踢掉舊的連線)
+    session, old = sessions.create(user_type, username, client_socket)
+    if old and old.socket and old.socket is not client_socket:
+        try:
+            send_to_client(old.socket, {
+                "type": "FORCE_LOGOUT",
+                "message": "您的帳號已在其他裝置登入"
+            })
+            old.socket.close()
+        except:
+            pass
     
     print(f"[Login] {user_type[:-1]} logged in: {username}")
     
     return create_response(True, "登入成功", {
-        "session_id": session_id,
+        "session_id": session.session_id,
         "username": username,
-        "display_name": users[username]["display_name"]
+        "display_name": profile["display_name"]
     })
 
 def handle_logout(request, user_type):
     """處理登出請求"""
-    session_id = request.get("session_id")
+    session = sessions.remove(request.get("session_id"))
     
-    if session_id in active_sessions:
-        username = active_sessions[session_id]["username"]
-        del active_sessions[session_id]
-        
-        db = load_database()
-        if username in db.get(user_type, {}):
-            db[user_type][username]["session_id"] = None
-            save_database(db)
+    if session:
+        username = session.username
+        matchmaker.cancel(username)
         
         print(f"[Logout] {user_type[:-1]} logged out: {username}")
         return create_response(True, "登出成功")
     
     return create_response(False, "Session 不存在")
 
+def handle_resume(request, user_type, client_socket):
+    """斷線重連：把這條連線接回既有的 Session，保留房間與配對以外的所有狀態"""
+    session, old_socket = sessions.resume(request.get("session_id"), user_type, client_socket)
+    if not session:
+        return create_response(False, "Session 已過期，請重新登入")
+    
+    # 舊連線可能還沒偵測到中斷，直接關閉
+    if old_socket and old_socket is not client_socket:
+        try:
+            old_socket.close()
+        except OSError:
+            pass
+    
+    data = {"session_id": session.session_id, "username": session.username, "room": None}
+    if user_type == "players":
+        room = room_registry.room_of(session.username)
+        if room:
+            data["room"] = room.detail()
+    
+    print(f"[Resume] {user_type[:-1]} reconnected: {session.username}")
+    return create_response(True, "已恢復連線", data)
+
 def verify_session(session_id, user_type):
     """驗證 Session"""
-    if session_id not in active_sessions:
+    return sessions.verify(session_id, user_type)
+
+# ========================= 遊戲版本儲存 =========================
+# 每個遊戲的檔案依版本存放在 storage/<game_id>/<version>/，
+# storage/<game_id>/CURRENT 記錄目前上架的版本目錄名稱。
+# 新版本在 .incoming-* 暫存目錄接收並驗證完成後，才以 os.replace 原子地切換指標，
+# 因此上傳中或上傳失敗都不會影響正在建立/進行的房間。
+# 每個版本另有 <version>.manifest.json 檔案清單，供開發者增量上傳比對，
+# 以及第一次下載時打包的 <version>.zip (雜湊值快取在 .zip.hashinfo.json)。
+
+CURRENT_POINTER = 'CURRENT'
+MANIFEST_SUFFIX = '.manifest.json'
+ARTIFACT_SUFFIX = '.zip'
+VERSION_SIDECAR_SUFFIXES = (ARTIFACT_SUFFIX + HASHINFO_SUFFIX, MANIFEST_SUFFIX, ARTIFACT_SUFFIX)
+artifact_builds = SingleFlight()  # 同一個版本同時只打包一次，不同版本互不等待
+
+def get_game_storage(game_id):
+    """取得遊戲的儲存根目錄"""
+    return os.path.join(STORAGE_DIR, game_id)
+
+def version_dir_name(version):
+    """將版本號轉成安全的目錄名稱"""
+    safe = "".join(c if c.isalnum() or c in "._-" else "_" for c in version).strip(".")
+    return safe or "unversioned"
+
+def read_current_version(game_storage):
+    """讀取 current 指標，回傳目前版本的目錄名稱 (沒有則回傳 None)"""
+    try:
+        with open(os.path.join(game_storage, CURRENT_POINTER), 'r', encoding='utf-8') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
         return None
-    session = active_sessions[session_id]
-    if session["type"] != user_type:
+
+def write_current_version(game_storage, version_dir):
+    """原子地切換 current 指標 (先寫暫存檔再 os.replace)"""
+    tmp_path = os.path.join(game_storage, f".{CURRENT_POINTER}.{uuid.uuid4().hex}")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(version_dir)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(game_storage, CURRENT_POINTER))
+
+def resolve_game_dir(game_storage, version_dir=None):
+    """
+    取得遊戲檔案目錄
+    未指定版本時依 current 指標，並相容舊版的 game/ 與直接存放結構
+    """
+    if version_dir is None:
+        version_dir = read_current_version(game_storage)
+    if version_dir:
+        path = os.path.join(game_storage, version_dir)
+        if os.path.isdir(path):
+            return path
+    legacy_dir = os.path.join(game_storage, 'game')
+    if os.path.isdir(legacy_dir):
+        return legacy_dir
+    if os.path.exists(os.path.join(game_storage, 'config.json')):
+        return game_storage
+    return None
+
+def validate_game_dir(game_dir):
+    """驗證遊戲檔案結構，回傳 (config, 錯誤訊息)"""
+    config_path = os.path.join(game_dir, 'config.json')
+    if not os.path.exists(config_path):
+        return None, "缺少 config.json 設定檔"
+    
+    try:
+        with open(config_path, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    except json.JSONDecodeError:
+        return None, "config.json 格式錯誤"
+    except Exception as e:
+        return None, f"驗證失敗: {e}"
+    
+    required_fields = ["name", "version", "server_command", "client_command"]
+    missing = [field for field in required_fields if field not in config]
+    if missing:
+        return None, f"config.json 缺少必要欄位: {', '.join(missing)}"
+    
+    if not isinstance(config.get("server_command"), list) or not isinstance(config.get("client_command"), list):
+        return None, "server_command 與 client_command 必須是列表 (List)"
+    
+    return config, None
+
+def load_version_manifest(game_storage, version_dir):
+    """讀取版本的檔案清單，舊版本沒有清單時即時建立並存檔"""
+    if version_dir:
+        try:
+            with open(os.path.join(game_storage, version_dir + MANIFEST_SUFFIX), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+    
+    game_dir = resolve_game_dir(game_storage, version_dir)
+    if not game_dir:
         return None
-    return session["username"]
+    
+    manifest = build_manifest(game_dir)
+    if game_dir != game_storage:
+        save_version_manifest(game_storage, os.path.basename(game_dir), manifest)
+    return manifest
+
+def save_version_manifest(game_storage, version_dir, manifest):
+    """儲存版本的檔案清單"""
+    tmp_path = os.path.join(game_storage, f".manifest.{uuid.uuid4().hex}")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, os.path.join(game_storage, version_dir + MANIFEST_SUFFIX))
+
+def assemble_incremental_version(extract_dir, manifest, game_storage):
+    """
+    依開發者送來的完整檔案清單補齊增量上傳中沒有附上的檔案
+    未變更的檔案從目前版本以硬連結沿用 (版本目錄寫入後不再修改，可安全共用)
+    回傳錯誤訊息，成功時回傳 None
+    """
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("files"), dict):
+        return "檔案清單格式錯誤"
+    if manifest.get("algorithm") != MANIFEST_ALGORITHM:
+        return "不支援的檔案清單雜湊演算法"
+    
+    files = manifest["files"]
+    base_version = read_current_version(game_storage)
+    base_dir = resolve_game_dir(game_storage, base_version)
+    base_files = {}
+    if base_dir:
+        base_files = (load_version_manifest(game_storage, base_version) or {}).get("files", {})
+    
+    # 清單以外的檔案不屬於新版本
+    for rel_path, file_path in list(walk_files(extract_dir)):
+        if rel_path not in files:
+            os.remove(file_path)
+    
+    for rel_path, info in files.items():
+        if not is_safe_relpath(rel_path):
+            return f"不合法的檔案路徑: {rel_path}"
+        
+        target = os.path.join(extract_dir, *rel_path.split('/'))
+        if os.path.exists(target):
+            if hash_file(target) != info.get("hash"):
+                return f"檔案驗證失敗: {rel_path}"
+            continue
+        
+        base_info = base_files.get(rel_path)
+        if not base_info or base_info.get("hash") != info.get("hash"):
+            return f"缺少檔案: {rel_path}"
+        
+        source = os.path.join(base_dir, *rel_path.split('/'))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copy2(source, target)
+    
+    return None
+
+def receive_game_version(client_socket, game_storage, version, manifest=None):
+    """
+    接收遊戲壓縮檔並建立新的版本目錄 (尚未切換 current 指標)
+    manifest 不為 None 時為增量上傳：壓縮檔只包含變更的檔案，其餘依清單從目前版本沿用
+    回傳 (成功與否, 訊息, 版本目錄名稱)
+    """
+    incoming_dir = os.path.join(game_storage, f".incoming-{uuid.uuid4().hex[:8]}")
+    os.makedirs(incoming_dir, exist_ok=True)
+    
+    try:
+        file_meta = recv_json(client_socket)
+        if not file_meta or file_meta.get("type") != "FILE_TRANSFER":
+            return False, "未收到檔案", None
+        
+        success, msg, file_path = recv_file_with_metadata(client_socket, file_meta, incoming_dir)
+        if not success:
+            return False, f"檔案傳輸失敗: {msg}", None
+        
+        extract_dir = os.path.join(incoming_dir, 'game')
+        os.makedirs(extract_dir, exist_ok=True)
+        try:
+            with zipfile.ZipFile(file_path, 'r') as zip_ref:
+                zip_ref.extractall(extract_dir)
+        except Exception as e:
+            return False, f"解壓縮失敗: {e}", None
+        
+        if manifest is not None:
+            error = assemble_incremental_version(extract_dir, manifest, game_storage)
+            if error:
+                return False, error, None
+        else:
+            manifest = build_manifest(extract_dir)
+        
+        config, error = validate_game_dir(extract_dir)
+        if error:
+            return False, error, None
+        
+        # 同名版本目錄可能仍被舊房間使用，改用不重複的名稱
+        version_dir = version_dir_name(version)
+        if os.path.exists(os.path.join(game_storage, version_dir)):
+            version_dir = f"{version_dir}-{uuid.uuid4().hex[:6]}"
+        os.rename(extract_dir, os.path.join(game_storage, version_dir))
+        save_version_manifest(game_storage, version_dir, manifest)
+        
+        return True, "接收成功", version_dir
+    finally:
+        shutil.rmtree(incoming_dir, ignore_errors=True)
+
+def get_download_artifact(game_storage, game_dir):
+    """
+    取得版本的下載用 zip，每個版本只打包一次
+    打包完成時一併計算並快取雜湊值，之後每次傳送都不必重新計算
+    (同一個版本同時下載時共用同一次打包，其他版本的下載不必等待)
+    """
+    version_dir = os.path.basename(game_dir) if game_dir != game_storage else 'game'
+    zip_path = os.path.join(game_storage, version_dir + ARTIFACT_SUFFIX)
+    
+    def build():
+        if not os.path.exists(zip_path):
+            tmp_path = os.path.join(game_storage, f".artifact-{uuid.uuid4().hex[:8]}.zip")
+            try:
+                with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+                    for arcname, file_path in walk_files(game_dir):
+                        zipf.write(file_path, arcname)
+                os.replace(tmp_path, zip_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        
+        describe_file(zip_path)
+    
+    artifact_builds.do(zip_path, build)
+    return zip_path
+
+def gc_game_versions(game_id):
+    """刪除不是目前版本、也沒有房間 (啟動中或進行中) 或預熱 process 正在使用的舊版本目錄"""
+    with version_lock:
+        remove_unused_versions(game_id)
+
+def remove_unused_versions(game_id):
+    """gc_game_versions 的實作 (需持有 version_lock)"""
+    game_storage = get_game_storage(game_id)
+    current = read_current_version(game_storage)
+    if not current or not os.path.isdir(game_storage):
+        return
+    
+    in_use = warm_pool.versions(game_id)
+    for status in ("starting", "playing"):
+        for room in room_registry.find(game_id, status):
+            with room.lock:
+                in_use.add(room.version_dir)
+    
+    for entry in os.listdir(game_storage):
+        path = os.path.join(game_storage, entry)
+        if entry.startswith('.'):
+            continue
+        if os.path.isdir(path):
+            version_dir = entry
+        else:
+            suffix = next((suffix for suffix in VERSION_SIDECAR_SUFFIXES if entry.endswith(suffix)), None)
+            if not suffix:
+                continue
+            version_dir = entry[:-len(suffix)]
+        if version_dir == current or version_dir in in_use:
+            continue
+        
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+            with hosted_classes_lock:
+                hosted_classes.pop(path, None)
+            print(f"[Storage] Removed old version {entry} of game {game_id}")
+        else:
+            os.remove(path)
 
 # ========================= 遊戲管理 (Developer) =========================
 
@@ -220,81 +625,49 @@ def handle_upload_game(request, client_socket):
     game_id = str(uuid.uuid4())[:8]
     
     # 準備儲存目錄
-    game_storage = os.path.join(STORAGE_DIR, game_id)
+    game_storage = get_game_storage(game_id)
     os.makedirs(game_storage, exist_ok=True)
+    version = game_info.get("version", "1.0.0")
     
     # 通知 Client 可以開始傳送檔案
     send_json(client_socket, create_response(True, "準備接收檔案", {"game_id": game_id}))
     
-    # 接收檔案
-    file_meta = recv_json(client_socket)
-    if not file_meta or file_meta.get("type") != "FILE_TRANSFER":
-        shutil.rmtree(game_storage, ignore_errors=True)
-        return create_response(False, "未收到檔案")
-    
-    success, msg, file_path = recv_file_with_metadata(client_socket, file_meta, game_storage)
+    # 接收檔案並驗證
+    success, msg, version_dir = receive_game_version(client_socket, game_storage, version)
     
     if not success:
         shutil.rmtree(game_storage, ignore_errors=True)
-        return create_response(False, f"檔案傳輸失敗: {msg}")
-    
-    # 如果是 zip 檔，解壓縮
-    if file_path.endswith('.zip'):
-        try:
-            extract_dir = os.path.join(game_storage, 'game')
-            with zipfile.ZipFile(file_path, 'r') as zip_ref:
-                zip_ref.extractall(extract_dir)
-            os.remove(file_path)
-        except Exception as e:
-            shutil.rmtree(game_storage, ignore_errors=True)
-            return create_response(False, f"解壓縮失敗: {e}")
-    
-    # 驗證遊戲檔案結構
-    extract_dir = os.path.join(game_storage, 'game')
-    config_path = os.path.join(extract_dir, 'config.json')
-    if not os.path.exists(config_path):
+        return create_response(False, msg)
+    
+    write_current_version(game_storage, version_dir)
+    
+    # 儲存遊戲資訊到資料庫 (接收檔案期間資料庫可能已被修改，重新讀取並再檢查一次名稱)
+    registered = []
+    
+    def register(db):
+        for game in db.get("games", {}).values():
+            if game["name"] == game_name and game.get("status") == "active":
+                return False
+        db["games"][game_id] = {
+            "name": game_name,
+            "description": game_info.get("description", "尚未提供簡介"),
+            "developer": username,
+            "version": version,
+            "game_type": game_info.get("game_type", "CLI"),
+            "max_players": game_info.get("max_players", 2),
+            "min_players": game_info.get("min_players", 2),
+            "created_at": datetime.now().isoformat(),
+            "updated_at": datetime.now().isoformat(),
+            "status": "active",
+            "storage_path": game_storage,
+            "download_count": 0
+        }
+        registered.append(game_id)
+    
+    update_database(register)
+    if not registered:
         shutil.rmtree(game_storage, ignore_errors=True)
-        return create_response(False, "缺少 config.json 設定檔")
-    
-    try:
-        with open(config_path, 'r', encoding='utf-8') as f:
-            config = json.load(f)
-            
-        required_fields = ["name", "version", "server_command", "client_command"]
-        missing = [field for field in required_fields if field not in config]
-        
-        if missing:
-            shutil.rmtree(game_storage, ignore_errors=True)
-            return create_response(False, f"config.json 缺少必要欄位: {', '.join(missing)}")
-            
-        if not isinstance(config.get("server_command"), list) or not isinstance(config.get("client_command"), list):
-             shutil.rmtree(game_storage, ignore_errors=True)
-             return create_response(False, "server_command 與 client_command 必須是列表 (List)")
-
-    except json.JSONDecodeError:
-        shutil.rmtree(game_storage, ignore_errors=True)
-        return create_response(False, "config.json 格式錯誤")
-    except Exception as e:
-        shutil.rmtree(game_storage, ignore_errors=True)
-        return create_response(False, f"驗證失敗: {e}")
-
-    # 儲存遊戲資訊到資料庫
-    db["games"][game_id] = {
-        "name": game_name,
-        "description": game_info.get("description", "尚未提供簡介"),
-        "developer": username,
-        "version": game_info.get("version", "1.0.0"),
-        "game_type": game_info.get("game_type", "CLI"),
-        "max_players": game_info.get("max_players", 2),
-        "min_players": game_info.get("min_players", 2),
-        "created_at": datetime.now().isoformat(),
-        "updated_at": datetime.now().isoformat(),
-        "status": "active",
-        "storage_path": game_storage,
-        "download_count": 0
-    }
-    
-    save_database(db)
+        return create_response(False, "遊戲名稱已存在")
     
     print(f"[Upload] Game uploaded: {game_name} by {username}")
     return create_response(True, "遊戲上架成功", {"game_id": game_id})
@@ -329,79 +702,58 @@ def handle_update_game(request, client_socket):
     if new_version == game["version"]:
         return create_response(False, "版本號不可與目前版本相同")
     
-    # 準備儲存目錄
-    game_storage = game["storage_path"]
-    
-    # 清除舊檔案
-    game_dir = os.path.join(game_storage, 'game')
-    if os.path.exists(game_dir):
-        shutil.rmtree(game_dir)
+    # 準備儲存目錄 (舊版本檔案保留，直到沒有房間使用)
+    game_storage = get_game_storage(game_id)
+    os.makedirs(game_storage, exist_ok=True)
     
     # 通知 Client 可以開始傳送檔案
     send_json(client_socket, create_response(True, "準備接收檔案"))
     
-    # 接收檔案
-    file_meta = recv_json(client_socket)
-    if not file_meta or file_meta.get("type") != "FILE_TRANSFER":
-        return create_response(False, "未收到檔案")
-    
-    success, msg, file_path = recv_file_with_metadata(client_socket, file_meta, game_storage)
+    # 接收檔案並驗證，失敗時目前版本維持不變
+    # 有附上檔案清單時為增量上傳，壓縮檔只包含變更的檔案
+    manifest = request.get("manifest")
+    success, msg, version_dir = receive_game_version(client_socket, game_storage, new_version, manifest)
     
     if not success:
-        return create_response(False, f"檔案傳輸失敗: {msg}")
-    
-    # 如果是 zip 檔，解壓縮
-    if file_path.endswith('.zip'):
-        try:
-            extract_dir = os.path.join(game_storage, 'game')
-            with zipfile.ZipFile(file_path, 'r') as zip_ref:
-                zip_ref.extractall(extract_dir)
-            os.remove(file_path)
-        except Exception as e:
-            return create_response(False, f"解壓縮失敗: {e}")
+        return create_response(False, msg)
     
-    # 驗證遊戲檔案結構
-    extract_dir = os.path.join(game_storage, 'game')
-    config_path = os.path.join(extract_dir, 'config.json')
-    if not os.path.exists(config_path):
-        return create_response(False, "缺少 config.json 設定檔")
+    # 驗證通過，更新版本資訊並切換 current 指標
+    # (接收檔案期間資料庫可能已被修改，重新讀取並再檢查一次遊戲狀態)
+    updated = []
     
-    try:
-        with open(config_path, 'r', encoding='utf-8') as f:
-            config = json.load(f)
-            
-        required_fields = ["name", "version", "server_command", "client_command"]
-        missing = [field for field in required_fields if field not in config]
+    def apply_update(db):
+        game = db.get("games", {}).get(game_id)
+        if not game or game["developer"] != username or game["status"] != "active":
+            return False
         
-        if missing:
-            return create_response(False, f"config.json 缺少必要欄位: {', '.join(missing)}")
-            
-        if not isinstance(config.get("server_command"), list) or not isinstance(config.get("client_command"), list):
-             return create_response(False, "server_command 與 client_command 必須是列表 (List)")
-
-    except json.JSONDecodeError:
-        return create_response(False, "config.json 格式錯誤")
-    except Exception as e:
-        return create_response(False, f"驗證失敗: {e}")
-
-    # 更新版本資訊
-    game["version"] = new_version
-    game["updated_at"] = datetime.now().isoformat()
-    
-    if "update_notes" in request:
-        if "update_history" not in game:
-            game["update_history"] = []
-        game["update_history"].append({
-            "version": new_version,
-            "notes": request["update_notes"],
-            "date": datetime.now().isoformat()
-        })
+        write_current_version(game_storage, version_dir)
+        game["version"] = new_version
+        game["updated_at"] = datetime.now().isoformat()
+        
+        if "update_notes" in request:
+            if "update_history" not in game:
+                game["update_history"] = []
+            game["update_history"].append({
+                "version": new_version,
+                "notes": request["update_notes"],
+                "date": datetime.now().isoformat()
+            })
+        updated.append(game)
     
-    db["games"][game_id] = game
-    save_database(db)
+    update_database(apply_update)
+    if not updated:
+        # 沒有切換到新版本，剛收到的版本目錄由清理時移除
+        gc_game_versions(game_id)
+        return create_response(False, "遊戲已下架，無法更新")
+    
+    game = updated[0]
+    warm_pool.evict(game_id, keep_version_dir=version_dir)
     
     print(f"[Update] Game updated: {game['name']} to version {new_version}")
     
+    # 清理沒有房間使用的舊版本
+    gc_game_versions(game_id)
+    
     # 通知所有在線玩家有新版本
     broadcast_update_notification(game['name'], new_version)
     
@@ -416,12 +768,42 @@ def broadcast_update_notification(game_name, version):
         "message": f"📢 遊戲 [{game_name}] 已更新至 v{version}！"
     }
     
-    for session_id, session in active_sessions.items():
-        if session["type"] == "players":
-            try:
-                send_json(session["socket"], message)
-            except:
-                pass
+    for _, client_socket in sessions.online("players"):
+        try:
+            send_to_client(client_socket, message)
+        except:
+            pass
+
+def handle_get_game_manifest(request):
+    """取得遊戲目前版本的檔案清單 (供開發者增量上傳比對)"""
+    session_id = request.get("session_id")
+    username = verify_session(session_id, "developers")
+    
+    if not username:
+        return create_response(False, "請先登入")
+    
+    game_id = request.get("game_id")
+    
+    db = load_database()
+    
+    if game_id not in db.get("games", {}):
+        return create_response(False, "遊戲不存在")
+    
+    game = db["games"][game_id]
+    
+    if game["developer"] != username:
+        return create_response(False, "無權限查詢此遊戲")
+    
+    game_storage = get_game_storage(game_id)
+    manifest = load_version_manifest(game_storage, read_current_version(game_storage))
+    
+    if not manifest:
+        return create_response(False, "遊戲檔案不存在")
+    
+    return create_response(True, "查詢成功", {
+        "version": game["version"],
+        "manifest": manifest
+    })
 
 def handle_unpublish_game(request):
     """處理遊戲下架請求"""
@@ -447,14 +829,14 @@ def handle_unpublish_game(request):
         return create_response(False, "遊戲已經是下架狀態")
     
     # 檢查是否有進行中的房間
-    for room_id, room in rooms.items():
-        if room["game_id"] == game_id and room["status"] == "playing":
-            return create_response(False, "有進行中的遊戲房間，無法下架")
+    if room_registry.has_active(game_id):
+        return create_response(False, "有進行中的遊戲房間，無法下架")
     
     game["status"] = "unpublished"
     game["unpublished_at"] = datetime.now().isoformat()
     db["games"][game_id] = game
     save_database(db)
+    warm_pool.evict(game_id)
     
     print(f"[Unpublish] Game unpublished: {game['name']} by {username}")
     return create_response(True, "遊戲已下架")
@@ -570,40 +952,38 @@ def handle_download_game(request, client_socket):
     if game["status"] != "active":
         return create_response(False, "遊戲已下架，無法下載")
     
-    game_storage = game["storage_path"]
-    game_dir = os.path.join(game_storage, 'game')
+    game_storage = get_game_storage(game_id)
+    game_dir = resolve_game_dir(game_storage)
     
-    if not os.path.exists(game_dir):
+    if not game_dir:
         return create_response(False, "遊戲檔案不存在")
     
-    # 將遊戲目錄打包成 zip
-    zip_path = os.path.join(game_storage, f'{game_id}.zip')
-    
+    # 取得此版本的下載檔 (每個版本只打包一次)
     try:
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, dirs, files in os.walk(game_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, game_dir)
-                    zipf.write(file_path, arcname)
+        zip_path = get_download_artifact(game_storage, game_dir)
     except Exception as e:
         return create_response(False, f"打包失敗: {e}")
     
-    # 傳送檔案資訊給 Client
+    # 傳送檔案資訊給 Client (附上下載檔摘要，Client 本機快取已有時不必重新下載)
     from utils import send_file
     
+    artifact = describe_file(zip_path)
     send_json(client_socket, create_response(True, "準備傳送檔案", {
         "game_id": game_id,
         "game_name": game["name"],
-        "version": game["version"]
+        "version": game["version"],
+        "hash": artifact["hash"],
+        "digest": artifact["digest"]
     }))
     
     # 等待 Client 確認
     ack = recv_json(client_socket)
-    if not ack or ack.get("status") != "READY":
-        return create_response(False, "Client 未準備好")
-    
-    success, msg = send_file(client_socket, zip_path)
+    if ack and ack.get("status") == "CACHED":
+        success = True
+    elif not ack or ack.get("status") != "READY":
+        return None  # Client 取消下載
+    else:
+        success, msg = send_file(client_socket, zip_path)
     
     if success:
         # 更新下載次數
@@ -612,27 +992,209 @@ def handle_download_game(request, client_socket):
         save_database(db)
         print(f"[Download] {username} downloaded {game['name']}")
     
-    # 清理臨時 zip 檔
-    try:
-        os.remove(zip_path)
-    except:
+    return None  # 回應已在 send_file 中處理
+
+# ========================= 推播通知 =========================
+
+def client_send_lock(client_socket):
+    """取得 socket 的寫入 lock (同一條連線的回應與推播必須逐一送出)"""
+    with send_locks_guard:
+        lock = send_locks.get(client_socket)
+        if lock is None:
+            lock = send_locks[client_socket] = threading.RLock()
+        return lock
+
+def send_to_client(client_socket, message):
+    """加鎖後送出訊息 (連線正在傳檔時先暫存，傳檔結束後才送出，不等待傳檔)"""
+    with client_send_lock(client_socket):
+        with send_locks_guard:
+            pending = transfer_queues.get(client_socket)
+            if pending is not None:
+                pending.append(message)
+                return True
+        return send_json(client_socket, message)
+
+@contextmanager
+def client_transfer(client_socket):
+    """
+    連線的傳檔區段 (可能要等待對方回覆，耗時不定)
+    期間其他執行緒的推播放進佇列，不持有寫入 lock，因此不會卡住推播的執行緒
+    """
+    with send_locks_guard:
+        transfer_queues[client_socket] = []
+    # 等待進行中的推播送完，之後的推播都會進入佇列
+    with client_send_lock(client_socket):
         pass
     
-    return None  # 回應已在 send_file 中處理
+    try:
+        yield
+    finally:
+        with client_send_lock(client_socket):
+            with send_locks_guard:
+                pending = transfer_queues.pop(client_socket, [])
+            for message in pending:
+                send_json(client_socket, message)
+
+def notify_player(username, message):
+    """推播訊息給單一在線玩家"""
+    client_socket = sessions.socket_of("players", username)
+    if client_socket:
+        send_to_client(client_socket, message)
+
+def notify_room(room, message, exclude=None):
+    """推播訊息給房間內的所有玩家 (exclude 為不需通知的玩家，通常是發起者)"""
+    with room.lock:
+        players = list(room.players)
+    
+    for player in players:
+        if player != exclude:
+            notify_player(player, message)
+
+def notify_game_started(room, data, exclude=None, **extra):
+    """推播 GAME_STARTED，託管遊戲時每位玩家各自帶上自己的 attach token"""
+    with room.lock:
+        players = list(room.players)
+        tokens = dict(room.attach_tokens)
+    
+    for player in players:
+        if player == exclude:
+            continue
+        event = {"type": "GAME_STARTED", **extra, **data}
+        if player in tokens:
+            event["attach_token"] = tokens[player]
+        notify_player(player, event)
+
+def notify_ready_state(room, exclude=None, message=None):
+    """推播房間的準備狀態"""
+    detail = room.detail()
+    notify_room(room, {
+        "type": "ROOM_READY_UPDATE",
+        "room_id": detail["room_id"],
+        "status": detail["status"],
+        "ready_players": detail["ready_players"],
+        "ready_count": len(detail["ready_players"]),
+        "total_count": detail["player_count"],
+        "players": detail["players"],
+        "message": message
+    }, exclude)
 
 # ========================= 房間管理 =========================
 
 def allocate_port():
     """分配一個可用的 Port"""
-    for port in range(GAME_PORT_START, GAME_PORT_END):
-        if port not in used_ports:
-            used_ports.add(port)
-            return port
-    return None
+    return port_allocator.allocate()
+
+def release_port(port, agent_id=None):
+    """釋放 Port (託管遊戲的共用 Port 不歸還，遊戲主機上的 Port 由主機自行回收)"""
+    if agent_id or port == GAME_HOST_PORT:
+        return
+    port_allocator.release(port)
+
+def room_port(game_id, db):
+    """託管遊戲的房間使用共用 Port，其他遊戲分配專屬 Port"""
+    game_dir, config, error = load_game_config(game_id)
+    if not error and is_hosted_game(game_id, config, db):
+        return GAME_HOST_PORT
+    return allocate_port()
+
+def stop_game_server(room_id, timeout=5):
+    """停止房間的 Game Server (在房間 lock 外呼叫，避免等待 process 時卡住其他操作)"""
+    game_channels.revoke(room_id)
+    game_supervisor.stop(room_id, timeout)
+    game_host.close_room(room_id)
+    agent_registry.stop(room_id)
+
+def load_game_config(game_id):
+    """
+    讀取遊戲目前版本的 config.json，回傳 (遊戲目錄, config, 錯誤訊息)
+    不直接使用 DB 中的絕對路徑 (可能是舊的或異質系統的路徑)，依 game_id 重新組合
+    """
+    game_storage_path = get_game_storage(game_id)
+    version_dir = read_current_version(game_storage_path)
+    game_dir = resolve_game_dir(game_storage_path, version_dir)
+    
+    if not game_dir:
+        print(f"[Error] Game files not found under: {game_storage_path}")
+        return None, None, "遊戲配置檔不存在"
+    
+    config_path = os.path.join(game_dir, 'config.json')
+    if not os.path.exists(config_path):
+        print(f"[Error] Config not found at: {config_path}")
+        return game_dir, None, "遊戲配置檔不存在"
+    
+    try:
+        with open(config_path, 'r', encoding='utf-8') as f:
+            return game_dir, json.load(f), None
+    except Exception as e:
+        return game_dir, None, f"讀取配置檔失敗: {e}"
 
-def release_port(port):
-    """釋放 Port"""
-    used_ports.discard(port)
+def is_hosted_game(game_id, config, db):
+    """遊戲宣告支援託管模式，且由管理者列入 trusted_games 時才在大廳內執行"""
+    return (config.get("hosting") == "in_process" and bool(config.get("hosted_class"))
+            and game_id in db.get("trusted_games", []))
+
+def start_game_host():
+    """第一次啟動託管房間時才開始監聽共用 Port，Port 無法使用時回傳 False (改以 server_command 啟動)"""
+    with game_host_lock:
+        if game_host.started:
+            return True
+        try:
+            game_host.start(record_game_result)
+        except OSError as e:
+            print(f"[Game] Cannot listen on shared port {GAME_HOST_PORT}, hosted games fall back to server_command: {e}")
+            return False
+        print(f"[Game] Hosting trusted games on shared port {GAME_HOST_PORT}")
+        return True
+
+def load_hosted_class(game_id, game_dir, config):
+    """載入託管遊戲類別 (每個版本目錄只載入一次)"""
+    with hosted_classes_lock:
+        game_class = hosted_classes.get(game_dir)
+        if game_class is None:
+            module_path = os.path.join(game_dir, config.get("hosted_module", "server.py"))
+            module_name = f"hosted_{game_id}_{os.path.basename(game_dir)}"
+            spec = importlib.util.spec_from_file_location(module_name, module_path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            game_class = hosted_classes[game_dir] = getattr(module, config["hosted_class"])
+    return game_class
+
+def handle_game_server_exit(room_id, returncode, expected, stderr_tail):
+    """
+    Game Server 結束 (由監管執行緒呼叫)
+    沒有回報結果就結束時視為異常：重置房間狀態並換一個新的 Port
+    """
+    if expected:
+        return
+    
+    room = room_registry.get(room_id)
+    if not room or not room_registry.set_status(room, "waiting", expected="playing"):
+        return
+    game_channels.revoke(room_id)
+    
+    if returncode != 0:
+        print(f"[Game] Game server crashed in room {room_id} (exit code {returncode})")
+        for line in stderr_tail.strip().splitlines()[-5:]:
+            print(f"         {line}")
+    else:
+        print(f"[Game] Game server in room {room_id} exited without reporting a result")
+    
+    # 舊 Port 可能還被殘留的子行程佔用，放回隔離區並改用新的 Port
+    # (託管房間使用共用 Port；遊戲主機上的房間下次啟動時會重新配置，都不需更換)
+    new_port = allocate_port() if room.port != GAME_HOST_PORT and not room.agent_id else None
+    if new_port:
+        old_port, _ = room_registry.set_port(room, new_port)
+        release_port(old_port if old_port is not None else new_port)
+    
+    gc_game_versions(room.game_id)
+    notify_ready_state(room, message="遊戲伺服器異常結束，房間已重置")
+
+def dispose_room(room, reason="empty"):
+    """房間已從註冊表移除後，停止 Game Server、釋放 Port 並清理舊版本"""
+    stop_game_server(room.room_id, timeout=1)
+    release_port(room.port, room.agent_id)
+    gc_game_versions(room.game_id)
+    print(f"[Room] Room {room.room_id} deleted ({reason})")
 
 def handle_create_room(request):
     """建立遊戲房間"""
@@ -655,31 +1217,27 @@ def handle_create_room(request):
         return create_response(False, "遊戲已下架，無法建立房間")
     
     # 檢查玩家是否已在其他房間
-    for room_id, room in rooms.items():
-        if username in room["players"]:
-            return create_response(False, "您已在其他房間中")
+    if room_registry.room_of(username):
+        return create_response(False, "您已在其他房間中")
     
     # 建立房間
     room_id = str(uuid.uuid4())[:8]
-    port = allocate_port()
+    port = room_port(game_id, db)
     
     if not port:
         return create_response(False, "伺服器繁忙，請稍後再試")
     
-    rooms[room_id] = {
-        "game_id": game_id,
-        "game_name": game["name"],
-        "game_version": game["version"],
-        "host": username,
-        "players": [username],
-        "max_players": game["max_players"],
-        "min_players": game["min_players"],
-        "status": "waiting",
-        "port": port,
-        "created_at": datetime.now().isoformat(),
-        "chat_history": [],
-        "ready_players": []
-    }
+    room, error = room_registry.create(
+        room_id, username, game_id, game["name"], game["version"],
+        game["max_players"], game["min_players"], port
+    )
+    if error:
+        # 分配 Port 期間可能已經加入其他房間
+        release_port(port)
+        return create_response(False, error)
+    
+    # 自行建立房間就不再參與快速配對
+    matchmaker.cancel(username)
     
     print(f"[Room] Room created: {room_id} for {game['name']} by {username}")
     
@@ -700,37 +1258,23 @@ def handle_join_room(request):
     
     room_id = request.get("room_id")
     
-    if room_id not in rooms:
-        return create_response(False, "房間不存在")
+    room, error = room_registry.join(room_id, username)
+    if error:
+        return create_response(False, error)
     
-    room = rooms[room_id]
-    
-    if room["status"] != "waiting":
-        return create_response(False, "遊戲已經開始")
-    
-    if len(room["players"]) >= room["max_players"]:
-        return create_response(False, "房間已滿")
-    
-    if username in room["players"]:
-        return create_response(False, "您已在此房間中")
-    
-    # 檢查玩家是否已在其他房間
-    for rid, r in rooms.items():
-        if rid != room_id and username in r["players"]:
-            return create_response(False, "您已在其他房間中")
-    
-    room["players"].append(username)
+    matchmaker.cancel(username)
     
     print(f"[Room] {username} joined room {room_id}")
     
+    data = room.summary()
     return create_response(True, "加入房間成功", {
         "room_id": room_id,
-        "port": room["port"],
-        "game_name": room["game_name"],
-        "game_version": room["game_version"],
-        "players": room["players"],
-        "player_count": len(room["players"]),
-        "max_players": room["max_players"]
+        "port": data["port"],
+        "game_name": data["game_name"],
+        "game_version": room.game_version,
+        "players": data["players"],
+        "player_count": data["player_count"],
+        "max_players": data["max_players"]
     })
 
 def handle_leave_room(request):
@@ -743,27 +1287,15 @@ def handle_leave_room(request):
     
     room_id = request.get("room_id")
     
-    if room_id not in rooms:
-        return create_response(False, "房間不存在")
+    room, deleted, error = room_registry.leave(room_id, username)
+    if error:
+        return create_response(False, error)
     
-    room = rooms[room_id]
-    
-    if username not in room["players"]:
-        return create_response(False, "您不在此房間中")
-    
-    room["players"].remove(username)
-    if "ready_players" in room and username in room["ready_players"]:
-        room["ready_players"].remove(username)
-    
-    # 如果房間空了，刪除房間
-    if not room["players"]:
-        release_port(room["port"])
-        del rooms[room_id]
-        print(f"[Room] Room {room_id} deleted (empty)")
-    # 如果是房主離開，轉移房主
-    elif room["host"] == username:
-        room["host"] = room["players"][0]
-        print(f"[Room] Host transferred to {room['host']} in room {room_id}")
+    # 如果房間空了，釋放資源；否則通知其他玩家人數變動
+    if deleted:
+        dispose_room(room)
+    else:
+        notify_ready_state(room)
     
     print(f"[Room] {username} left room {room_id}")
     return create_response(True, "已離開房間")
@@ -782,29 +1314,19 @@ def handle_send_chat(request):
     if not message:
         return create_response(False, "訊息不能為空")
         
-    if room_id not in rooms:
+    room = room_registry.get(room_id)
+    if not room:
         return create_response(False, "房間不存在")
-        
-    room = rooms[room_id]
     
-    if username not in room["players"]:
+    # 存入房間的環狀緩衝區 (保留最近 50 則)
+    chat_entry = room.add_chat(username, message, datetime.now().strftime("%H:%M:%S"))
+    if not chat_entry:
         return create_response(False, "您不在此房間中")
-        
-    chat_entry = {
-        "username": username,
-        "message": message,
-        "time": datetime.now().strftime("%H:%M:%S")
-    }
     
-    if "chat_history" not in room:
-        room["chat_history"] = []
-        
-    room["chat_history"].append(chat_entry)
-    # 保留最近 50 則
-    if len(room["chat_history"]) > 50:
-        room["chat_history"] = room["chat_history"][-50:]
-        
-    return create_response(True, "發送成功")
+    # 即時推送給房間內的其他玩家
+    notify_room(room, {"type": "CHAT_MESSAGE", "room_id": room_id, **chat_entry}, exclude=username)
+    
+    return create_response(True, "發送成功", {"seq": chat_entry["seq"]})
 
 def handle_get_room_chat(request):
     """取得房間聊天紀錄"""
@@ -816,37 +1338,123 @@ def handle_get_room_chat(request):
         
     room_id = request.get("room_id")
     
-    if room_id not in rooms:
+    try:
+        after_seq = int(request.get("after_seq") or 0)
+        limit = request.get("limit")
+        limit = int(limit) if limit is not None else None
+    except (TypeError, ValueError):
+        return create_response(False, "after_seq / limit 格式錯誤")
+    
+    room = room_registry.get(room_id)
+    if not room:
         return create_response(False, "房間不存在")
-        
-    room = rooms[room_id]
     
     # 只有房間內的人可以看到聊天 (或大廳也可以? 這裡限制房間內)
-    if username not in room["players"]:
+    if username not in room.player_set:
         return create_response(False, "您不在此房間中")
+    
+    # 只回傳 after_seq 之後的訊息，limit 指定時只取最新幾則
+    chat_history, last_seq, truncated = room.chat_since(after_seq, limit)
         
     return create_response(True, "查詢成功", {
-        "chat_history": room.get("chat_history", [])
+        "chat_history": chat_history,
+        "last_seq": last_seq,
+        "truncated": truncated
     })
 
 def handle_list_rooms(request):
-    """列出所有房間"""
-    rooms_list = []
+    """
+    列出房間
+    - 可用 game_id / status / has_free_slot 篩選
+    - 帶 since_revision 時只回傳該 revision 之後變動的房間，以及已刪除 (或不再符合篩選) 的 room_id
+      (需同時帶上次回應的 epoch，大廳重啟後 epoch 不同時改回傳完整列表)
+    - sort 為 "rating" 時回傳完整列表，依房內玩家平均積分與查詢者積分的差距排序 (limit 選填，只取最接近的幾間)
+    """
+    if request.get("sort") == "rating":
+        return list_rooms_by_rating(request)
+    
+    since_revision = request.get("since_revision")
+    if since_revision is not None:
+        try:
+            since_revision = int(since_revision)
+        except (TypeError, ValueError):
+            return create_response(False, "since_revision 格式錯誤")
+    
+    revision, rooms_found, removed, full = room_registry.changes(
+        since_revision,
+        game_id=request.get("game_id"),
+        status=request.get("status"),
+        has_free_slot=bool(request.get("has_free_slot")),
+        epoch=request.get("epoch")
+    )
     
-    for room_id, room in rooms.items():
-        rooms_list.append({
-            "room_id": room_id,
-            "game_id": room["game_id"],
-            "game_name": room["game_name"],
-            "host": room["host"],
-            "players": room["players"],
-            "player_count": len(room["players"]),
-            "max_players": room["max_players"],
-            "status": room["status"],
-            "port": room.get("port")
-        })
+    return create_response(True, "查詢成功", {
+        "rooms": [room.summary() for room in rooms_found],
+        "removed": removed,
+        "revision": revision,
+        "epoch": room_registry.epoch,
+        "full": full
+    })
+
+def list_rooms_by_rating(request):
+    """依積分接近程度排序的房間列表"""
+    username = verify_session(request.get("session_id"), "players")
+    if not username:
+        return create_response(False, "請先登入")
+    
+    try:
+        limit = int(request["limit"]) if request.get("limit") is not None else None
+    except (TypeError, ValueError):
+        return create_response(False, "limit 格式錯誤")
+    
+    revision, rooms_found, _, _ = room_registry.changes(
+        None,
+        game_id=request.get("game_id"),
+        status=request.get("status"),
+        has_free_slot=bool(request.get("has_free_slot"))
+    )
+    
+    ranked = []
+    for room in rooms_found:
+        summary = room.summary()
+        average = ratings.average(room.game_id, summary["players"])
+        if average is None:
+            continue
+        gap = abs(average - ratings.rating(room.game_id, username))
+        summary["avg_rating"] = round(average, 1)
+        summary["rating_gap"] = round(gap, 1)
+        ranked.append((gap, summary["room_id"], summary))
+    
+    ranked = heapq.nsmallest(limit, ranked) if limit is not None else sorted(ranked)
+    return create_response(True, "查詢成功", {
+        "rooms": [summary for _, _, summary in ranked],
+        "removed": [],
+        "revision": revision,
+        "full": True
+    })
+
+def handle_get_room(request):
+    """取得單一房間資訊"""
+    session_id = request.get("session_id")
+    username = verify_session(session_id, "players")
+    
+    if not username:
+        return create_response(False, "請先登入")
+    
+    room = room_registry.get(request.get("room_id"))
+    if not room:
+        return create_response(False, "房間不存在")
     
-    return create_response(True, "查詢成功", {"rooms": rooms_list})
+    detail = room.detail()
+    if detail["status"] == "playing":
+        # Game Server 透過控制通道回報的即時進度 (人數、狀態、統計)
+        detail["progress"] = game_channels.progress(room.room_id)
+        # 託管遊戲中的成員需要自己的 attach token 才能 (重新) 連上共用 Port
+        with room.lock:
+            token = room.attach_tokens.get(username)
+        if token:
+            detail["attach_token"] = token
+    return create_response(True, "查詢成功", detail)
 
 def handle_start_game(request):
     """開始遊戲"""
@@ -858,140 +1466,270 @@ def handle_start_game(request):
     
     room_id = request.get("room_id")
     
-    if room_id not in rooms:
-        return create_response(False, "房間不存在")
-    
-    room = rooms[room_id]
-    
-    # if room["host"] != username:
+    # if room.host != username:
     #     return create_response(False, "只有房主可以開始遊戲")
     
-    if len(room["players"]) < room["min_players"]:
-        return create_response(False, f"人數不足，至少需要 {room['min_players']} 人")
+    room, all_ready, error = room_registry.mark_ready(room_id, username)
+    if error:
+        return create_response(False, error)
     
-    if room["status"] != "waiting":
-        return create_response(False, "遊戲已經開始")
-    
-    # 處理準備狀態
-    if "ready_players" not in room:
-        room["ready_players"] = []
-        
-    if username not in room["ready_players"]:
-        room["ready_players"].append(username)
-        
-    ready_count = len(room["ready_players"])
-    total_count = len(room["players"])
-    
-    if ready_count < total_count:
+    if not all_ready:
+        with room.lock:
+            ready_count = len(room.ready_players)
+            total_count = len(room.players)
+        notify_ready_state(room, exclude=username)
         return create_response(True, "已準備", {
             "status": "ready_waiting",
             "ready_count": ready_count,
             "total_count": total_count
         })
     
-    # 所有人都準備好了，啟動遊戲伺服器
-    db = load_database()
-    game = db["games"][room["game_id"]]
-    
-    # 修正路徑問題：不直接使用 DB 中的絕對路徑，而是根據當前環境重新組合
-    # game["storage_path"] 可能是舊的或異質系統的路徑，我們只取最後的目錄名 (game_id)
-    game_id_dir = os.path.basename(game["storage_path"])
-    # 如果 basename 取不到 (例如路徑結尾有斜線)，則直接用 game_id
-    if not game_id_dir or game_id_dir == "":
-        game_id_dir = room["game_id"]
-        
-    game_storage_path = os.path.join(STORAGE_DIR, game_id_dir)
-    game_dir = os.path.join(game_storage_path, 'game')
-    config_path = os.path.join(game_dir, 'config.json')
+    # 最後一位準備的玩家負責啟動 (房間已轉為 starting，其他人無法中途加入或重複啟動)
+    response = launch_room_game(room)
+    
+    if response["success"]:
+        # 其他已準備的玩家正在等待這個事件，直接帶上連線資訊
+        notify_game_started(room, response["data"], exclude=username)
+        with room.lock:
+            token = room.attach_tokens.get(username)
+        if token:
+            response["data"]["attach_token"] = token
+    else:
+        room_registry.set_status(room, "waiting", expected="starting")
+        notify_ready_state(room, exclude=username, message=response["message"])
+    return response
+
+def launch_room_game(room, db=None):
+    """所有人都準備好了，啟動遊戲伺服器 (db 為呼叫端已讀取的資料庫，省略時重新讀取)"""
+    if db is None:
+        db = load_database()
     
-    if not os.path.exists(config_path):
-        # 嘗試另一種常見結構 (直接在 storage_path 下)
-        if os.path.exists(os.path.join(game_storage_path, 'config.json')):
-             game_dir = game_storage_path
-             config_path = os.path.join(game_dir, 'config.json')
-        else:
-             print(f"[Error] Config not found at: {config_path}")
-             return create_response(False, "遊戲配置檔不存在")
+    # 啟動時固定使用當下的 current 版本，之後更新也不影響這場遊戲
+    # (在 version_lock 內記下版本目錄，清理舊版本時會把啟動中的房間視為使用中)
+    with version_lock:
+        game_dir, config, error = load_game_config(room.game_id)
+        if error:
+            return create_response(False, error)
+        with room.lock:
+            room.version_dir = os.path.basename(game_dir)
     
-    try:
-        with open(config_path, 'r', encoding='utf-8') as f:
-            config = json.load(f)
-    except Exception as e:
-        return create_response(False, f"讀取配置檔失敗: {e}")
+    with room.lock:
+        players = list(room.players)
+        room.attach_tokens = {}
     
     server_cmd = config.get("server_command")
     
-    if server_cmd:
+    if is_hosted_game(room.game_id, config, db) and start_game_host():
         try:
-            # 啟動遊戲 Server
-            cmd = server_cmd.copy()
-            cmd.extend([
-                "--port", str(room["port"]),
-                "--lobby-port", str(SERVER_PORT),
-                "--room-id", room_id
-            ])
-            
-            process = subprocess.Popen(
-                cmd,
-                cwd=game_dir,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-            game_servers[room_id] = process
-            print(f"[Game] Game server started on port {room['port']} for room {room_id}")
+            # 信任的遊戲在大廳內執行，改用共用 Port
+            game_class = load_hosted_class(room.game_id, game_dir, config)
+            release_port(*room_registry.set_port(room, GAME_HOST_PORT))
+            hosted = game_host.open_room(room.room_id, game_class, players, on_exit=handle_game_server_exit)
+            with room.lock:
+                room.attach_tokens = dict(hosted.tokens)
+            print(f"[Game] Hosted game started on shared port {GAME_HOST_PORT} for room {room.room_id}")
         except Exception as e:
             return create_response(False, f"啟動遊戲伺服器失敗: {e}")
+    elif server_cmd:
+        response = start_game_server(room, game_dir, server_cmd, players)
+        if response:
+            return response
     
-    room["status"] = "playing"
-    room["ready_players"] = [] # 清空準備狀態
-    print(f"[Room] Room {room_id} status changed to 'playing'")
+    room.match_players = players
+    room_registry.set_status(room, "playing", expected="starting")
+    print(f"[Room] Room {room.room_id} status changed to 'playing'")
     
-    # 記錄玩家已玩過此遊戲
-    for player in room["players"]:
-        if player in db["players"]:
-            if room["game_id"] not in db["players"][player].get("played_games", []):
-                db["players"][player].setdefault("played_games", []).append(room["game_id"])
-    save_database(db)
+    # 記錄玩家已玩過此遊戲 (只記在記憶體，由回收執行緒批次寫入)
+    record_played_games(room.game_id, players)
     
     return create_response(True, "遊戲開始", {
-        "room_id": room_id,
-        "game_id": room["game_id"],
-        "port": room["port"],
-        "game_name": room["game_name"],
-        "players": room["players"],
+        "room_id": room.room_id,
+        "game_id": room.game_id,
+        "port": room.port,
+        "server_host": room.server_host,
+        "game_name": room.game_name,
+        "players": players,
         "client_command": config.get("client_command", [])
     })
 
+def record_played_games(game_id, players):
+    """記下玩家玩過遊戲 (不讀寫資料庫)"""
+    with played_lock:
+        for player in players:
+            played_pending.setdefault(player, set()).add(game_id)
+
+def played_games_of(username, player):
+    """玩家玩過的遊戲：資料庫的 played_games 加上尚未寫入的紀錄"""
+    played = list(player.get("played_games", []))
+    with played_lock:
+        played.extend(game_id for game_id in played_pending.get(username, ()) if game_id not in played)
+    return played
+
+def flush_played_games():
+    """把記憶體中的 played_games 批次寫入資料庫，已確認寫入的紀錄才移除 (由回收執行緒定期呼叫)"""
+    with played_lock:
+        if not played_pending:
+            return
+        pending = {username: set(game_ids) for username, game_ids in played_pending.items()}
+    
+    confirmed = []
+    
+    def merge(db):
+        changed = False
+        for username, game_ids in pending.items():
+            player = db["players"].get(username)
+            if player is None:
+                # 帳號已不存在，不需要再寫入
+                confirmed.extend((username, game_id) for game_id in game_ids)
+                continue
+            played = player.setdefault("played_games", [])
+            for game_id in game_ids:
+                if game_id in played:
+                    confirmed.append((username, game_id))
+                else:
+                    played.append(game_id)
+                    changed = True
+        return changed
+    
+    update_database(merge)
+    
+    with played_lock:
+        for username, game_id in confirmed:
+            game_ids = played_pending.get(username)
+            if game_ids is not None:
+                game_ids.discard(game_id)
+                if not game_ids:
+                    del played_pending[username]
+
+def start_game_server(room, game_dir, server_cmd, players):
+    """
+    啟動房間的 Game Server，失敗時回傳錯誤回應
+    有可用的遊戲主機時配置到負載最低的主機，否則在大廳本機啟動
+    每位玩家的 ATTACH token 在 Game Server 建立控制連線時交給它，開始遊戲時發給玩家
+    """
+    version_dir = os.path.basename(game_dir)
+    channel = game_channels.issue(room.room_id, players)
+    token = channel.token
+    with room.lock:
+        room.attach_tokens = dict(channel.attach_tokens)
+    agent = agent_registry.place(room.room_id, room.game_id, version_dir)
+    
+    if agent:
+        port, error = agent_registry.start(agent, room.room_id, room.game_id, version_dir, server_cmd, token,
+                                           channel.attach_tokens)
+        if error:
+            agent_registry.release(room.room_id, agent)
+            game_channels.revoke(room.room_id)
+            return create_response(False, f"啟動遊戲伺服器失敗: {error}")
+        release_port(*room_registry.set_port(room, port, agent.agent_id, agent.host))
+        print(f"[Game] Game server started on agent {agent.agent_id} ({agent.host}:{port}) for room {room.room_id}")
+        return None
+    
+    if room.port == GAME_HOST_PORT or room.agent_id:
+        # 上一場在託管模式或遊戲主機上執行，改在本機啟動需要專屬 Port
+        port = allocate_port()
+        if not port:
+            game_channels.revoke(room.room_id)
+            return create_response(False, "伺服器繁忙，請稍後再試")
+        room_registry.set_port(room, port)
+    
+    try:
+        # 啟動遊戲 Server (以 --lobby-token 建立控制連線)
+        args = [
+            "--port", str(room.port),
+            "--lobby-port", str(SERVER_PORT),
+            "--room-id", room.room_id,
+            "--lobby-token", token
+        ]
+        
+        # 優先使用預熱池中已載入好的 Game Server，沒有時才冷啟動
+        # 兩者都由監管者持續讀取輸出寫入 log，並在結束時回收
+        if warm_pool.take(room.game_id, version_dir, game_dir, server_cmd,
+                          room.room_id, server_cmd[2:] + args, handle_game_server_exit):
+            print(f"[Game] Pre-warmed game server assigned port {room.port} for room {room.room_id}")
+        else:
+            game_supervisor.spawn(room.room_id, server_cmd + args, game_dir, on_exit=handle_game_server_exit,
+                                  group=room.game_id)
+            print(f"[Game] Game server started on port {room.port} for room {room.room_id}")
+    except Exception as e:
+        game_channels.revoke(room.room_id)
+        return create_response(False, f"啟動遊戲伺服器失敗: {e}")
+    
+    return None
+
 def handle_report_game_result(request):
-    """處理遊戲結果回報"""
-    # 這裡不驗證 session，因為是 Game Server 呼叫的
-    # 但為了安全，應該要驗證來源 IP (必須是 localhost 或信任的 IP)
-    # 或是檢查 room_id 對應的 process 是否存在
+    """處理遊戲結果回報 (單次連線，需附上啟動時給的 token；持續連線請改用 GAME_CONTROL)"""
+    room_id = request.get("room_id")
+    if not game_channels.verify(room_id, request.get("token")):
+        return create_response(False, "驗證失敗")
     
+    result = game_channels.update(room_id, {"type": "RESULT", "result": request.get("result")})
+    return record_game_result(room_id, result)
+
+def handle_game_control(request, client_socket):
+    """
+    Game Server 的控制連線：驗證 token 後持續接收 HEARTBEAT / STATS / RESULT，直到斷線
+    (佔用這條連線的處理執行緒)
+    """
     room_id = request.get("room_id")
-    result = request.get("result")
+    channel = game_channels.verify(room_id, request.get("token"))
+    if not channel:
+        send_json(client_socket, create_response(False, "驗證失敗"))
+        return
     
-    if room_id not in rooms:
-        return create_response(False, "房間不存在")
+    game_channels.connect(channel)
+    send_json(client_socket, create_response(True, "控制連線已建立", {"attach_tokens": channel.attach_tokens}))
     
-    room = rooms[room_id]
+    try:
+        while True:
+            message = recv_json(client_socket)
+            if message is None:
+                break
+            response = game_control_message(room_id, message)
+            if response:
+                send_json(client_socket, response)
+    finally:
+        game_channels.disconnect(channel)
+
+def game_control_message(room_id, message):
+    """處理控制通道的訊息 (大廳直接連線與遊戲主機轉送共用)，RESULT 時回傳回應"""
+    if message.get("type") not in CONTROL_MESSAGE_TYPES:
+        return create_response(False, "未知的訊息類型")
+    
+    result = game_channels.update(room_id, message)
+    if result is False:
+        return create_response(False, "房間不在遊戲中") if message.get("type") == "RESULT" else None
+    if result is None:
+        return None
+    return record_game_result(room_id, result)
+
+def record_game_result(room_id, result):
+    """記錄遊戲結果並讓房間回到等待狀態 (獨立 Game Server 與託管遊戲共用)"""
+    room = room_registry.get(room_id)
+    if not room:
+        return create_response(False, "房間不存在")
     
     # 驗證是否為該房間的 Game Server (簡單驗證：狀態必須是 playing)
-    if room["status"] != "playing":
+    # 同時更新房間狀態並重置準備狀態
+    if not room_registry.set_status(room, "waiting", expected="playing"):
         return create_response(False, "房間不在遊戲中")
+    game_channels.revoke(room_id)
     
-    # 更新房間狀態
-    room["status"] = "waiting"
-    room["ready_players"] = [] # 重置準備狀態
     print(f"[Game] Game over in room {room_id}. Result: {result}")
     
-    # 移除 Game Server Process 記錄 (因為它即將結束)
-    if room_id in game_servers:
-        # 不用 terminate，因為是它自己回報結束的
-        del game_servers[room_id]
+    # Game Server 即將自行結束，不用 terminate，之後的結束屬於正常結束
+    game_supervisor.finish(room_id)
     
-    # 這裡可以處理戰績更新 (如果 result 包含詳細資訊)
-    # ...
+    # 這場遊戲使用的版本若已被取代，現在可以清理
+    gc_game_versions(room.game_id)
+    
+    # 寫入對戰紀錄並更新玩家統計 (winner 不是這場的玩家時，例如 "Player1"，只記錄參與不計勝場)
+    players = room.match_players or list(room.players)
+    winner = result.get("winner") if isinstance(result, dict) else None
+    try:
+        match_store.record(room.game_id, room_id, players, winner if winner in players else None, result)
+    except OSError as e:
+        print(f"[Match] Failed to record result for room {room_id}: {e}")
     
     return create_response(True, "結果已接收")
 
@@ -1005,27 +1743,258 @@ def handle_end_game(request):
     
     room_id = request.get("room_id")
     
-    if room_id not in rooms:
+    room = room_registry.get(room_id)
+    if not room:
         return create_response(False, "房間不存在")
     
-    room = rooms[room_id]
+    if username not in room.player_set:
+        return create_response(False, "您不在此房間中")
+    
+    # 刪除房間 (同時清除成員索引)
+    if not room_registry.remove(room_id):
+        return create_response(False, "房間不存在")
     
     # 停止遊戲伺服器
-    if room_id in game_servers:
-        try:
-            game_servers[room_id].terminate()
-            game_servers[room_id].wait(timeout=5)
-        except:
-            game_servers[room_id].kill()
-        del game_servers[room_id]
+    stop_game_server(room_id)
     
-    # 釋放 Port 並刪除房間
-    release_port(room["port"])
-    del rooms[room_id]
+    # 釋放 Port
+    release_port(room.port, room.agent_id)
+    gc_game_versions(room.game_id)
     
     print(f"[Game] Game ended in room {room_id}")
     return create_response(True, "遊戲結束")
 
+# ========================= 房間回收 =========================
+
+def check_game_server(room, silent=()):
+    """
+    檢查進行中房間的 Game Server，回傳異常原因 (正常時回傳 None)
+    - 行程是否存活 (本機監管、大廳託管或遊戲主機上的配置)
+    - 已建立控制連線的 Game Server 是否持續送出心跳 (silent 為超時的 room_id)
+    - 本機 Game Server 是否仍佔用 Port (以 bind 檢查，不建立連線，避免佔用玩家名額)
+    """
+    room_id = room.room_id
+    if room.port == GAME_HOST_PORT:
+        return None if game_host.running(room_id) else "託管房間已不存在"
+    if room.agent_id:
+        if not agent_registry.agent_of(room_id):
+            return "遊戲主機上已沒有此房間"
+        return f"控制連線超過 {CONTROL_SILENCE_TIMEOUT} 秒沒有心跳" if room_id in silent else None
+    if not game_supervisor.running(room_id):
+        return "Game Server 已結束"
+    if room_id in silent:
+        return f"控制連線超過 {CONTROL_SILENCE_TIMEOUT} 秒沒有心跳"
+    
+    if time.time() - room.status_since < GAME_START_GRACE or port_allocator.listening(room.port) is not False:
+        with reaper_lock:
+            reaper_strikes.pop(room_id, None)
+        return None
+    
+    with reaper_lock:
+        strikes = reaper_strikes[room_id] = reaper_strikes.get(room_id, 0) + 1
+    if strikes < UNRESPONSIVE_CHECKS:
+        return None
+    return "Game Server 沒有在 Port 上監聽"
+
+def reap_rooms():
+    """回收一次：重置 Game Server 已失效的房間、解散閒置或沒有在線玩家的房間"""
+    counts = {"dead_servers": 0, "unresponsive_servers": 0, "idle_rooms": 0, "orphan_rooms": 0}
+    
+    silent = set(game_channels.silent(CONTROL_SILENCE_TIMEOUT))
+    for room in room_registry.find(status="playing"):
+        reason = check_game_server(room, silent)
+        if not reason:
+            continue
+        with reaper_lock:
+            reaper_strikes.pop(room.room_id, None)
+        
+        if game_supervisor.running(room.room_id) or agent_registry.agent_of(room.room_id):
+            # 行程還在但沒有回應，先停止 (停止後的結束屬於預期內，由這裡重置房間)
+            counts["unresponsive_servers"] += 1
+            stop_game_server(room.room_id, timeout=2)
+        else:
+            counts["dead_servers"] += 1
+        print(f"[Reaper] Room {room.room_id}: {reason}")
+        handle_game_server_exit(room.room_id, -1, False, reason)
+    
+    for room in room_registry.find():
+        with room.lock:
+            players = list(room.players)
+        if any(sessions.has("players", player) for player in players):
+            continue
+        # 所有玩家都已離線 (斷線清理未執行，例如連線異常中斷)
+        if room_registry.remove(room.room_id):
+            counts["orphan_rooms"] += 1
+            dispose_room(room, reason="no players online")
+    
+    if ROOM_IDLE_TTL > 0:
+        for room in room_registry.stale("waiting", ROOM_IDLE_TTL):
+            if room_registry.remove(room.room_id):
+                counts["idle_rooms"] += 1
+                notify_room(room, {
+                    "type": "ROOM_CLOSED",
+                    "room_id": room.room_id,
+                    "message": f"房間閒置超過 {ROOM_IDLE_TTL // 60} 分鐘，已自動解散"
+                })
+                dispose_room(room, reason="idle")
+    
+    with reaper_lock:
+        # 已不在進行中的房間不再保留檢查紀錄
+        for room_id in list(reaper_strikes):
+            room = room_registry.get(room_id)
+            if not room or room.status != "playing":
+                del reaper_strikes[room_id]
+        reaper_stats["passes"] += 1
+        for key, value in counts.items():
+            reaper_stats[key] += value
+    return counts
+
+def expire_sessions():
+    """移除閒置過久、或斷線後沒有在寬限時間內接回的 Session，玩家同時離開配對佇列與房間"""
+    for session in sessions.expire():
+        print(f"[Session] {session.user_type[:-1]} session expired: {session.username}")
+        if session.user_type == "players":
+            matchmaker.cancel(session.username)
+            cleanup_user_from_rooms(session.username)
+
+def prune_game_logs():
+    """刪除已結束房間過舊或過多的 Game Server log"""
+    pruned = game_supervisor.prune_logs(max_age=GAME_LOG_MAX_AGE, max_rooms=GAME_LOG_MAX_ROOMS)
+    if pruned:
+        print(f"[Reaper] Pruned game server logs of {pruned} rooms")
+
+def run_reaper():
+    """背景執行緒：定期回收房間 (第一次回收時與之後每 LOG_PRUNE_PASSES 次清理舊 log)"""
+    passes = 0
+    while True:
+        time.sleep(REAPER_INTERVAL)
+        try:
+            reap_rooms()
+            expire_sessions()
+            flush_played_games()
+            if passes % LOG_PRUNE_PASSES == 0:
+                prune_game_logs()
+        except Exception as e:
+            print(f"[Reaper] Error: {e}")
+        passes += 1
+
+# ========================= 快速配對 =========================
+
+def handle_quick_match(request):
+    """加入快速配對佇列，配對成功後會推播 GAME_STARTED"""
+    session_id = request.get("session_id")
+    username = verify_session(session_id, "players")
+    
+    if not username:
+        return create_response(False, "請先登入")
+    
+    game_id = request.get("game_id")
+    
+    db = load_database()
+    game = db.get("games", {}).get(game_id)
+    
+    if not game:
+        return create_response(False, "遊戲不存在")
+    
+    if game["status"] != "active":
+        return create_response(False, "遊戲已下架，無法配對")
+    
+    if room_registry.room_of(username):
+        return create_response(False, "您已在其他房間中")
+    
+    queue_size, error = matchmaker.enqueue(username, game_id, game["min_players"], game["max_players"])
+    if error:
+        return create_response(False, error)
+    
+    print(f"[Match] {username} queued for {game['name']} ({queue_size} waiting)")
+    return create_response(True, "已加入配對佇列", {
+        "status": "queued",
+        "game_id": game_id,
+        "queue_size": queue_size,
+        "max_wait": MATCH_MAX_WAIT_SECONDS
+    })
+
+def handle_cancel_match(request):
+    """取消快速配對"""
+    session_id = request.get("session_id")
+    username = verify_session(session_id, "players")
+    
+    if not username:
+        return create_response(False, "請先登入")
+    
+    if not matchmaker.cancel(username):
+        return create_response(False, "您不在配對佇列中")
+    
+    return create_response(True, "已取消配對")
+
+def start_match(game_id, players):
+    """
+    配對成功：建立房間、讓所有人加入並準備，然後啟動遊戲 (由配對執行緒呼叫)
+    回傳需要放回佇列的玩家
+    """
+    db = load_database()
+    game = db.get("games", {}).get(game_id)
+    
+    if not game or game["status"] != "active":
+        for player in players:
+            notify_player(player, {"type": "MATCH_CANCELLED", "game_id": game_id, "message": "遊戲已下架，配對取消"})
+        return []
+    
+    port = room_port(game_id, db)
+    if not port:
+        # 暫時沒有 Port，稍後重試
+        return players
+    
+    room_id = str(uuid.uuid4())[:8]
+    host = players[0]
+    room, error = room_registry.create(
+        room_id, host, game_id, game["name"], game["version"],
+        game["max_players"], game["min_players"], port
+    )
+    if error:
+        # 房主排隊期間已自行進入其他房間
+        release_port(port)
+        return players[1:]
+    
+    joined = [host]
+    for player in players[1:]:
+        if room_registry.join(room_id, player)[1] is None:
+            joined.append(player)
+    
+    if len(joined) < game["min_players"]:
+        # 有人中途進入其他房間導致人數不足，解散房間讓其餘玩家繼續排隊
+        for player in joined:
+            left_room, deleted, error = room_registry.leave(room_id, player)
+            if deleted:
+                dispose_room(left_room)
+        return joined
+    
+    for player in joined:
+        room_registry.mark_ready(room_id, player)
+    
+    print(f"[Match] Matched {len(joined)} players for {game['name']} in room {room_id}")
+    
+    response = launch_room_game(room, db)
+    if response["success"]:
+        notify_game_started(room, response["data"], match=True)
+    else:
+        # 啟動失敗時玩家留在房間內，可從房間畫面重試或離開
+        room_registry.set_status(room, "waiting", expected="starting")
+        notify_ready_state(room, message=response["message"])
+        notify_room(room, {
+            "type": "MATCH_CANCELLED", "game_id": game_id, "room_id": room_id, "message": response["message"]
+        })
+    return []
+
+def expire_match(game_id, players):
+    """通知排隊逾時的玩家"""
+    for player in players:
+        notify_player(player, {
+            "type": "MATCH_CANCELLED",
+            "game_id": game_id,
+            "message": "等待逾時，目前配對人數不足"
+        })
+
 # ========================= 評分評論 =========================
 
 def handle_add_review(request):
@@ -1047,7 +2016,7 @@ def handle_add_review(request):
     
     # 檢查是否玩過
     player = db["players"].get(username, {})
-    if game_id not in player.get("played_games", []):
+    if game_id not in played_games_of(username, player):
         return create_response(False, "您尚未玩過此遊戲，無法評分")
     
     # 驗證評分
@@ -1096,7 +2065,7 @@ def handle_get_player_profile(request):
     db = load_database()
     player = db["players"].get(username, {})
     
-    played_game_ids = player.get("played_games", [])
+    played_game_ids = played_games_of(username, player)
     played_games_details = []
     
     for gid in played_game_ids:
@@ -1110,7 +2079,94 @@ def handle_get_player_profile(request):
             
     return create_response(True, "查詢成功", {
         "username": username,
-        "played_games": played_games_details
+        "played_games": played_games_details,
+        "stats": match_store.player_stats(username)
+    })
+
+# ========================= 對戰紀錄 =========================
+
+MATCH_HISTORY_MAX_LIMIT = 50
+
+def handle_get_match_history(request):
+    """取得對戰紀錄 (由新到舊分頁，before 為上一頁回傳的 next_before)"""
+    session_id = request.get("session_id")
+    username = verify_session(session_id, "players")
+    
+    if not username:
+        return create_response(False, "請先登入")
+    
+    try:
+        limit = min(max(int(request.get("limit") or 20), 1), MATCH_HISTORY_MAX_LIMIT)
+        before = request.get("before")
+        before = int(before) if before is not None else None
+    except (TypeError, ValueError):
+        return create_response(False, "before / limit 格式錯誤")
+    
+    # 預設查詢自己的紀錄，指定 all_players 時查詢某遊戲所有玩家的紀錄
+    target = None if request.get("all_players") else (request.get("username") or username)
+    game_id = request.get("game_id")
+    if target is None and game_id is None:
+        return create_response(False, "請指定玩家或遊戲")
+    
+    matches, next_before = match_store.history(target, game_id, before, limit)
+    return create_response(True, "查詢成功", {
+        "matches": matches,
+        "next_before": next_before
+    })
+
+def handle_get_player_stats(request):
+    """取得玩家的累計戰績 (預先計算的統計，不掃描對戰紀錄)"""
+    session_id = request.get("session_id")
+    username = verify_session(session_id, "players")
+    
+    if not username:
+        return create_response(False, "請先登入")
+    
+    target = request.get("username") or username
+    stats = match_store.player_stats(target)
+    if stats is None:
+        if target not in load_database()["players"]:
+            return create_response(False, "玩家不存在")
+        stats = {"played": 0, "wins": 0, "win_rate": 0, "last_played": None, "games": {}}
+    
+    # 各遊戲的積分 (rd 越小代表積分越可靠)
+    for game_id, game_stats in stats["games"].items():
+        game_stats.update(ratings.profile(game_id, target))
+    
+    return create_response(True, "查詢成功", {"username": target, **stats})
+
+LEADERBOARD_MAX_LIMIT = 100
+
+def handle_get_leaderboard(request):
+    """取得遊戲排行榜 (預先排序，只讀取需要的名次) 與查詢者的名次"""
+    session_id = request.get("session_id")
+    username = verify_session(session_id, "players")
+    
+    if not username:
+        return create_response(False, "請先登入")
+    
+    game_id = request.get("game_id")
+    board = request.get("board") or "rating"
+    if not game_id:
+        return create_response(False, "請指定遊戲")
+    if board not in LEADERBOARD_BOARDS:
+        return create_response(False, f"排行種類必須是 {', '.join(LEADERBOARD_BOARDS)}")
+    
+    try:
+        limit = min(max(int(request.get("limit") or 10), 1), LEADERBOARD_MAX_LIMIT)
+        offset = max(int(request.get("offset") or 0), 0)
+    except (TypeError, ValueError):
+        return create_response(False, "offset / limit 格式錯誤")
+    
+    entries, total = leaderboards.top(game_id, board, offset, limit)
+    target = request.get("username") or username
+    return create_response(True, "查詢成功", {
+        "game_id": game_id,
+        "board": board,
+        "total": total,
+        "min_games": leaderboards.min_games,
+        "entries": entries,
+        "player": leaderboards.lookup(game_id, board, target)
     })
 
 # ========================= 大廳資訊 =========================
@@ -1121,21 +2177,19 @@ def handle_get_lobby_info(request):
     username = verify_session(session_id, "players")
     
     # 線上玩家
-    online_players = []
-    for sid, session in active_sessions.items():
-        if session["type"] == "players":
-            online_players.append(session["username"])
+    online_players = [name for name, _ in sessions.online("players")]
     
     # 房間列表
     rooms_list = []
-    for room_id, room in rooms.items():
+    for room in room_registry.find():
+        summary = room.summary()
         rooms_list.append({
-            "room_id": room_id,
-            "game_name": room["game_name"],
-            "host": room["host"],
-            "player_count": len(room["players"]),
-            "max_players": room["max_players"],
-            "status": room["status"]
+            "room_id": summary["room_id"],
+            "game_name": summary["game_name"],
+            "host": summary["host"],
+            "player_count": summary["player_count"],
+            "max_players": summary["max_players"],
+            "status": summary["status"]
         })
     
     # 遊戲數量
@@ -1192,38 +2246,185 @@ def handle_download_plugin(request, client_socket):
     except Exception as e:
         print(f"[Error] Failed to send plugin: {e}")
 
-def cleanup_user_from_rooms(username):
-    """清理使用者在房間的狀態"""
-    # 複製 keys 以避免迭代時修改字典錯誤
-    for room_id in list(rooms.keys()):
-        if room_id not in rooms: continue # 可能已被刪除
-        
-        room = rooms[room_id]
-        if username in room["players"]:
-            room["players"].remove(username)
-            if "ready_players" in room and username in room["ready_players"]:
-                room["ready_players"].remove(username)
-            print(f"[Room] {username} removed from room {room_id} (disconnect)")
+# ========================= 遊戲主機 =========================
+
+def verify_agent(request, client_address):
+    """驗證遊戲主機：有設定 GAME_AGENT_SECRET 時比對密鑰，否則只接受本機連線"""
+    if GAME_AGENT_SECRET:
+        return hmac.compare_digest(str(request.get("secret", "")), GAME_AGENT_SECRET)
+    return client_address[0] in ("127.0.0.1", "::1")
+
+def handle_agent_session(request, client_socket, client_address):
+    """
+    遊戲主機的控制連線：註冊後持續接收狀態回報、指令回覆與 Game Server 事件，直到斷線
+    (佔用這條連線的處理執行緒)
+    """
+    if not verify_agent(request, client_address):
+        send_json(client_socket, create_response(False, "遊戲主機驗證失敗"))
+        return
+    
+    agent_id = str(request.get("agent_id") or "").strip()
+    if not agent_id:
+        send_json(client_socket, create_response(False, "缺少遊戲主機 ID"))
+        return
+    
+    try:
+        capacity = int(request.get("capacity", 0))
+        free_ports = int(request.get("free_ports", 0))
+    except (TypeError, ValueError):
+        send_json(client_socket, create_response(False, "容量格式錯誤"))
+        return
+    
+    agent, error = agent_registry.register(
+        agent_id, request.get("host") or client_address[0], client_socket,
+        capacity, free_ports, request.get("versions", [])
+    )
+    if error:
+        send_json(client_socket, create_response(False, error))
+        return
+    
+    agent_registry.send(agent, create_response(True, "註冊成功", {"agent_id": agent_id}))
+    print(f"[Agent] Game host {agent_id} registered ({agent.host}, capacity {capacity})")
+    
+    try:
+        while True:
+            message = recv_json(client_socket)
+            if message is None:
+                break
             
-            # 如果房間空了，刪除房間
-            if not room["players"]:
-                # 停止遊戲伺服器
-                if room_id in game_servers:
-                    try:
-                        game_servers[room_id].terminate()
-                        game_servers[room_id].wait(timeout=1)
-                    except:
-                        pass
-                    del game_servers[room_id]
-                
-                release_port(room["port"])
-                del rooms[room_id]
-                print(f"[Room] Room {room_id} deleted (empty)")
+            kind = message.get("type")
+            room_id = message.get("room_id")
             
-            # 如果是房主離開，轉移房主
-            elif room["host"] == username:
-                room["host"] = room["players"][0]
-                print(f"[Room] Host transferred to {room['host']} in room {room_id}")
+            if kind == "REPLY":
+                agent_registry.deliver(agent, message)
+            elif kind == "STATUS":
+                agent_registry.update(agent, message)
+                stale = unreferenced_versions(message.get("versions") or [])
+                if stale:
+                    agent_registry.send(agent, {"type": "PRUNE", "versions": stale})
+            elif kind == "GAME_CONTROL":
+                # 主機轉送的 Game Server 控制訊息 (token 已由主機驗證)，只接受配置在這台主機上的房間
+                if agent_registry.agent_of(room_id) is agent:
+                    agent_game_control(room_id, message.get("message") or {})
+            elif kind == "GAME_EXIT":
+                if agent_registry.release(room_id, agent):
+                    handle_game_server_exit(room_id, message.get("returncode"), message.get("expected", False),
+                                            message.get("stderr_tail", ""))
+    finally:
+        # 主機離線時，上面的遊戲視為異常結束
+        room_ids = agent_registry.unregister(agent)
+        print(f"[Agent] Game host {agent_id} disconnected ({len(room_ids)} rooms affected)")
+        for room_id in room_ids:
+            handle_game_server_exit(room_id, -1, False, "遊戲主機離線")
+
+def unreferenced_versions(versions):
+    """
+    遊戲主機回報的版本 ("game_id/version_dir") 中，大廳儲存區已沒有的版本
+    (大廳清理舊版本時會保留目前版本與使用中的版本，已被刪除的版本不會再配置到主機)
+    """
+    stale = []
+    for key in versions:
+        game_id, sep, version_dir = str(key).partition('/')
+        if not sep:
+            continue
+        game_storage = get_game_storage(game_id)
+        if os.path.isdir(os.path.join(game_storage, version_dir)):
+            continue
+        if version_dir == game_id and os.path.isdir(game_storage):
+            # 舊版單一目錄的遊戲 (沒有版本子目錄)
+            continue
+        stale.append(key)
+    return stale
+
+def agent_game_control(room_id, message):
+    """遊戲主機轉送的控制訊息：連線狀態另以 CONNECTED / DISCONNECTED 通知"""
+    kind = message.get("type")
+    if kind in ("CONNECTED", "DISCONNECTED"):
+        channel = game_channels.get(room_id)
+        if channel:
+            (game_channels.connect if kind == "CONNECTED" else game_channels.disconnect)(channel)
+        return
+    game_control_message(room_id, message)
+
+def handle_agent_fetch_game(request, client_socket, client_address):
+    """遊戲主機下載指定的遊戲版本 (成功時檔案直接送出，只有錯誤時回傳 response)"""
+    if not verify_agent(request, client_address):
+        return create_response(False, "遊戲主機驗證失敗")
+    
+    game_id = request.get("game_id")
+    version_dir = str(request.get("version_dir") or "")
+    
+    if game_id not in load_database().get("games", {}):
+        return create_response(False, "遊戲不存在")
+    if not version_dir or version_dir.startswith('.') or os.path.basename(version_dir) != version_dir:
+        return create_response(False, "遊戲版本不存在")
+    
+    game_storage = get_game_storage(game_id)
+    game_dir = resolve_game_dir(game_storage, version_dir)
+    if not game_dir or os.path.basename(game_dir) != version_dir:
+        return create_response(False, "遊戲版本不存在")
+    
+    try:
+        zip_path = get_download_artifact(game_storage, game_dir)
+    except Exception as e:
+        return create_response(False, f"打包失敗: {e}")
+    
+    send_json(client_socket, create_response(True, "準備傳送檔案", {"game_id": game_id, "version_dir": version_dir}))
+    
+    ack = recv_json(client_socket)
+    if not ack or ack.get("status") != "READY":
+        return None
+    
+    success, msg = send_file(client_socket, zip_path)
+    if success:
+        print(f"[Agent] Sent {game_id}/{version_dir} to game host {request.get('agent_id')}")
+    else:
+        print(f"[Agent] Failed to send {game_id}/{version_dir}: {msg}")
+    return None
+
+# ========================= 伺服器狀態 =========================
+
+def handle_get_server_metrics(request):
+    """取得伺服器資源使用統計 (只開放給已登入的開發者)"""
+    if not verify_session(request.get("session_id"), "developers"):
+        return create_response(False, "請先以開發者身分登入")
+    
+    return create_response(True, "查詢成功", {
+        "ports": port_allocator.metrics(),
+        "rooms": room_registry.metrics(),
+        "matchmaking": matchmaker.metrics(),
+        "game_servers": game_supervisor.metrics(),
+        "game_resources": game_supervisor.resource_usage(),
+        "warm_pool": warm_pool.metrics(),
+        "hosted_games": game_host.metrics(),
+        "agents": agent_registry.metrics(),
+        "reaper": dict(reaper_stats),
+        "sessions": sessions.metrics(),
+        "login_limits": {
+            "ip": login_ip_limiter.metrics(),
+            "user": login_user_limiter.metrics(),
+            "credentials": credential_cache.metrics(),
+            "credential_loads": credential_loads.metrics()
+        },
+        "game_channels": game_channels.metrics(),
+        "matches": match_store.metrics(),
+        "leaderboards": leaderboards.metrics(),
+        "ratings": ratings.metrics()
+    })
+
+def cleanup_user_from_rooms(username):
+    """清理使用者在房間的狀態"""
+    room, deleted = room_registry.leave_current(username)
+    if not room:
+        return
+    
+    print(f"[Room] {username} removed from room {room.room_id} (disconnect)")
+    
+    # 如果房間空了，停止遊戲伺服器並釋放資源
+    if deleted:
+        dispose_room(room)
+    else:
+        notify_ready_state(room)
 
 # ========================= Client 處理 =========================
 
@@ -1248,43 +2449,57 @@ def handle_client(client_socket, client_address):
             # ===== 開發者操作 =====
             if client_type == "developer":
                 if action == "REGISTER":
-                    response = handle_register(request, "developers")
+                    response = handle_register(request, "developers", client_address)
                 elif action == "LOGIN":
-                    response = handle_login(request, "developers", client_socket)
+                    response = handle_login(request, "developers", client_socket, client_address)
                     if response.get("success"):
                         current_session = response["data"]["session_id"]
                 elif action == "LOGOUT":
                     response = handle_logout(request, "developers")
                     current_session = None
+                elif action == "RESUME":
+                    response = handle_resume(request, "developers", client_socket)
+                    if response.get("success"):
+                        current_session = response["data"]["session_id"]
                 elif action == "UPLOAD_GAME":
                     response = handle_upload_game(request, client_socket)
                 elif action == "UPDATE_GAME":
                     response = handle_update_game(request, client_socket)
+                elif action == "GET_GAME_MANIFEST":
+                    response = handle_get_game_manifest(request)
                 elif action == "UNPUBLISH_GAME":
                     response = handle_unpublish_game(request)
                 elif action == "LIST_MY_GAMES":
                     response = handle_list_my_games(request)
+                elif action == "GET_SERVER_METRICS":
+                    response = handle_get_server_metrics(request)
                 else:
                     response = create_response(False, "未知的操作")
             
             # ===== 玩家操作 =====
             elif client_type == "player":
                 if action == "REGISTER":
-                    response = handle_register(request, "players")
+                    response = handle_register(request, "players", client_address)
                 elif action == "LOGIN":
-                    response = handle_login(request, "players", client_socket)
+                    response = handle_login(request, "players", client_socket, client_address)
                     if response.get("success"):
                         current_session = response["data"]["session_id"]
                 elif action == "LOGOUT":
                     response = handle_logout(request, "players")
                     current_session = None
+                elif action == "RESUME":
+                    response = handle_resume(request, "players", client_socket)
+                    if response.get("success"):
+                        current_session = response["data"]["session_id"]
                 elif action == "LIST_GAMES":
                     response = handle_list_games(request)
                 elif action == "GET_GAME_DETAIL":
                     response = handle_get_game_detail(request)
                 elif action == "DOWNLOAD_GAME":
-                    handle_download_game(request, client_socket)
-                    continue  # 回應已在函式內處理
+                    # 成功時回應已在函式內處理，只有錯誤時回傳 response
+                    # 傳檔期間不能穿插推播，推播先暫存到傳輸結束
+                    with client_transfer(client_socket):
+                        response = handle_download_game(request, client_socket)
                 elif action == "CREATE_ROOM":
                     response = handle_create_room(request)
                 elif action == "JOIN_ROOM":
@@ -1297,14 +2512,24 @@ def handle_client(client_socket, client_address):
                     response = handle_leave_room(request)
                 elif action == "LIST_ROOMS":
                     response = handle_list_rooms(request)
+                elif action == "GET_ROOM":
+                    response = handle_get_room(request)
                 elif action == "START_GAME":
                     response = handle_start_game(request)
-                elif action == "REPORT_GAME_RESULT":
-                    response = handle_report_game_result(request)
+                elif action == "QUICK_MATCH":
+                    response = handle_quick_match(request)
+                elif action == "CANCEL_MATCH":
+                    response = handle_cancel_match(request)
                 elif action == "END_GAME":
                     response = handle_end_game(request)
                 elif action == "ADD_REVIEW":
                     response = handle_add_review(request)
+                elif action == "GET_MATCH_HISTORY":
+                    response = handle_get_match_history(request)
+                elif action == "GET_PLAYER_STATS":
+                    response = handle_get_player_stats(request)
+                elif action == "GET_LEADERBOARD":
+                    response = handle_get_leaderboard(request)
                 elif action == "GET_PLAYER_PROFILE":
                     response = handle_get_player_profile(request)
                 elif action == "GET_LOBBY_INFO":
@@ -1312,36 +2537,58 @@ def handle_client(client_socket, client_address):
                 elif action == "LIST_PLUGINS":
                     response = handle_list_plugins(request)
                 elif action == "DOWNLOAD_PLUGIN":
-                    handle_download_plugin(request, client_socket)
+                    with client_transfer(client_socket):
+                        handle_download_plugin(request, client_socket)
                     continue
                 else:
                     response = create_response(False, "未知的操作")
             
+            # ===== Game Server =====
+            elif client_type == "game_server":
+                if action == "GAME_CONTROL":
+                    # 之後這條連線作為 Game Server 的控制連線，直到斷線
+                    handle_game_control(request, client_socket)
+                    break
+                elif action == "REPORT_GAME_RESULT":
+                    response = handle_report_game_result(request)
+                else:
+                    response = create_response(False, "未知的操作")
+            
+            # ===== 遊戲主機 =====
+            elif client_type == "agent":
+                if action == "AGENT_REGISTER":
+                    # 之後這條連線作為遊戲主機的控制連線，直到斷線
+                    handle_agent_session(request, client_socket, client_address)
+                    break
+                elif action == "AGENT_FETCH_GAME":
+                    with client_transfer(client_socket):
+                        response = handle_agent_fetch_game(request, client_socket, client_address)
+                else:
+                    response = create_response(False, "未知的操作")
+            
             else:
                 response = create_response(False, "請指定 client_type (developer/player)")
             
             if response:
-                send_json(client_socket, response)
+                send_to_client(client_socket, response)
     
     except Exception as e:
         print(f"[Error] Error handling client {client_address}: {e}")
     
     finally:
-        # 清理 Session
-        if current_session and current_session in active_sessions:
-            username = active_sessions[current_session]["username"]
-            user_type = active_sessions[current_session]["type"]
+        # 清理 Session (已在別處重新登入或重新連線則保留新的連線)
+        if current_session and sessions.resume_grace:
+            # 保留 Session 與房間，寬限時間內可用 RESUME 接回 (逾時由回收執行緒清理)
+            session = sessions.detach(current_session, client_socket)
+            if session and session.user_type == "players":
+                matchmaker.cancel(session.username)
+        elif current_session:
+            session = sessions.remove(current_session, client_socket)
             
             # 如果是玩家，清理房間狀態
-            if user_type == "players":
-                cleanup_user_from_rooms(username)
-            
-            del active_sessions[current_session]
-            
-            db = load_database()
-            if username in db.get(user_type, {}):
-                db[user_type][username]["session_id"] = None
-                save_database(db)
+            if session and session.user_type == "players":
+                matchmaker.cancel(session.username)
+                cleanup_user_from_rooms(session.username)
         
         client_socket.close()
         print(f"[Disconnect] Connection closed: {client_address}")
@@ -1363,6 +2610,13 @@ def main():
             "rooms": {}
         })
     
+    # 讀取積分快照，再重建對戰統計與索引 (積分只計算快照之後的場次)
+    rated_until = ratings.load()
+    match_count = match_store.load()
+    if rated_until > match_count:
+        print(f"[Rating] Snapshot covers match {rated_until} but the log only has {match_count}, continuing from the log")
+        ratings.rewind(match_count)
+    
     # 建立 Server Socket
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -1373,8 +2627,13 @@ def main():
         print(f"=" * 50)
         print(f"  Game Store Server 啟動")
         print(f"  監聽位址: {SERVER_HOST}:{SERVER_PORT}")
+        print(f"  已載入對戰紀錄: {match_count} 場")
         print(f"=" * 50)
         
+        # 啟動快速配對執行緒與房間回收執行緒 (託管遊戲的事件迴圈在第一次有託管房間時才啟動)
+        matchmaker.start(start_match, expire_match)
+        threading.Thread(target=run_reaper, daemon=True).start()
+        
         while True:
             client_socket, client_address = server_socket.accept()
             client_thread = threading.Thread(
@@ -1388,12 +2647,21 @@ def main():
         print("\n[Server] 正在關閉...")
     finally:
         # 清理所有遊戲伺服器
-        for room_id, process in game_servers.items():
-            try:
-                process.terminate()
-            except:
-                pass
+        game_supervisor.stop_all()
         server_socket.close()
+        
+        # 寫入尚未寫入的 played_games (連續兩次：第二次確認已寫入)
+        try:
+            flush_played_games()
+            flush_played_games()
+        except OSError as e:
+            print(f"[Server] Failed to save played games: {e}")
+        
+        # 寫出最新的積分快照
+        try:
+            ratings.save()
+        except OSError as e:
+            print(f"[Rating] Failed to save snapshot: {e}")
         print("[Server] 已關閉")
 
 if __name__ == "__main__":
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Game Store System - Session 管理
+Session 只存在記憶體中 (大廳重啟後需重新登入)，同時以 session_id 與 (使用者類型, 帳號) 索引，
+登入 / 登出 / 斷線都不需要寫入資料庫；連線中斷後 Session 保留一段寬限時間，可用 RESUME 接回新的連線
+"""
+
+import time
+import uuid
+import threading
+
+class Session:
+    """一個登入中的使用者"""
+    __slots__ = ("session_id", "username", "user_type", "socket", "created_at", "last_seen", "detached_at")
+    
+    def __init__(self, session_id, username, user_type, client_socket):
+        self.session_id = session_id
+        self.username = username
+        self.user_type = user_type        # "developers" / "players"
+        self.socket = client_socket       # 目前的連線 (推播用)，斷線等待接回時為 None
+        self.created_at = time.time()
+        self.last_seen = time.monotonic()
+        self.detached_at = None           # 連線中斷的時間 (monotonic)
+
+class SessionManager:
+    """
+    Session 表
+    - 每個帳號同時只有一個 Session，重新登入時取代舊的 (由呼叫端通知並關閉舊連線)
+    - 每次驗證都會更新最後活動時間，超過 idle_ttl 秒沒有任何請求的 Session 視為過期
+      (verify() / resume() 只拒絕過期的 Session，一律由 expire() 移除，讓呼叫端能清理配對與房間)
+    - 連線中斷時 detach() 只拿掉連線，resume_grace 秒內以 resume() 接回新連線；超過寬限時間由 expire() 移除
+    """
+    
+    def __init__(self, idle_ttl=12 * 3600, resume_grace=60):
+        self.idle_ttl = idle_ttl
+        self.resume_grace = resume_grace
+        self.lock = threading.Lock()
+        self.by_id = {}    # session_id -> Session
+        self.by_user = {}  # (user_type, username) -> Session
+        
+        # 統計
+        self.logins = 0
+        self.resumed = 0
+        self.expired = 0
+    
+    def create(self, user_type, username, client_socket):
+        """建立新 Session，回傳 (session, 被取代的舊 Session 或 None)"""
+        session = Session(str(uuid.uuid4()), username, user_type, client_socket)
+        with self.lock:
+            old = self.by_user.get((user_type, username))
+            if old is not None:
+                del self.by_id[old.session_id]
+            self.by_id[session.session_id] = session
+            self.by_user[(user_type, username)] = session
+            self.logins += 1
+        return session, old
+    
+    def remove(self, session_id, client_socket=None):
+        """
+        移除 Session 並回傳；client_socket 不是 Session 目前的連線時不移除
+        (例如舊連線在重新登入後才斷線)
+        """
+        with self.lock:
+            session = self.by_id.get(session_id)
+            if session is None or (client_socket is not None and session.socket is not client_socket):
+                return None
+            self.drop(session)
+            return session
+    
+    def detach(self, session_id, client_socket):
+        """連線中斷，保留 Session 等待接回；client_socket 不是 Session 目前的連線時回傳 None"""
+        with self.lock:
+            session = self.by_id.get(session_id)
+            if session is None or session.socket is not client_socket:
+                return None
+            session.socket = None
+            session.detached_at = time.monotonic()
+            return session
+    
+    def resume(self, session_id, user_type, client_socket):
+        """
+        把新連線接回既有的 Session，回傳 (session, 被取代的舊連線)
+        Session 不存在 (已過期或已登出) 時回傳 (None, None)
+        """
+        with self.lock:
+            session = self.by_id.get(session_id)
+            if session is None or session.user_type != user_type or self.is_stale(session, time.monotonic()):
+                return None, None
+            old_socket = session.socket
+            session.socket = client_socket
+            session.detached_at = None
+            session.last_seen = time.monotonic()
+            self.resumed += 1
+            return session, old_socket
+    
+    def drop(self, session):
+        """從兩個索引移除 (需持有 self.lock)"""
+        self.by_id.pop(session.session_id, None)
+        if self.by_user.get((session.user_type, session.username)) is session:
+            del self.by_user[(session.user_type, session.username)]
+    
+    def is_stale(self, session, now):
+        """閒置過久，或斷線超過寬限時間"""
+        return bool((self.idle_ttl and now - session.last_seen > self.idle_ttl)
+                    or (session.detached_at is not None and now - session.detached_at > self.resume_grace))
+    
+    def verify(self, session_id, user_type):
+        """驗證 Session 並更新活動時間，成功時回傳帳號 (過期的 Session 留給 expire() 移除)"""
+        now = time.monotonic()
+        with self.lock:
+            session = self.by_id.get(session_id)
+            if session is None or session.user_type != user_type or self.is_stale(session, now):
+                return None
+            session.last_seen = now
+            return session.username
+    
+    def has(self, user_type, username):
+        """帳號是否有 Session (含斷線等待接回中)"""
+        with self.lock:
+            return (user_type, username) in self.by_user
+    
+    def socket_of(self, user_type, username):
+        """帳號目前的連線 (不在線時回傳 None)"""
+        with self.lock:
+            session = self.by_user.get((user_type, username))
+            return session.socket if session else None
+    
+    def online(self, user_type):
+        """在線的 (帳號, 連線) 列表 (不含斷線等待接回中的 Session)"""
+        with self.lock:
+            return [
+                (session.username, session.socket)
+                for (kind, _), session in self.by_user.items() if kind == user_type and session.socket
+            ]
+    
+    def expire(self):
+        """移除閒置過久、或斷線超過寬限時間的 Session 並回傳 (定期呼叫)"""
+        now = time.monotonic()
+        with self.lock:
+            stale = [session for session in self.by_id.values() if self.is_stale(session, now)]
+            for session in stale:
+                self.drop(session)
+            self.expired += len(stale)
+        return stale
+    
+    def metrics(self):
+        with self.lock:
+            counts = {}
+            for user_type, _ in self.by_user:
+                counts[user_type] = counts.get(user_type, 0) + 1
+            return {
+                "active": len(self.by_id),
+                "detached": sum(1 for session in self.by_id.values() if session.socket is None),
+                "by_type": counts,
+                "logins": self.logins,
+                "resumed": self.resumed,
+                "expired": self.expired
+            }
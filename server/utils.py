@@ -1,4 +1,3 @@
-import socket
 import json
 import struct
 import os
@@ -59,64 +58,257 @@ def recv_all(sock, n):
     輔助函式：確保一定讀滿 n 個 bytes 才會返回
     解決 TCP 斷包問題
     """
-    data = b''
+    data = bytearray()
     while len(data) < n:
         packet = sock.recv(n - len(data))
         if not packet:
             return None
         data += packet
-    return data
+    return bytes(data)
 
 # ========================= 檔案傳輸功能 =========================
+# 傳輸流程:
+#   1. 傳送端送出 metadata (FILE_TRANSFER)，包含雜湊演算法、區塊大小，
+#      已知時附上整體摘要 digest 與每個區塊的雜湊 chunks (區塊樹)
+#   2. 接收端回覆 READY，可帶 offset 要求從已驗證的區塊之後續傳，
+#      或帶 hash 要求改用其他雜湊演算法
+#   3. 傳送端送出檔案內容；metadata 中沒有摘要時，於傳送的同時計算，
+#      並在內容之後送出結尾 JSON (digest/chunks)
+#   4. 接收端逐區塊驗證並回覆 SUCCESS / FAILED
 
-def send_file(sock, file_path):
+HASH_ALGORITHMS = ("blake2b", "sha256", "md5")
+DEFAULT_HASH = "blake2b"
+CHUNK_SIZE = 1024 * 1024
+# 接收端接受的區塊大小範圍 (由傳送端的 metadata 指定)
+MIN_CHUNK_SIZE = 4 * 1024
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+HASHINFO_SUFFIX = '.hashinfo.json'
+
+def new_hash(algorithm):
+    """建立雜湊物件 (BLAKE2b 使用 32 bytes 摘要)"""
+    if algorithm == "blake2b":
+        return hashlib.blake2b(digest_size=32)
+    return hashlib.new(algorithm)
+
+def valid_chunk_size(chunk_size):
+    """區塊大小需為 MIN_CHUNK_SIZE ~ MAX_CHUNK_SIZE 之間的整數"""
+    return (isinstance(chunk_size, int) and not isinstance(chunk_size, bool)
+            and MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE)
+
+class ChunkTreeHasher:
+    """
+    邊讀取資料邊計算區塊樹：每 chunk_size 個 bytes 一個區塊雜湊，
+    整體摘要為所有區塊雜湊串接後的雜湊值
+    """
+    
+    def __init__(self, algorithm=DEFAULT_HASH, chunk_size=CHUNK_SIZE, chunks=None):
+        if not valid_chunk_size(chunk_size):
+            raise ValueError(f"chunk_size 不合法: {chunk_size!r}")
+        self.algorithm = algorithm
+        self.chunk_size = chunk_size
+        self.chunks = list(chunks or [])  # 已完成的區塊雜湊 (hex)
+        self._current = new_hash(algorithm)
+        self._current_len = 0
+    
+    def update(self, data):
+        view = memoryview(data)
+        while len(view):
+            take = min(self.chunk_size - self._current_len, len(view))
+            self._current.update(view[:take])
+            self._current_len += take
+            view = view[take:]
+            if self._current_len == self.chunk_size:
+                self.chunks.append(self._current.hexdigest())
+                self._current = new_hash(self.algorithm)
+                self._current_len = 0
+    
+    def finish(self):
+        """結束計算，回傳 (整體摘要, 區塊雜湊列表)"""
+        if self._current_len or not self.chunks:
+            self.chunks.append(self._current.hexdigest())
+            self._current = new_hash(self.algorithm)
+            self._current_len = 0
+        return chunk_tree_root(self.algorithm, self.chunks), self.chunks
+
+def chunk_tree_root(algorithm, chunks):
+    """由區塊雜湊列表計算整體摘要"""
+    root = new_hash(algorithm)
+    for chunk_hash in chunks:
+        root.update(bytes.fromhex(chunk_hash))
+    return root.hexdigest()
+
+def load_hashinfo(file_path, algorithm=DEFAULT_HASH):
+    """讀取和檔案放在一起的雜湊快取，檔案大小或修改時間不同則視為失效"""
+    try:
+        stat = os.stat(file_path)
+        with open(file_path + HASHINFO_SUFFIX, 'r', encoding='utf-8') as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        return None
+    
+    if (info.get("hash") != algorithm or info.get("size") != stat.st_size
+            or info.get("mtime") != stat.st_mtime_ns or info.get("chunk_size") != CHUNK_SIZE):
+        return None
+    return info
+
+def save_hashinfo(file_path, algorithm, digest, chunks, stat=None):
+    """將檔案的雜湊值存成快取，之後傳送時不必重新計算"""
+    try:
+        stat = stat or os.stat(file_path)
+        info = {
+            "hash": algorithm,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "chunk_size": CHUNK_SIZE,
+            "digest": digest,
+            "chunks": chunks
+        }
+        tmp_path = f"{file_path}{HASHINFO_SUFFIX}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(info, f)
+        os.replace(tmp_path, file_path + HASHINFO_SUFFIX)
+        return info
+    except OSError:
+        return None
+
+def describe_file(file_path, algorithm=DEFAULT_HASH):
+    """取得檔案的區塊樹雜湊 (優先使用快取，沒有則計算並存檔)"""
+    info = load_hashinfo(file_path, algorithm)
+    if info:
+        return info
+    
+    stat = os.stat(file_path)
+    hasher = ChunkTreeHasher(algorithm)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            hasher.update(chunk)
+    digest, chunks = hasher.finish()
+    return save_hashinfo(file_path, algorithm, digest, chunks, stat) or {
+        "hash": algorithm, "chunk_size": CHUNK_SIZE, "digest": digest, "chunks": chunks
+    }
+
+def send_file(sock, file_path, algorithm=DEFAULT_HASH):
     """
     發送檔案：先傳 metadata (JSON)，再傳檔案內容 (binary)
+    已有雜湊快取時 metadata 直接附上區塊樹 (接收端可逐區塊驗證與續傳)；
+    沒有快取時在傳送的同時計算，於結尾送出並存成快取
     """
     try:
         if not os.path.exists(file_path):
             return False, "檔案不存在"
         
-        file_size = os.path.getsize(file_path)
+        stat = os.stat(file_path)
+        file_size = stat.st_size
         file_name = os.path.basename(file_path)
-        
-        # 計算檔案 MD5 用於驗證
-        md5_hash = hashlib.md5()
-        with open(file_path, 'rb') as f:
-            for chunk in iter(lambda: f.read(8192), b''):
-                md5_hash.update(chunk)
-        file_md5 = md5_hash.hexdigest()
+        info = load_hashinfo(file_path, algorithm)
         
         # 1. 先發送 metadata
         metadata = {
             "type": "FILE_TRANSFER",
             "filename": file_name,
             "filesize": file_size,
-            "md5": file_md5
+            "hash": algorithm,
+            "hash_algorithms": list(HASH_ALGORITHMS),
+            "chunk_size": CHUNK_SIZE
         }
+        if info:
+            metadata["digest"] = info["digest"]
+            metadata["chunks"] = info["chunks"]
         send_json(sock, metadata)
         
-        # 2. 等待對方準備好
+        # 2. 等待對方準備好 (可能要求續傳或改用其他雜湊演算法)
         response = recv_json(sock)
         if not response or response.get("status") != "READY":
-            return False, "對方未準備好接收"
+            return False, (response or {}).get("message", "對方未準備好接收")
+        
+        negotiated = response.get("hash", algorithm)
+        if negotiated not in HASH_ALGORITHMS:
+            return False, f"不支援的雜湊演算法: {negotiated}"
+        
+        need_trailer = info is None or negotiated != algorithm
+        offset = 0
+        if not need_trailer:
+            offset = min(max(int(response.get("offset", 0)), 0), file_size)
+        hasher = ChunkTreeHasher(negotiated) if need_trailer else None
         
-        # 3. 發送檔案內容
+        # 3. 發送檔案內容 (需要時同時計算雜湊)
         with open(file_path, 'rb') as f:
-            sent = 0
+            f.seek(offset)
+            sent = offset
             while sent < file_size:
-                chunk = f.read(8192)
+                chunk = f.read(65536)
                 if not chunk:
                     break
                 sock.sendall(chunk)
+                if hasher:
+                    hasher.update(chunk)
                 sent += len(chunk)
         
+        if need_trailer:
+            digest, chunks = hasher.finish()
+            send_json(sock, {"filesize": sent, "hash": negotiated, "digest": digest, "chunks": chunks})
+            if info is None and negotiated == algorithm:
+                save_hashinfo(file_path, algorithm, digest, chunks, stat)
+        
         # 4. 等待確認
         ack = recv_json(sock)
         if ack and ack.get("status") == "SUCCESS":
             return True, "檔案傳輸成功"
         else:
-            return False, ack.get("message", "傳輸失敗")
+            return False, ack.get("message", "傳輸失敗") if ack else "傳輸失敗"
+            
+    except Exception as e:
+        return False, str(e)
+
+def send_file_stream(sock, file_name, chunks, algorithm=DEFAULT_HASH):
+    """
+    以分塊串流發送檔案 (事先不知道總大小，例如邊壓縮邊傳送)
+    每個區塊為 [4 bytes 長度] + 內容，長度 0 代表結束，之後再送出含區塊樹的結尾 JSON
+    雜湊在傳送的同時計算，不需要另外讀一次檔案
+    """
+    try:
+        # 1. 先發送 metadata
+        metadata = {
+            "type": "FILE_TRANSFER",
+            "filename": file_name,
+            "filesize": None,
+            "chunked": True,
+            "hash": algorithm,
+            "hash_algorithms": list(HASH_ALGORITHMS),
+            "chunk_size": CHUNK_SIZE
+        }
+        send_json(sock, metadata)
+        
+        # 2. 等待對方準備好
+        response = recv_json(sock)
+        if not response or response.get("status") != "READY":
+            return False, (response or {}).get("message", "對方未準備好接收")
+        
+        negotiated = response.get("hash", algorithm)
+        if negotiated not in HASH_ALGORITHMS:
+            return False, f"不支援的雜湊演算法: {negotiated}"
+        
+        # 3. 邊產生邊發送
+        hasher = ChunkTreeHasher(negotiated)
+        sent = 0
+        for chunk in chunks:
+            if not chunk:
+                continue
+            hasher.update(chunk)
+            sock.sendall(struct.pack('>I', len(chunk)) + chunk)
+            sent += len(chunk)
+        sock.sendall(struct.pack('>I', 0))
+        
+        # 4. 送出結尾 (檔案大小與區塊樹)
+        digest, chunk_hashes = hasher.finish()
+        send_json(sock, {"filesize": sent, "hash": negotiated, "digest": digest, "chunks": chunk_hashes})
+        
+        # 5. 等待確認
+        ack = recv_json(sock)
+        if ack and ack.get("status") == "SUCCESS":
+            return True, "檔案傳輸成功"
+        else:
+            return False, ack.get("message", "傳輸失敗") if ack else "傳輸失敗"
             
     except Exception as e:
         return False, str(e)
@@ -133,43 +325,151 @@ def recv_file(sock, save_dir):
     except Exception as e:
         return False, str(e), None
 
+def verify_partial(part_path, algorithm, chunk_size, expected_chunks):
+    """檢查先前中斷留下的部分檔案，回傳可續傳的位置 (已驗證區塊的結尾)"""
+    if not os.path.exists(part_path):
+        return 0
+    
+    verified = 0
+    with open(part_path, 'rb') as f:
+        for expected in expected_chunks:
+            data = f.read(chunk_size)
+            if len(data) < chunk_size:
+                break
+            chunk_hash = new_hash(algorithm)
+            chunk_hash.update(data)
+            if chunk_hash.hexdigest() != expected:
+                break
+            verified += 1
+    return verified * chunk_size
+
 def recv_file_with_metadata(sock, metadata, save_dir):
     """
     根據已收到的 metadata 接收檔案
+    metadata 附有區塊樹時逐區塊驗證，並可從先前中斷的位置續傳
     """
+    part_path = None
+    resumable = False
+    
     try:
         filename = metadata.get("filename")
         filesize = metadata.get("filesize")
-        expected_md5 = metadata.get("md5")
+        chunked = metadata.get("chunked", False)
+        algorithm = metadata.get("hash")
+        chunk_size = metadata.get("chunk_size", CHUNK_SIZE)
+        expected_digest = metadata.get("digest")
+        expected_chunks = metadata.get("chunks")
+        
+        # 區塊大小由傳送端指定，0 或負數會讓區塊計算無法前進
+        if not valid_chunk_size(chunk_size):
+            send_json(sock, {"status": "FAILED", "message": "chunk_size 不合法"})
+            return False, "chunk_size 不合法", None
         
         # 確保目錄存在
         os.makedirs(save_dir, exist_ok=True)
         save_path = os.path.join(save_dir, filename)
         
+        ready = {"status": "READY"}
+        legacy_md5 = algorithm is None  # 舊版傳送端只提供整個檔案的 MD5
+        if legacy_md5:
+            algorithm = "md5"
+            expected_digest = metadata.get("md5")
+            expected_chunks = None
+        elif algorithm not in HASH_ALGORITHMS:
+            # 協商改用雙方都支援的演算法，雜湊值改由傳送端在結尾送出
+            offered = metadata.get("hash_algorithms", [])
+            algorithm = next((alg for alg in HASH_ALGORITHMS if alg in offered), DEFAULT_HASH)
+            ready["hash"] = algorithm
+            expected_digest = None
+            expected_chunks = None
+        
+        # 已知區塊樹時，以摘要命名部分檔案，中斷後可從已驗證的區塊續傳
+        offset = 0
+        if expected_chunks and expected_digest:
+            resumable = True
+            part_path = os.path.join(save_dir, f".{expected_digest[:16]}.part")
+            offset = verify_partial(part_path, algorithm, chunk_size, expected_chunks)
+            ready["offset"] = offset
+        else:
+            part_path = save_path + '.part'
+        
         # 1. 回覆準備好了
-        send_json(sock, {"status": "READY"})
+        send_json(sock, ready)
         
         # 2. 接收檔案內容
-        received = 0
-        md5_hash = hashlib.md5()
-        
-        with open(save_path, 'wb') as f:
-            while received < filesize:
-                remaining = filesize - received
-                chunk_size = min(8192, remaining)
-                chunk = recv_all(sock, chunk_size)
-                if not chunk:
-                    return False, "傳輸中斷", None
+        received = offset
+        hasher = ChunkTreeHasher(algorithm, chunk_size, expected_chunks[:offset // chunk_size] if offset else None)
+        whole_hash = new_hash("md5") if legacy_md5 else None
+        
+        corrupted = False
+        
+        with open(part_path, 'r+b' if offset else 'wb') as f:
+            f.seek(offset)
+            f.truncate()
+            
+            def write_chunk(chunk):
+                nonlocal corrupted
+                if corrupted:
+                    return  # 仍需讀完剩餘內容，維持通訊同步
                 f.write(chunk)
-                md5_hash.update(chunk)
-                received += len(chunk)
+                hasher.update(chunk)
+                if whole_hash:
+                    whole_hash.update(chunk)
+                # 逐區塊驗證，錯誤時只保留驗證過的部分供續傳
+                if expected_chunks:
+                    done = len(hasher.chunks)
+                    if done and (done > len(expected_chunks) or hasher.chunks[done - 1] != expected_chunks[done - 1]):
+                        f.truncate((done - 1) * chunk_size)
+                        corrupted = True
+            
+            if chunked:
+                # 分塊串流: 讀到長度 0 的區塊為止
+                while True:
+                    header = recv_all(sock, 4)
+                    if not header:
+                        return False, "傳輸中斷", None
+                    chunk_len = struct.unpack('>I', header)[0]
+                    if chunk_len == 0:
+                        break
+                    chunk = recv_all(sock, chunk_len)
+                    if not chunk:
+                        return False, "傳輸中斷", None
+                    write_chunk(chunk)
+                    received += len(chunk)
+            else:
+                while received < filesize:
+                    remaining = filesize - received
+                    chunk = recv_all(sock, min(65536, remaining))
+                    if not chunk:
+                        return False, "傳輸中斷", None
+                    write_chunk(chunk)
+                    received += len(chunk)
+        
+        if corrupted:
+            send_json(sock, {"status": "FAILED", "message": "區塊驗證失敗"})
+            return False, "區塊驗證失敗", None
+        
+        # 摘要未事先提供時，由傳送端在結尾送出
+        if not legacy_md5 and not expected_digest:
+            trailer = recv_json(sock)
+            if not trailer:
+                return False, "傳輸中斷", None
+            expected_digest = trailer.get("digest")
+            expected_chunks = trailer.get("chunks")
         
-        # 3. 驗證 MD5
-        actual_md5 = md5_hash.hexdigest()
-        if actual_md5 != expected_md5:
-            os.remove(save_path)
-            send_json(sock, {"status": "FAILED", "message": "MD5 驗證失敗"})
-            return False, "MD5 驗證失敗", None
+        # 3. 驗證雜湊
+        actual_digest, actual_chunks = hasher.finish()
+        if legacy_md5:
+            actual_digest = whole_hash.hexdigest()
+        elif expected_chunks is not None and actual_chunks != expected_chunks:
+            actual_digest = None
+        
+        if actual_digest != expected_digest:
+            os.remove(part_path)
+            send_json(sock, {"status": "FAILED", "message": "檔案驗證失敗"})
+            return False, "檔案驗證失敗", None
+        
+        os.replace(part_path, save_path)
         
         # 4. 回覆成功
         send_json(sock, {"status": "SUCCESS"})
@@ -178,6 +478,68 @@ def recv_file_with_metadata(sock, metadata, save_dir):
     except Exception as e:
         send_json(sock, {"status": "FAILED", "message": str(e)})
         return False, str(e), None
+    
+    finally:
+        # 無法續傳的部分檔案直接刪除
+        if part_path and not resumable and os.path.exists(part_path):
+            try:
+                os.remove(part_path)
+            except OSError:
+                pass
+
+# ========================= 檔案清單 (Manifest) =========================
+# 遊戲目錄的檔案清單，用來比對兩個版本之間有哪些檔案變更:
+# {"algorithm": "sha256", "files": {"相對路徑": {"hash": ..., "size": ...}}}
+
+MANIFEST_ALGORITHM = "sha256"
+
+def hash_file(file_path, algorithm=MANIFEST_ALGORITHM):
+    """計算檔案的雜湊值"""
+    file_hash = hashlib.new(algorithm)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def walk_files(root_dir):
+    """依序列出目錄下所有檔案，回傳 (以 / 分隔的相對路徑, 完整路徑)"""
+    for root, dirs, files in os.walk(root_dir):
+        dirs.sort()
+        for file in sorted(files):
+            file_path = os.path.join(root, file)
+            yield os.path.relpath(file_path, root_dir).replace(os.sep, '/'), file_path
+
+def build_manifest(root_dir, cache=None):
+    """
+    建立目錄的檔案清單
+    cache: {相對路徑: {"mtime", "size", "hash"}}，大小與修改時間都沒變的檔案直接沿用雜湊值，
+           呼叫後 cache 會被更新為目前的狀態
+    """
+    files = {}
+    fresh_cache = {}
+    
+    for rel_path, file_path in walk_files(root_dir):
+        stat = os.stat(file_path)
+        cached = (cache or {}).get(rel_path)
+        if cached and cached.get("mtime") == stat.st_mtime_ns and cached.get("size") == stat.st_size:
+            file_hash = cached["hash"]
+        else:
+            file_hash = hash_file(file_path)
+        
+        files[rel_path] = {"hash": file_hash, "size": stat.st_size}
+        fresh_cache[rel_path] = {"mtime": stat.st_mtime_ns, "size": stat.st_size, "hash": file_hash}
+    
+    if cache is not None:
+        cache.clear()
+        cache.update(fresh_cache)
+    
+    return {"algorithm": MANIFEST_ALGORITHM, "files": files}
+
+def is_safe_relpath(rel_path):
+    """檢查清單中的相對路徑不會跳出目錄"""
+    if not rel_path or rel_path.startswith('/') or '\\' in rel_path or ':' in rel_path:
+        return False
+    return all(part not in ('', '.', '..') for part in rel_path.split('/'))
 
 # ========================= 輔助函式 =========================
 
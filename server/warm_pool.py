@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Game Store System - Game Server 預熱池
+為常被啟動的遊戲版本預先啟動閒置的 Game Server (game_bootstrap.py)，
+房間開始時透過 stdin 控制通道指派 Port / 房間，省下 Python 啟動與 import 的時間
+"""
+
+import os
+import json
+import math
+import time
+import itertools
+import threading
+from collections import deque
+
+BOOTSTRAP_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'game_bootstrap.py')
+PYTHON_NAMES = {'python', 'python3', 'python.exe', 'python3.exe', 'py'}
+
+def bootstrap_command(server_cmd):
+    """
+    server_command 為 python <script.py> [...] 時回傳預熱用的啟動指令，否則回傳 None
+    (預熱 process 不帶參數，script 之後的參數與 Port 等參數從控制通道送入)
+    """
+    if len(server_cmd) < 2:
+        return None
+    interpreter, script = server_cmd[0], server_cmd[1]
+    if os.path.basename(interpreter).lower() not in PYTHON_NAMES or not script.endswith('.py'):
+        return None
+    return [interpreter, BOOTSTRAP_SCRIPT, script]
+
+class WarmPool:
+    """
+    預熱池
+    - 依 (game_id, version_dir) 分組，每組保留的閒置數量依最近的啟動次數決定
+      (window_seconds 內每 starts_per_process 次啟動保留一個，上限 max_per_game)
+    - 遊戲更新或下架時淘汰舊版本的閒置 process；閒置超過 idle_timeout 也會淘汰
+    """
+    
+    def __init__(self, supervisor, max_per_game=2, window_seconds=600, starts_per_process=5, idle_timeout=1800):
+        self.supervisor = supervisor
+        self.max_per_game = max_per_game
+        self.window_seconds = window_seconds
+        self.starts_per_process = starts_per_process
+        self.idle_timeout = idle_timeout
+        
+        self.lock = threading.Lock()
+        self.idle = {}    # (game_id, version_dir) -> deque[(key, process, spawned_at)]
+        self.starts = {}  # (game_id, version_dir) -> deque[啟動時間]
+        self.counter = itertools.count(1)
+        
+        # 統計
+        self.hits = 0
+        self.misses = 0
+        self.spawned = 0
+        self.evicted = 0
+    
+    @property
+    def enabled(self):
+        return self.max_per_game > 0
+    
+    def take(self, game_id, version_dir, game_dir, server_cmd, room_id, args, on_exit):
+        """
+        取出一個閒置的 Game Server 指派給房間，沒有可用的時回傳 None (由呼叫者冷啟動)
+        無論是否命中都會記錄這次啟動，並在背景補充預熱 process
+        """
+        if not self.enabled or not bootstrap_command(server_cmd):
+            return None
+        
+        group = (game_id, version_dir)
+        now = time.monotonic()
+        process = None
+        
+        with self.lock:
+            self.starts.setdefault(group, deque()).append(now)
+            idle = self.idle.get(group)
+            while idle:
+                key, candidate, spawned_at = idle.popleft()
+                if candidate.poll() is None:
+                    process = candidate
+                    break
+            if process:
+                self.hits += 1
+            else:
+                self.misses += 1
+        
+        if process and not self.assign(key, process, room_id, args, on_exit):
+            process = None
+        
+        threading.Thread(
+            target=self.refill, args=(game_id, version_dir, game_dir, server_cmd), daemon=True
+        ).start()
+        return process
+    
+    def assign(self, key, process, room_id, args, on_exit):
+        """透過控制通道送出房間設定"""
+        try:
+            process.stdin.write((json.dumps({"args": args}) + "\n").encode('utf-8'))
+            process.stdin.close()
+        except OSError:
+            self.supervisor.stop(key, timeout=1)
+            return False
+        return self.supervisor.assign(key, room_id, on_exit)
+    
+    def target_size(self, group, now):
+        """依最近的啟動次數決定要保留幾個閒置 process (需持有 self.lock)"""
+        starts = self.starts.get(group)
+        if not starts:
+            return 0
+        while starts and now - starts[0] > self.window_seconds:
+            starts.popleft()
+        return min(self.max_per_game, math.ceil(len(starts) / self.starts_per_process))
+    
+    def refill(self, game_id, version_dir, game_dir, server_cmd):
+        """補充預熱 process 到目標數量，並淘汰閒置過久的"""
+        group = (game_id, version_dir)
+        self.evict_expired()
+        
+        while True:
+            with self.lock:
+                idle = self.idle.setdefault(group, deque())
+                if len(idle) >= self.target_size(group, time.monotonic()):
+                    return
+                key = f"warm-{next(self.counter)}"
+            
+            try:
+                process = self.supervisor.spawn(key, bootstrap_command(server_cmd), game_dir,
+                                                on_exit=self.on_idle_exit, control=True, group=game_id)
+            except Exception as e:
+                print(f"[Pool] Failed to pre-spawn game server for {game_id}: {e}")
+                return
+            
+            with self.lock:
+                self.idle.setdefault(group, deque()).append((key, process, time.monotonic()))
+                self.spawned += 1
+    
+    def evict(self, game_id, keep_version_dir=None):
+        """淘汰某遊戲除了 keep_version_dir 以外的閒置 process (遊戲更新或下架時)"""
+        victims = []
+        with self.lock:
+            for group in list(self.idle):
+                if group[0] == game_id and group[1] != keep_version_dir:
+                    victims.extend(self.idle.pop(group))
+                    self.starts.pop(group, None)
+        self.retire(victims)
+    
+    def versions(self, game_id):
+        """某遊戲目前有閒置 process 的版本目錄"""
+        with self.lock:
+            return {group[1] for group, idle in self.idle.items() if group[0] == game_id and idle}
+    
+    def evict_expired(self):
+        """淘汰閒置超過 idle_timeout 的 process"""
+        deadline = time.monotonic() - self.idle_timeout
+        victims = []
+        with self.lock:
+            for idle in self.idle.values():
+                while idle and idle[0][2] < deadline:
+                    victims.append(idle.popleft())
+        self.retire(victims)
+    
+    def retire(self, victims):
+        """關閉控制通道讓閒置 process 自行結束"""
+        for key, process, spawned_at in victims:
+            try:
+                process.stdin.close()
+            except OSError:
+                self.supervisor.stop(key, timeout=1)
+        if victims:
+            with self.lock:
+                self.evicted += len(victims)
+    
+    def on_idle_exit(self, key, returncode, expected, stderr_tail):
+        """未被指派就結束的預熱 process：正常結束時刪除 log，異常時保留供排查"""
+        if returncode == 0:
+            try:
+                os.remove(self.supervisor.log_path(key))
+            except OSError:
+                pass
+        else:
+            print(f"[Pool] Pre-warmed game server {key} exited with code {returncode}")
+    
+    def metrics(self):
+        """預熱池統計"""
+        with self.lock:
+            return {
+                "idle": {f"{game_id}/{version_dir}": len(idle) for (game_id, version_dir), idle in self.idle.items() if idle},
+                "hits": self.hits,
+                "misses": self.misses,
+                "spawned": self.spawned,
+                "evicted": self.evicted
+            }
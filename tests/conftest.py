@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+"""
+pytest 設定：伺服器模組以 server/ 為工作目錄互相 import (例如 from utils import ...)，
+測試時把 server/ 加入 sys.path
+"""
+
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_DIR = os.path.join(ROOT_DIR, 'server')
+
+if SERVER_DIR not in sys.path:
+    sys.path.insert(0, SERVER_DIR)
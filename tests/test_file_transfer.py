@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""區塊樹雜湊與中斷後的續傳"""
+
+import os
+import socket
+import threading
+
+import pytest
+
+from utils import (CHUNK_SIZE, ChunkTreeHasher, chunk_tree_root, describe_file, recv_file_with_metadata,
+                   recv_json, send_file, verify_partial)
+
+class CountingSocket:
+    """記錄送出 bytes 數的 socket 包裝"""
+    
+    def __init__(self, sock):
+        self.sock = sock
+        self.sent = 0
+    
+    def sendall(self, data):
+        self.sent += len(data)
+        self.sock.sendall(data)
+    
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+def make_file(path, size):
+    data = os.urandom(size)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return data
+
+def transfer(file_path, save_dir):
+    """以 socketpair 傳送檔案，回傳 (接收結果, 傳送結果, 傳送端送出的 bytes 數)"""
+    sender_sock, receiver_sock = socket.socketpair()
+    sender = CountingSocket(sender_sock)
+    sent = []
+    thread = threading.Thread(target=lambda: sent.append(send_file(sender, file_path)))
+    thread.start()
+    try:
+        metadata = recv_json(receiver_sock)
+        received = recv_file_with_metadata(receiver_sock, metadata, save_dir)
+        thread.join(10)
+    finally:
+        sender_sock.close()
+        receiver_sock.close()
+    return received, sent[0], sender.sent
+
+def test_resumed_hasher_matches_fresh_hash():
+    data = os.urandom(CHUNK_SIZE * 2 + 123)
+    fresh = ChunkTreeHasher()
+    fresh.update(data)
+    digest, chunks = fresh.finish()
+    assert len(chunks) == 3
+    assert chunk_tree_root("blake2b", chunks) == digest
+    
+    resumed = ChunkTreeHasher(chunks=chunks[:2])
+    resumed.update(data[CHUNK_SIZE * 2:])
+    assert resumed.finish() == (digest, chunks)
+
+@pytest.mark.parametrize("chunk_size", [0, -1, 1024, 64 * 1024 * 1024, "1", True])
+def test_invalid_chunk_size_is_rejected(chunk_size):
+    with pytest.raises(ValueError):
+        ChunkTreeHasher(chunk_size=chunk_size)
+    
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        metadata = {"filename": "x", "filesize": 1, "hash": "blake2b", "chunk_size": chunk_size}
+        success, message, path = recv_file_with_metadata(receiver, metadata, "unused")
+        assert not success and path is None
+        assert recv_json(sender)["status"] == "FAILED"
+
+def test_transfer_resumes_after_verified_chunks(tmp_path):
+    source = str(tmp_path / "game.zip")
+    data = make_file(source, CHUNK_SIZE * 2 + CHUNK_SIZE // 2)
+    info = describe_file(source)
+    save_dir = tmp_path / "incoming"
+    save_dir.mkdir()
+    
+    # 上次中斷時寫入了完整的前兩個區塊，以及一段未完成的第三個區塊
+    part_path = str(save_dir / f".{info['digest'][:16]}.part")
+    with open(part_path, 'wb') as f:
+        f.write(data[:CHUNK_SIZE * 2] + b'partial')
+    assert verify_partial(part_path, "blake2b", CHUNK_SIZE, info["chunks"]) == CHUNK_SIZE * 2
+    
+    (success, _, saved_path), (sent_ok, _), sent_bytes = transfer(source, str(save_dir))
+    assert success and sent_ok
+    with open(saved_path, 'rb') as f:
+        assert f.read() == data
+    # 只重送沒有驗證過的最後一個區塊 (加上少量 JSON)
+    assert sent_bytes < CHUNK_SIZE
+    assert not os.path.exists(part_path)
+
+def test_corrupt_chunk_is_not_resumed(tmp_path):
+    source = str(tmp_path / "game.zip")
+    data = make_file(source, CHUNK_SIZE * 2 + 10)
+    info = describe_file(source)
+    save_dir = tmp_path / "incoming"
+    save_dir.mkdir()
+    
+    part_path = str(save_dir / f".{info['digest'][:16]}.part")
+    corrupted = bytearray(data[:CHUNK_SIZE * 2])
+    corrupted[CHUNK_SIZE + 5] ^= 0xFF
+    with open(part_path, 'wb') as f:
+        f.write(bytes(corrupted))
+    assert verify_partial(part_path, "blake2b", CHUNK_SIZE, info["chunks"]) == CHUNK_SIZE
+    
+    (success, _, saved_path), _, sent_bytes = transfer(source, str(save_dir))
+    assert success
+    with open(saved_path, 'rb') as f:
+        assert f.read() == data
+    assert CHUNK_SIZE < sent_bytes < CHUNK_SIZE * 2
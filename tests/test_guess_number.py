@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+猜數字 Game Server 由大廳啟動時的 ATTACH 流程
+ATTACH 需在 JOINED 之前處理，TURN 的玩家名稱才會與 Client 收到的 JOINED 一致
+"""
+
+import os
+import socket
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from utils import recv_json, send_json
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             'developer_client', 'games', 'guess_number', 'server.py')
+ATTACH_TOKENS = {"alice": "token-a", "bob": "token-b"}
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+@pytest.fixture
+def game_server():
+    """假的大廳控制通道 + 由它「啟動」的 Game Server，回傳 Game Server 的 Port"""
+    lobby = socket.socket()
+    lobby.bind(('127.0.0.1', 0))
+    lobby.listen()
+    
+    def serve_control():
+        conn, _ = lobby.accept()
+        with conn:
+            request = recv_json(conn)
+            assert request["action"] == "GAME_CONTROL"
+            send_json(conn, {"success": True, "message": "控制連線已建立", "data": {"attach_tokens": ATTACH_TOKENS}})
+            while recv_json(conn) is not None:
+                pass
+    
+    threading.Thread(target=serve_control, daemon=True).start()
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, SERVER_SCRIPT, "--host", "127.0.0.1", "--port", str(port),
+         "--lobby-port", str(lobby.getsockname()[1]), "--room-id", "room1", "--lobby-token", "lobby-token"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        yield port
+    finally:
+        process.kill()
+        process.wait()
+        lobby.close()
+
+def connect(port, username, token):
+    for _ in range(50):
+        try:
+            sock = socket.create_connection(('127.0.0.1', port), timeout=10)
+            break
+        except OSError:
+            threading.Event().wait(0.1)
+    else:
+        pytest.fail("Game Server 沒有啟動")
+    send_json(sock, {"action": "ATTACH", "room_id": "room1", "username": username, "token": token})
+    return sock
+
+def next_event(sock, event_type):
+    while True:
+        message = recv_json(sock)
+        assert message is not None, f"等待 {event_type} 時連線中斷"
+        if message.get("type") == event_type:
+            return message
+
+def test_joined_and_turn_use_attached_name(game_server):
+    alice = connect(game_server, "alice", "token-a")
+    joined = next_event(alice, "JOINED")
+    assert joined["player_name"] == "alice"
+    
+    # token 不符時不能冒用其他帳號，維持預設名稱
+    mallory = connect(game_server, "bob", "token-a")
+    assert next_event(mallory, "JOINED")["player_name"] == "玩家2"
+    assert next_event(alice, "PLAYER_JOINED")["player_name"] == "玩家2"
+    
+    # 第一位玩家的 TURN 與 JOINED 名稱一致 (Client 以此判斷是否輪到自己)
+    turn = next_event(alice, "TURN")
+    assert turn["current_player"] == joined["player_name"]
+    alice.close()
+    mallory.close()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""RankedSet (indexable skiplist) 的排序、名次與跨距"""
+
+import random
+
+from leaderboard import RankedSet
+
+def check_widths(ranked, expected):
+    """每一層從 head 沿跨距前進，抵達每個節點時的位置都要等於它的名次 + 1"""
+    for level in range(ranked.level):
+        node, position = ranked.head, 0
+        while node[1][level] is not None:
+            position += node[2][level]
+            node = node[1][level]
+            assert position == expected.index(node[0]) + 1
+
+def test_insert_remove_keeps_order_and_widths():
+    rng = random.Random(7)
+    random.seed(7)
+    ranked = RankedSet()
+    expected = []
+    
+    for _ in range(300):
+        key = rng.randrange(1000)
+        if key in expected:
+            assert ranked.remove(key)
+            expected.remove(key)
+        else:
+            ranked.insert(key)
+            expected.append(key)
+        expected.sort()
+    
+    assert len(ranked) == len(expected)
+    assert ranked.slice(0, len(expected)) == expected
+    check_widths(ranked, expected)
+
+def test_rank_and_slice():
+    random.seed(1)
+    ranked = RankedSet()
+    keys = [(-score, name) for score, name in [(1500, "a"), (1200, "b"), (1800, "c"), (1200, "a")]]
+    for key in keys:
+        ranked.insert(key)
+    ordered = sorted(keys)
+    
+    assert [ranked.rank(key) for key in ordered] == [0, 1, 2, 3]
+    assert ranked.rank((-1, "missing")) is None
+    assert ranked.slice(1, 2) == ordered[1:3]
+    assert ranked.slice(3, 10) == ordered[3:]
+    assert ranked.slice(4, 1) == []
+
+def test_remove_missing_key():
+    ranked = RankedSet()
+    ranked.insert(1)
+    assert not ranked.remove(2)
+    assert ranked.remove(1)
+    assert len(ranked) == 0
+    assert ranked.slice(0, 5) == []
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""增量上傳：依檔案清單從目前版本補齊沒有附上的檔案"""
+
+import os
+
+import pytest
+
+import server_main
+from utils import build_manifest
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(content)
+
+@pytest.fixture
+def game_storage(tmp_path):
+    """已有 1.0 版 (含檔案清單) 的遊戲儲存目錄"""
+    storage = str(tmp_path / "game")
+    base = os.path.join(storage, "1.0")
+    write(os.path.join(base, "config.json"), '{"name": "g"}')
+    write(os.path.join(base, "server.py"), "print('v1')")
+    write(os.path.join(base, "assets", "map.txt"), "map")
+    server_main.write_current_version(storage, "1.0")
+    server_main.save_version_manifest(storage, "1.0", build_manifest(base))
+    return storage
+
+def new_version(tmp_path, files):
+    """開發者端的新版本目錄與它的完整檔案清單"""
+    source = str(tmp_path / "source")
+    for rel_path, content in files.items():
+        write(os.path.join(source, *rel_path.split('/')), content)
+    return build_manifest(source)
+
+def test_unchanged_files_come_from_current_version(tmp_path, game_storage):
+    manifest = new_version(tmp_path, {
+        "config.json": '{"name": "g"}',
+        "server.py": "print('v2')",
+        "assets/map.txt": "map"
+    })
+    # 壓縮檔只包含變更的檔案，外加一個不在清單中的殘留檔
+    extract_dir = str(tmp_path / "extract")
+    write(os.path.join(extract_dir, "server.py"), "print('v2')")
+    write(os.path.join(extract_dir, "stale.txt"), "old")
+    
+    assert server_main.assemble_incremental_version(extract_dir, manifest, game_storage) is None
+    assert build_manifest(extract_dir) == manifest
+    base_map = os.path.join(game_storage, "1.0", "assets", "map.txt")
+    assert os.path.samefile(os.path.join(extract_dir, "assets", "map.txt"), base_map)
+
+def test_file_missing_from_archive_and_base_is_rejected(tmp_path, game_storage):
+    manifest = new_version(tmp_path, {"config.json": '{"name": "g"}', "client.py": "new"})
+    extract_dir = str(tmp_path / "extract")
+    os.makedirs(extract_dir)
+    
+    assert server_main.assemble_incremental_version(extract_dir, manifest, game_storage) == "缺少檔案: client.py"
+
+def test_uploaded_file_must_match_manifest(tmp_path, game_storage):
+    manifest = new_version(tmp_path, {"server.py": "print('v2')"})
+    extract_dir = str(tmp_path / "extract")
+    write(os.path.join(extract_dir, "server.py"), "tampered")
+    
+    assert server_main.assemble_incremental_version(extract_dir, manifest, game_storage) == "檔案驗證失敗: server.py"
+
+def test_unsafe_paths_and_bad_manifests_are_rejected(tmp_path, game_storage):
+    extract_dir = str(tmp_path / "extract")
+    os.makedirs(extract_dir)
+    manifest = {"algorithm": "sha256", "files": {"../escape.py": {"hash": "0", "size": 1}}}
+    
+    assert server_main.assemble_incremental_version(extract_dir, manifest, game_storage).startswith("不合法的檔案路徑")
+    assert server_main.assemble_incremental_version(extract_dir, {"files": []}, game_storage) == "檔案清單格式錯誤"
+    assert (server_main.assemble_incremental_version(extract_dir, {"algorithm": "md5", "files": {}}, game_storage)
+            == "不支援的檔案清單雜湊演算法")
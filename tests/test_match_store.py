@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""MatchStore 載入時略過損毀紀錄、截掉寫到一半的最後一行"""
+
+import json
+
+from match_store import MatchStore
+
+def match_line(match_id, players=("alice", "bob"), winner="alice"):
+    return json.dumps({
+        "match_id": match_id, "time": 1.0 * match_id, "game_id": "g1", "room_id": "r1",
+        "players": list(players), "winner": winner, "result": {}
+    }) + "\n"
+
+def test_corrupt_middle_line_is_skipped(tmp_path):
+    path = tmp_path / "matches.jsonl"
+    path.write_text(match_line(1) + "{not json\n" + match_line(2, winner="bob") + match_line(3))
+    
+    store = MatchStore(str(path))
+    assert store.load() == 3
+    assert store.skipped == 1
+    assert store.player_stats("alice")["played"] == 3
+    assert store.player_stats("alice")["wins"] == 2
+    
+    matches, next_before = store.history(username="bob")
+    assert [match["match_id"] for match in matches] == [3, 2, 1]
+    assert next_before is None
+
+def test_partial_tail_is_truncated_and_appends_continue(tmp_path):
+    path = tmp_path / "matches.jsonl"
+    good = match_line(1)
+    path.write_text(good + match_line(2)[:20])
+    
+    store = MatchStore(str(path))
+    assert store.load() == 1
+    assert store.skipped == 0
+    assert path.read_text() == good
+    
+    match = store.record("g1", "r2", ["alice", "bob"], "bob", {})
+    assert match["match_id"] == 2
+    matches, _ = store.history(game_id="g1")
+    assert [m["match_id"] for m in matches] == [2, 1]
+
+def test_non_increasing_match_id_is_skipped(tmp_path):
+    path = tmp_path / "matches.jsonl"
+    path.write_text(match_line(1) + match_line(1) + match_line(2))
+    
+    store = MatchStore(str(path))
+    assert store.load() == 2
+    assert store.skipped == 1
+
+def test_single_player_match_is_not_a_win(tmp_path):
+    store = MatchStore(str(tmp_path / "matches.jsonl"))
+    store.load()
+    store.record("g1", "r1", ["alice"], "alice", {})
+    
+    stats = store.player_stats("alice")
+    assert stats["played"] == 1 and stats["wins"] == 0
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""RateLimiter 的 token bucket 與 SingleFlight 合併同時進行的工作"""
+
+import threading
+
+import pytest
+
+from rate_limiter import RateLimiter, SingleFlight
+
+def test_rate_limiter_burst_then_reject():
+    limiter = RateLimiter(rate=0.001, burst=3)
+    assert [limiter.allow("ip")[0] for _ in range(4)] == [True, True, True, False]
+    allowed, wait = limiter.allow("ip")
+    assert not allowed and wait > 0
+    # 不同 key 互不影響
+    assert limiter.allow("other")[0]
+
+def test_wait_time_does_not_consume_tokens():
+    limiter = RateLimiter(rate=0.001, burst=2)
+    assert limiter.wait_time("user") == 0
+    for _ in range(5):
+        assert limiter.wait_time("user") == 0
+    limiter.allow("user")
+    limiter.allow("user")
+    assert limiter.wait_time("user") > 0
+
+def test_rate_limiter_evicts_least_recently_used_key():
+    limiter = RateLimiter(rate=0.001, burst=1, max_keys=2)
+    limiter.allow("a")
+    limiter.allow("b")
+    limiter.allow("c")  # 淘汰 a
+    assert list(limiter.buckets) == ["b", "c"]
+    assert limiter.allow("a")[0]
+
+def test_single_flight_shares_one_call():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    
+    def work():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return {"value": 42}
+    
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do("key", work)))
+    leader.start()
+    assert started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flight.do("key", work))) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    while flight.metrics()["shared"] < 3:
+        threading.Event().wait(0.01)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+    
+    assert len(calls) == 1
+    assert len(results) == 4 and all(result is results[0] for result in results)
+    # 完成後同一個 key 會重新執行
+    assert flight.do("key", lambda: "again") == "again"
+
+def test_single_flight_propagates_errors_to_waiters():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    errors = []
+    
+    def fail():
+        started.set()
+        release.wait(5)
+        raise ValueError("boom")
+    
+    def call():
+        try:
+            flight.do("key", fail)
+        except ValueError as e:
+            errors.append(str(e))
+    
+    leader = threading.Thread(target=call)
+    leader.start()
+    assert started.wait(5)
+    follower = threading.Thread(target=call)
+    follower.start()
+    while flight.metrics()["shared"] < 1:
+        threading.Event().wait(0.01)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    
+    assert errors == ["boom", "boom"]
+    with pytest.raises(KeyError):
+        flight.do("other", lambda: {}["missing"])
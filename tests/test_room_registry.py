@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""RoomRegistry 的 revision 增量查詢與刪除紀錄 (tombstone)"""
+
+import room_registry
+from room_registry import RoomRegistry
+
+def create(registry, room_id, host, game_id="g1"):
+    room, error = registry.create(room_id, host, game_id, "Game", "1.0", 4, 2, 10000)
+    assert error is None
+    return room
+
+def test_changes_since_revision():
+    registry = RoomRegistry()
+    create(registry, "r1", "alice")
+    create(registry, "r2", "bob")
+    revision, rooms, removed, full = registry.changes(None)
+    assert full and {room.room_id for room in rooms} == {"r1", "r2"}
+    
+    registry.join("r1", "carol")
+    new_revision, rooms, removed, full = registry.changes(revision, epoch=registry.epoch)
+    assert not full
+    assert new_revision > revision
+    assert [room.room_id for room in rooms] == ["r1"]
+    assert removed == []
+    
+    # 沒有變動時回傳空的增量
+    _, rooms, removed, full = registry.changes(new_revision, epoch=registry.epoch)
+    assert (rooms, removed, full) == ([], [], False)
+
+def test_removed_rooms_are_reported_as_tombstones():
+    registry = RoomRegistry()
+    create(registry, "r1", "alice")
+    revision = registry.changes(None)[0]
+    
+    registry.leave("r1", "alice")
+    _, rooms, removed, full = registry.changes(revision)
+    assert not full
+    assert rooms == [] and removed == ["r1"]
+    assert registry.room_of("alice") is None
+
+def test_filtered_out_rooms_are_reported_as_removed():
+    registry = RoomRegistry()
+    room = create(registry, "r1", "alice")
+    revision = registry.changes(None, status="waiting")[0]
+    
+    registry.set_status(room, "playing")
+    _, rooms, removed, full = registry.changes(revision, status="waiting")
+    assert rooms == [] and removed == ["r1"]
+
+def test_old_or_foreign_revisions_get_full_list(monkeypatch):
+    monkeypatch.setattr(room_registry, "MAX_TOMBSTONES", 2)
+    registry = RoomRegistry()
+    create(registry, "keep", "zed")
+    revision = registry.changes(None)[0]
+    
+    for i in range(3):
+        create(registry, f"r{i}", f"user{i}")
+        registry.leave(f"r{i}", f"user{i}")
+    
+    # 刪除紀錄已丟棄到 revision 之後，無法再回報增量
+    assert registry.tombstone_floor > revision
+    _, rooms, removed, full = registry.changes(revision)
+    assert full and [room.room_id for room in rooms] == ["keep"]
+    
+    latest = registry.changes(None)[0]
+    assert not registry.changes(latest, epoch=registry.epoch)[3]
+    # 其他註冊表 (大廳重啟前) 的 revision、或比目前還新的 revision 都改回傳完整列表
+    assert registry.changes(latest, epoch="previous-epoch")[3]
+    assert registry.changes(latest + 5)[3]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""Session 過期：verify() 只拒絕，由 expire() 移除並讓大廳清理配對與房間"""
+
+import time
+
+import server_main
+from session_manager import SessionManager
+
+def test_verify_rejects_idle_session_but_leaves_it_for_expire():
+    sessions = SessionManager(idle_ttl=0.01)
+    session, _ = sessions.create("players", "alice", None)
+    time.sleep(0.02)
+    
+    assert sessions.verify(session.session_id, "players") is None
+    assert sessions.resume(session.session_id, "players", None) == (None, None)
+    assert sessions.has("players", "alice")
+    
+    assert [s.username for s in sessions.expire()] == ["alice"]
+    assert not sessions.has("players", "alice")
+    assert sessions.metrics()["expired"] == 1
+
+def test_detached_session_expires_after_grace():
+    sessions = SessionManager(resume_grace=0.01)
+    client = object()
+    session, _ = sessions.create("players", "bob", client)
+    assert sessions.detach(session.session_id, client) is session
+    assert sessions.expire() == []
+    
+    time.sleep(0.02)
+    assert sessions.verify(session.session_id, "players") is None
+    assert [s.username for s in sessions.expire()] == ["bob"]
+
+def test_expire_sessions_cleans_up_rejected_player(monkeypatch):
+    sessions = SessionManager(idle_ttl=0.01)
+    cancelled, cleaned = [], []
+    monkeypatch.setattr(server_main, "sessions", sessions)
+    monkeypatch.setattr(server_main.matchmaker, "cancel", cancelled.append)
+    monkeypatch.setattr(server_main, "cleanup_user_from_rooms", cleaned.append)
+    
+    session, _ = sessions.create("players", "alice", None)
+    time.sleep(0.02)
+    # 過期後第一個請求被拒絕，回收執行緒之後仍會清理該玩家
+    assert server_main.verify_session(session.session_id, "players") is None
+    server_main.expire_sessions()
+    
+    assert cancelled == ["alice"]
+    assert cleaned == ["alice"]